@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+広告ブロックのベンチマーク用のリストとリクエストのコーパス
+
+EasyList と同程度の規模・構成 (ドメインルール, URLパターン, オプション付きルール,
+例外ルール, 要素非表示ルール) のリストと、それに対するリクエストのコーパスを
+乱数のシードから決定的に生成する。同じバージョンのスクリプトからは常に同じ内容が得られるため、
+コミット間で結果を比較できる。ネットワークは使わない。
+
+実際のリストや、ブラウザで記録したリクエストを使いたい場合は、
+bench_adblock.py の --list / --corpus にファイルを指定する。
+コーパスは1行1リクエストのJSON Lines形式:
+    {"url": "https://ads.example.com/banner.js", "source": "www.example.org", "type": "script"}
+
+判定キャッシュの計測には、コーパスのページを閲覧の順に並べ直したもの (browsing_session()) を使う。
+実際の閲覧では再読み込みや「戻る」で同じページのリクエストが繰り返され、
+ページ内でもポーリングやビーコンで同じURLが何度も要求されるため、重複のないコーパスのままでは
+キャッシュが一度も当たらず、実際の効果を測れない。
+"""
+import json
+import random
+from urllib.parse import urlsplit
+
+# 生成するスナップショットの名前と規模 (EasyList 全体 / 地域リストを加えた規模)
+SNAPSHOTS = {
+    "easylist": 70_000,
+    "easylist+regional": 120_000,
+}
+CORPUS_SIZE = 20_000
+SNAPSHOT_VERSION = 2 # 生成方法を変えた場合は上げること (結果のJSONに記録される)
+# 閲覧の再現: 新しいページの代わりに最近のページをもう一度読み込む確率と、その対象にする最近のページ数
+SESSION_REVISIT_RATE = 0.4
+SESSION_RECENT_PAGES = 8
+# ページ内で xmlhttprequest / other のリクエストを繰り返す確率と最大回数 (ポーリングやビーコン)
+SESSION_REPEAT_RATE = 0.3
+SESSION_REPEAT_MAX = 3
+
+# EasyList のおおよその構成比
+_RULE_MIX = (
+    ("domain", 0.30),
+    ("path", 0.25),
+    ("option", 0.10),
+    ("exception", 0.05),
+    ("cosmetic_generic", 0.12),
+    ("cosmetic_specific", 0.18),
+)
+_TLDS = ("com", "net", "org", "jp", "io", "co.uk", "de", "fr")
+_AD_WORDS = ("ad", "ads", "banner", "track", "pixel", "promo", "sponsor", "analytics", "beacon", "popunder")
+_PAGE_WORDS = ("news", "blog", "shop", "video", "wiki", "forum", "mail", "search", "docs", "photos")
+_RESOURCE_TYPES = (
+    ("script", 0.30), ("image", 0.35), ("stylesheet", 0.08), ("xmlhttprequest", 0.12),
+    ("subdocument", 0.05), ("font", 0.04), ("media", 0.02), ("other", 0.04),
+)
+_TYPE_OPTIONS = ("script", "image", "stylesheet", "xmlhttprequest", "subdocument", "third-party")
+
+
+def _label(rng, lo=4, hi=10):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(rng.randint(lo, hi)))
+
+
+def _domain(rng):
+    return f"{_label(rng)}.{rng.choice(_TLDS)}"
+
+
+def _weighted(rng, table):
+    r = rng.random()
+    for value, weight in table:
+        r -= weight
+        if r <= 0:
+            return value
+    return table[-1][0]
+
+
+def generate_list(rule_count, seed=1):
+    """EasyList形式のリスト (行のリスト) と、その中のブロック対象ドメイン・パスを返す"""
+    rng = random.Random(seed)
+    lines = ["[Adblock Plus 2.0]", "! Title: EQUA benchmark snapshot", f"! Rules: {rule_count}"]
+    ad_domains, ad_paths = [], []
+    for i in range(rule_count):
+        kind = _weighted(rng, _RULE_MIX)
+        if kind == "domain":
+            domain = _domain(rng)
+            ad_domains.append(domain)
+            lines.append(f"||{domain}^")
+        elif kind == "path":
+            path = f"/{rng.choice(_AD_WORDS)}{i}/"
+            ad_paths.append(path)
+            lines.append(f"{path}*" if rng.random() < 0.5 else f"{path}{_label(rng)}.js")
+        elif kind == "option":
+            options = ",".join(rng.sample(_TYPE_OPTIONS, rng.randint(1, 2)))
+            lines.append(f"||{_domain(rng)}/{rng.choice(_AD_WORDS)}/*${options}")
+        elif kind == "exception":
+            lines.append(f"@@||{_domain(rng)}/{rng.choice(_AD_WORDS)}{i}/")
+        elif kind == "cosmetic_generic":
+            lines.append(f"##.{rng.choice(_AD_WORDS)}-{_label(rng, 3, 6)}")
+        else:
+            lines.append(f"{_domain(rng)}##div#{rng.choice(_AD_WORDS)}_{_label(rng, 3, 6)}")
+    return lines, ad_domains, ad_paths
+
+
+def generate_corpus(ad_domains, ad_paths, size=CORPUS_SIZE, seed=2):
+    """
+    ページの読み込みを模したリクエストのコーパスを生成する。
+    1ページにつきファーストパーティの部品が多数と、一部の広告・トラッカーへのリクエストを含む。
+    """
+    rng = random.Random(seed)
+    corpus = []
+    while len(corpus) < size:
+        page = f"www.{rng.choice(_PAGE_WORDS)}{rng.randint(1, 500)}.{rng.choice(_TLDS)}"
+        corpus.append({"url": f"https://{page}/", "source": "", "type": "document"})
+        for _ in range(rng.randint(20, 60)):
+            resource_type = _weighted(rng, _RESOURCE_TYPES)
+            r = rng.random()
+            if r < 0.08 and ad_domains:
+                host = f"cdn.{rng.choice(ad_domains)}"
+                path = f"/{_label(rng)}.js"
+            elif r < 0.14 and ad_paths:
+                host = page
+                path = f"{rng.choice(ad_paths)}{_label(rng)}.gif"
+            elif r < 0.55:
+                host = page
+                path = f"/static/{_label(rng)}/{_label(rng)}.{rng.choice(('js', 'css', 'png', 'jpg'))}"
+            else:
+                host = f"static.{_label(rng)}.{rng.choice(_TLDS)}"
+                path = f"/{_label(rng)}?v={rng.randint(1, 9999)}"
+            corpus.append({"url": f"https://{host}{path}", "source": page, "type": resource_type})
+    return corpus[:size]
+
+
+def browsing_session(corpus, size=CORPUS_SIZE, seed=3):
+    """
+    コーパスをページごとのリクエストのまとまりに分け、閲覧を模した順に並べ直す。
+    SESSION_REVISIT_RATE の確率で最近のページをもう一度読み込み (再読み込みや「戻る」) 、
+    ページ内では xmlhttprequest / other のリクエストの一部を繰り返す。
+    """
+    pages = []
+    for entry in corpus:
+        if entry.get("type") == "document" or not pages:
+            pages.append([])
+        pages[-1].append(entry)
+    rng = random.Random(seed)
+    session = []
+    recent = []
+    next_page = 0
+    while len(session) < size and pages:
+        if recent and (rng.random() < SESSION_REVISIT_RATE or next_page == len(pages)):
+            page = rng.choice(recent)
+        else:
+            page = pages[next_page]
+            next_page += 1
+            recent = (recent + [page])[-SESSION_RECENT_PAGES:]
+        for entry in page:
+            session.append(entry)
+            if entry.get("type") in ("xmlhttprequest", "other") and rng.random() < SESSION_REPEAT_RATE:
+                session.extend([entry] * rng.randint(1, SESSION_REPEAT_MAX))
+    return session[:size]
+
+
+def snapshot(name, seed=1):
+    """名前付きスナップショットの (リストの行, リクエストのコーパス) を返す"""
+    lines, ad_domains, ad_paths = generate_list(SNAPSHOTS[name], seed)
+    return lines, generate_corpus(ad_domains, ad_paths)
+
+
+def load_list(path):
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        return [line.rstrip('\r\n') for line in f]
+
+
+def load_corpus(path):
+    """JSON Lines形式のコーパスを読み込む"""
+    corpus = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                corpus.append(json.loads(line))
+    return corpus
+
+
+def save_corpus(corpus, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        for entry in corpus:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+def request_args(entry):
+    """コーパスの1件を Request() の引数 (url, hostname, source_hostname, resource_type) に変換する"""
+    url = entry["url"]
+    return url, urlsplit(url).hostname or "", entry.get("source", ""), entry.get("type", "other")
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+広告ブロック全体のベンチマーク
+
+同梱のスナップショット (adblock_corpus.py が決定的に生成するEasyList規模のリスト) に対して、
+次の項目を計測する。ネットワークやディスプレイは不要。
+    parse      … 全行のパース時間 (エンジンへの登録を除く)
+    compile    … エンジンの構築時間 (load_domains() でキャッシュが使えない場合の時間)
+    cache      … コンパイル済みキャッシュの保存・読み込み時間とファイルサイズ
+    memory     … 構築したエンジンが確保しているメモリ量 (tracemalloc)
+    match      … コーパスのリクエスト1件あたりの判定時間 (p50 / p99 / 平均) とブロック率
+                 エンジン単体と、判定キャッシュを経由した場合 (interceptRequest と同じ経路) の両方。
+                 キャッシュの効果は閲覧を模したリクエスト列 (adblock_corpus.browsing_session()) で計測し、
+                 同じ列でのエンジン単体の時間と、キャッシュのヒット率を並べて表示する
+
+使い方:
+    python benchmarks/bench_adblock.py                      # 全スナップショットを計測して表を表示
+    python benchmarks/bench_adblock.py --json result.json   # 結果をJSONにも書き出す
+    python benchmarks/bench_adblock.py --compare base.json  # 以前の結果との差分を表示
+    python benchmarks/bench_adblock.py --list easylist.txt --corpus requests.jsonl  # 実際のリストとコーパスを使う
+"""
+import argparse
+import gc
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import adblock_corpus # noqa: E402
+from equa_adblock import ( # noqa: E402
+    FilterEngine, NetworkFilter, Request, SharedEngine, load_engine_cache, parse_cosmetic_rule, save_engine_cache,
+)
+
+MATCH_ROUNDS = 3 # 判定時間は各リクエストをこの回数計測し、最小値を採用してノイズを抑える
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[index]
+
+
+def bench_parse(lines):
+    start = time.perf_counter()
+    for line in lines:
+        if parse_cosmetic_rule(line) is None:
+            NetworkFilter.parse(line)
+    return time.perf_counter() - start
+
+
+def bench_compile(lines):
+    gc.collect()
+    start = time.perf_counter()
+    engine = FilterEngine.from_lines(lines)
+    return engine, time.perf_counter() - start
+
+
+def bench_memory(lines):
+    """エンジンの構築中に確保され、構築後も残っているメモリ量 (バイト)"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    engine = FilterEngine.from_lines(lines)
+    gc.collect()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del engine
+    return after - before, peak - before
+
+
+def bench_cache(engine, lines):
+    with tempfile.TemporaryDirectory() as directory:
+        list_path = os.path.join(directory, "ad_block_list.txt")
+        with open(list_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        start = time.perf_counter()
+        save_engine_cache(engine, list_path)
+        save_time = time.perf_counter() - start
+        cache_path = os.path.splitext(list_path)[0] + ".cache"
+        size = os.path.getsize(cache_path)
+        start = time.perf_counter()
+        loaded = load_engine_cache(list_path)
+        load_time = time.perf_counter() - start
+        assert loaded is not None and loaded.rule_count == engine.rule_count
+    return save_time, load_time, size
+
+
+def bench_match(new_match, corpus):
+    """
+    リクエスト1件あたりの判定時間 (マイクロ秒) の統計とブロック率を返す。
+    new_match() はラウンドごとに呼ばれ、そのラウンドで使う判定関数を返す
+    (判定キャッシュを経由する場合は、ラウンドごとに空のキャッシュから始めるため) 。
+    """
+    timings = [float("inf")] * len(corpus)
+    blocked = 0
+    for round_index in range(MATCH_ROUNDS):
+        match = new_match()
+        for i, args in enumerate(corpus):
+            start = time.perf_counter_ns()
+            # interceptRequest と同様に、Requestの生成 (URLの小文字化など) も計測に含める
+            result = match(Request(*args))
+            elapsed = time.perf_counter_ns() - start
+            if elapsed < timings[i]:
+                timings[i] = elapsed
+            if round_index == 0 and result[0]:
+                blocked += 1
+    timings = sorted(t / 1000 for t in timings)
+    return {
+        "p50_us": round(percentile(timings, 50), 3),
+        "p99_us": round(percentile(timings, 99), 3),
+        "mean_us": round(sum(timings) / len(timings), 3),
+        "max_us": round(timings[-1], 3),
+        "blocked_ratio": round(blocked / len(corpus), 4),
+    }
+
+
+def cached_matcher(engine, caches):
+    """判定キャッシュを経由する判定関数を作る。使ったキャッシュは caches に追加する"""
+    shared = SharedEngine()
+    shared.swap(engine)
+    caches.append(shared.cache)
+    return shared.match
+
+
+def run_snapshot(name, lines, corpus, session):
+    corpus_args = [adblock_corpus.request_args(entry) for entry in corpus]
+    session_args = [adblock_corpus.request_args(entry) for entry in session]
+    parse_time = bench_parse(lines)
+    engine, compile_time = bench_compile(lines)
+    retained, peak = bench_memory(lines)
+    save_time, load_time, cache_size = bench_cache(engine, lines)
+
+    engine_match = bench_match(lambda: engine.match, corpus_args)
+    # 判定キャッシュを経由する場合 (ページの再読み込みなどで同じリクエストが繰り返される状況)
+    session_match = bench_match(lambda: engine.match, session_args)
+    caches = []
+    cached_match = bench_match(lambda: cached_matcher(engine, caches), session_args)
+    cache_stats = caches[0].stats() # どのラウンドも同じ列なので、ヒット率は1ラウンド目のもの
+    return {
+        "snapshot": name,
+        "lines": len(lines),
+        "rules": engine.rule_count,
+        "cosmetic_selectors": len(engine.cosmetic),
+        "requests": len(corpus),
+        "session_requests": len(session),
+        "session_unique_requests": len(set(session_args)),
+        "list_sha256": hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()[:16],
+        "parse_s": round(parse_time, 4),
+        "compile_s": round(compile_time, 4),
+        "cache_save_s": round(save_time, 4),
+        "cache_load_s": round(load_time, 4),
+        "cache_bytes": cache_size,
+        "memory_retained_bytes": retained,
+        "memory_peak_bytes": peak,
+        "match": engine_match,
+        "match_session": session_match,
+        "match_cached": cached_match,
+        "cache_hit_rate": round(cache_stats["hit_rate"], 4),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"{'snapshot':<20} {'rules':>8} {'parse':>8} {'compile':>8} {'load':>7} {'memory':>9} "
+          f"{'p50':>7} {'p99':>7} {'p50s':>7} {'p50c':>7} {'p99c':>7} {'hit':>6} {'block':>6}")
+    for r in results:
+        print(f"{r['snapshot']:<20} {r['rules']:>8} {r['parse_s']:>7.3f}s {r['compile_s']:>7.3f}s "
+              f"{r['cache_load_s']:>6.3f}s {r['memory_retained_bytes'] / 1e6:>7.1f}MB "
+              f"{r['match']['p50_us']:>5.1f}us {r['match']['p99_us']:>5.1f}us "
+              f"{r['match_session']['p50_us']:>5.1f}us "
+              f"{r['match_cached']['p50_us']:>5.1f}us {r['match_cached']['p99_us']:>5.1f}us "
+              f"{r['cache_hit_rate']:>6.1%} {r['match']['blocked_ratio']:>6.1%}")
+    print("(p50s: 閲覧を模したリクエスト列でのエンジン単体, p50c / p99c: 同じ列で判定キャッシュを経由した場合, "
+          "hit: そのときのキャッシュのヒット率)")
+
+
+# 比較時に表示する項目 (値が小さいほど良い)
+_COMPARE_KEYS = (
+    ("parse_s", lambda r: r["parse_s"]),
+    ("compile_s", lambda r: r["compile_s"]),
+    ("cache_load_s", lambda r: r["cache_load_s"]),
+    ("memory_retained_bytes", lambda r: r["memory_retained_bytes"]),
+    ("match.p50_us", lambda r: r["match"]["p50_us"]),
+    ("match.p99_us", lambda r: r["match"]["p99_us"]),
+    ("match_cached.p50_us", lambda r: r["match_cached"]["p50_us"]),
+)
+
+
+def print_comparison(results, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    base_by_name = {r["snapshot"]: r for r in baseline.get("results", [])}
+    print(f"\n比較対象: {baseline_path} (revision {baseline.get('revision')})")
+    for r in results:
+        base = base_by_name.get(r["snapshot"])
+        if base is None:
+            continue
+        if base.get("list_sha256") != r["list_sha256"]:
+            print(f"  {r['snapshot']}: リストの内容が異なるため比較できません")
+            continue
+        for key, get in _COMPARE_KEYS:
+            old, new = get(base), get(r)
+            change = (new - old) / old * 100 if old else 0.0
+            print(f"  {r['snapshot']:<20} {key:<24} {old:>12.4g} -> {new:<12.4g} {change:+6.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="広告ブロックのベンチマーク")
+    parser.add_argument("--snapshot", choices=sorted(adblock_corpus.SNAPSHOTS), action="append",
+                        help="計測するスナップショット (省略時はすべて)")
+    parser.add_argument("--list", help="スナップショットの代わりに使うリストファイル (ABP形式)")
+    parser.add_argument("--corpus", help="リクエストのコーパス (JSON Lines形式)")
+    parser.add_argument("--json", help="結果をJSONファイルに書き出す")
+    parser.add_argument("--compare", help="以前に --json で書き出した結果と比較する")
+    args = parser.parse_args()
+
+    runs = []
+    if args.list:
+        lines = adblock_corpus.load_list(args.list)
+        if args.corpus:
+            corpus = adblock_corpus.load_corpus(args.corpus)
+        else:
+            # コーパスがなければ、リスト中のドメインルールを使って生成する
+            domains = [line[2:-1] for line in lines if line.startswith("||") and line.endswith("^")]
+            corpus = adblock_corpus.generate_corpus(domains, [])
+        # 記録したコーパスはそのまま閲覧の順になっているので、並べ直さずにキャッシュの計測にも使う
+        session = corpus if args.corpus else adblock_corpus.browsing_session(corpus)
+        runs.append((os.path.basename(args.list), lines, corpus, session))
+    else:
+        for name in args.snapshot or adblock_corpus.SNAPSHOTS:
+            lines, corpus = adblock_corpus.snapshot(name)
+            if args.corpus:
+                corpus = adblock_corpus.load_corpus(args.corpus)
+                session = corpus
+            else:
+                session = adblock_corpus.browsing_session(corpus)
+            runs.append((name, lines, corpus, session))
+
+    results = [run_snapshot(*run) for run in runs]
+    print_results(results)
+
+    output = {
+        "benchmark": "adblock",
+        "snapshot_version": adblock_corpus.SNAPSHOT_VERSION,
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(output, f, ensure_ascii=False, indent=4)
+    if args.compare:
+        print_comparison(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
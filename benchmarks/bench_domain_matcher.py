@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+DomainMatcher のマイクロベンチマーク
+
+1k / 50k / 200k 件のドメインルールに対して、1リクエストあたりの判定時間を
+旧実装 (全ドメインに対する endswith の線形走査) と比較する。
+ネットワークやディスプレイは不要。
+
+使い方:
+    python benchmarks/bench_domain_matcher.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from equa_adblock import DomainMatcher # noqa: E402
+
+RULE_COUNTS = (1_000, 50_000, 200_000)
+REQUEST_COUNT = 2_000
+TLDS = ("com", "net", "org", "jp", "io", "co.uk")
+
+
+def make_domains(count, rng):
+    """ランダムなドメイン名をcount件生成する"""
+    domains = set()
+    while len(domains) < count:
+        label = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(rng.randint(4, 12)))
+        domains.add(f"{label}.{rng.choice(TLDS)}")
+    return list(domains)
+
+
+def make_hosts(domains, count, rng):
+    """半分はルールにヒットし、半分はヒットしないホスト名を生成する"""
+    hosts = []
+    for i in range(count):
+        if i % 2 == 0:
+            hosts.append(f"cdn{i}.{rng.choice(domains)}")
+        else:
+            hosts.append(f"www.site{i}.example.{rng.choice(TLDS)}")
+    return hosts
+
+
+def linear_match(domains, host):
+    """旧実装と同じ線形走査"""
+    for domain in domains:
+        if host == domain or host.endswith('.' + domain):
+            return domain
+    return None
+
+
+def bench(func, hosts, repeat):
+    """1リクエストあたりの平均時間 (マイクロ秒) を返す"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for host in hosts:
+            func(host)
+    elapsed = time.perf_counter() - start
+    return elapsed / (repeat * len(hosts)) * 1e6
+
+
+def main():
+    rng = random.Random(42)
+    print(f"{'rules':>8} {'linear (us/req)':>16} {'matcher (us/req)':>17} {'speedup':>9}")
+    for count in RULE_COUNTS:
+        domains = make_domains(count, rng)
+        hosts = make_hosts(domains, REQUEST_COUNT, rng)
+        matcher = DomainMatcher(domains)
+        rule_set = set(domains)
+
+        # 線形走査は遅いため、ルール数が多いときはリクエスト数を減らして計測する
+        linear_hosts = hosts[:max(20, REQUEST_COUNT * 1_000 // count)]
+        linear_us = bench(lambda h: linear_match(rule_set, h), linear_hosts, 1)
+        matcher_us = bench(matcher.match, hosts, 20)
+        print(f"{count:>8} {linear_us:>16.2f} {matcher_us:>17.3f} {linear_us / matcher_us:>8.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,10 @@
 import sys
 import os
 import json
+import time
 import urllib.request
 import urllib.parse
 import re
-import sqlite3
 try: # winregはWindows専用モジュールなので、他のOSでエラーにならないようにする
     import winreg
 except ImportError:
@@ -15,17 +15,22 @@ except ImportError:
 from packaging.version import parse as parse_version, InvalidVersion # バージョン番号の比較に使用
 from datetime import datetime # 日時情報の扱いに使用
 from html.parser import HTMLParser # HTMLの解析に使用 (ブックマークインポート)
+from concurrent.futures import ThreadPoolExecutor # 検索をGUIスレッドの外で行うために使用
 import qtawesome as qta # Font Awesomeアイコンを使用するためのライブラリ
+from equa_adblock import Request, QT_RESOURCE_TYPES, AdBlockStats, shared_engine, fetch_list, source_store_for # 広告ブロックエンジン
+from equa_history import history_service_for, HISTORY_PAGE_SIZE, RetentionPolicy, DEFAULT_HISTORY_MAX_AGE_DAYS, DEFAULT_HISTORY_MAX_URLS, DEFAULT_HISTORY_MAX_SIZE_MB, TRANSITION_LINK, TRANSITION_TYPED, TRANSITION_FORM_SUBMIT, TRANSITION_BACK_FORWARD, TRANSITION_RELOAD, TRANSITION_OTHER # 閲覧履歴サービス
+from equa_omnibox import Omnibox, SuggestionIndex, OMNIBOX_MAX_SUGGESTIONS, OMNIBOX_HISTORY_SIZE, OMNIBOX_REFRESH_INTERVAL, SOURCE_BOOKMARK, SOURCE_TAB # アドレスバーの入力候補
+from equa_bookmarks import BookmarkStore # ブックマークストア
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QToolBar, QLineEdit, QTabWidget, QInputDialog, QGroupBox, QStyle, QProxyStyle, QStyleOptionTab, QStyleFactory,
     QWidget, QSizePolicy, QHBoxLayout, QPushButton, QListWidget, QDialog, QVBoxLayout, QMessageBox,
     QLabel, QListWidgetItem, QMenu, QFileDialog, QProgressBar, QScrollArea, QColorDialog, QComboBox,
-    QStackedWidget, QCheckBox
+    QStackedWidget, QCheckBox, QSpinBox, QListView, QCompleter, QFormLayout
 )
 from PyQt6.QtWebEngineWidgets import QWebEngineView # ウェブページを表示するためのウィジェット
-from PyQt6.QtWebEngineCore import QWebEngineSettings, QWebEngineProfile, QWebEngineUrlRequestInterceptor, QWebEnginePage
-from PyQt6.QtCore import QUrl, QSettings, Qt, QStandardPaths, QSize, QThread, pyqtSignal, QTimer
-from PyQt6.QtGui import QIcon, QCloseEvent, QAction, QDesktopServices, QPixmap, QColor
+from PyQt6.QtWebEngineCore import QWebEngineSettings, QWebEngineProfile, QWebEngineUrlRequestInterceptor, QWebEngineUrlRequestInfo, QWebEnginePage, QWebEngineScript
+from PyQt6.QtCore import QUrl, QSettings, Qt, QStandardPaths, QSize, QThread, QObject, QAbstractListModel, QModelIndex, pyqtSignal, QTimer
+from PyQt6.QtGui import QIcon, QCloseEvent, QAction, QDesktopServices, QPixmap, QColor, QStandardItemModel, QStandardItem
 
 # アプリケーションのバージョンとGitHubリポジトリ情報
 __version__ = "0.2.0"
@@ -69,19 +74,82 @@ windows = []
 # 永続プロファイルを保持するためのグローバル変数
 persistent_profile = None # Cookieやキャッシュなどを保持するプロファイル
 
+# QtのリソースタイプをABP形式のタイプ名 ($script, $image など) に対応付ける
+# Qtのバージョンによって存在しないメンバーは無視する
+RESOURCE_TYPE_MAP = {
+    getattr(QWebEngineUrlRequestInfo.ResourceType, name): abp_type
+    for name, abp_type in QT_RESOURCE_TYPES.items()
+    if hasattr(QWebEngineUrlRequestInfo.ResourceType, name)
+}
+
+# ページの遷移の種類と、履歴に記録する訪問の種類の対応 (frecencyの重み付けに使う)
+# リダイレクトは含めない (リダイレクト先はリダイレクト元の遷移の種類を引き継ぐ)
+HISTORY_TRANSITIONS = {
+    getattr(QWebEnginePage.NavigationType, name): transition
+    for name, transition in (
+        ("NavigationTypeLinkClicked", TRANSITION_LINK),
+        ("NavigationTypeTyped", TRANSITION_TYPED),
+        ("NavigationTypeFormSubmitted", TRANSITION_FORM_SUBMIT),
+        ("NavigationTypeBackForward", TRANSITION_BACK_FORWARD),
+        ("NavigationTypeReload", TRANSITION_RELOAD),
+        ("NavigationTypeOther", TRANSITION_OTHER),
+    )
+    if hasattr(QWebEnginePage.NavigationType, name)
+}
+
+# 検索欄の入力が止まってから検索を始めるまでの時間 (ミリ秒)
+SEARCH_DEBOUNCE_MS = 150
+# 履歴の保存期間などの設定が変わってから履歴サービスに反映するまでの時間 (ミリ秒)
+# (スピンボックスを連続して操作している間に、何度も整理の予定を立て直さないように)
+HISTORY_RETENTION_DEBOUNCE_MS = 1000
+# ブックマークの検索やアドレスバーの入力候補の索引の作成など、メモリ上のデータの処理を行うスレッド
+# (1つだけなので、後から始めた処理が先の処理を追い越すことはない)
+search_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search")
+
+# 要素非表示ルール (##) のスタイルシートを挿入するスクリプトの名前
+COSMETIC_GENERIC_SCRIPT_NAME = "equa-cosmetic-generic" # 全サイト共通 (サブフレームにも挿入する)
+COSMETIC_PAGE_SCRIPT_NAME = "equa-cosmetic-page" # 遷移先のホスト固有
+
+# 共通のスタイルシートのスクリプトは大きいため、エンジンごとに一度だけ作って全ページで使い回す
+_generic_cosmetic_script = (None, None) # (エンジンのbuild_id, QWebEngineScript)
+
+def make_cosmetic_script(name, source, runs_on_subframes):
+    """DocumentCreationの時点で分離されたワールドで実行する QWebEngineScript を作る"""
+    script = QWebEngineScript()
+    script.setName(name)
+    script.setSourceCode(source)
+    script.setInjectionPoint(QWebEngineScript.InjectionPoint.DocumentCreation)
+    script.setWorldId(QWebEngineScript.ScriptWorldId.ApplicationWorld)
+    script.setRunsOnSubFrames(runs_on_subframes)
+    return script
+
+def generic_cosmetic_script(engine):
+    """エンジンの共通のスタイルシートを挿入するスクリプトを返す"""
+    global _generic_cosmetic_script
+    build_id, script = _generic_cosmetic_script
+    if script is None or build_id != engine.build_id:
+        script = make_cosmetic_script(COSMETIC_GENERIC_SCRIPT_NAME, engine.cosmetic.generic_script(), True)
+        _generic_cosmetic_script = (engine.build_id, script)
+    return script
+
 # 広告ブロック用リクエストインターセプター
 class AdBlockInterceptor(QWebEngineUrlRequestInterceptor):
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.ad_domains = set()
+        # フィルターエンジン本体はプロセス全体で共有し、このインターセプターは参照だけを持つ
+        # (ウィンドウが増えてもメモリ使用量は増えず、リストの更新もコンパイル1回で済む)
+        self.shared_engine = shared_engine
+        self.stats = AdBlockStats() # このプロファイルのリクエスト数・処理時間・ルールの一致回数
         # ad_block_list.txtのパスを決定 (ポータブル化)
         data_path = os.path.join(PORTABLE_BASE_PATH, DATA_DIR_NAME)
         self.block_list_path = os.path.join(data_path, 'ad_block_list.txt') # ブロックリストのファイルパス
         self.load_domains() # ドメインリストを読み込む
 
     def load_domains(self):
-        """ブロックリストファイルからドメインを読み込む。ファイルがなければデフォルト値で作成する"""
-        self.ad_domains.clear()
+        """
+        ブロックリストファイルから共有エンジンを読み込み直す。ファイルがなければデフォルト値で作成する。
+        共有エンジンが差し替わるため、どのウィンドウから呼んでも全ウィンドウに反映される。
+        """
         try:
             if not os.path.exists(self.block_list_path):
                 # ファイルが存在しない場合、デフォルトのリストで作成
@@ -101,70 +169,91 @@ class AdBlockInterceptor(QWebEngineUrlRequestInterceptor):
                     ]
                     f.write('\n'.join(default_domains) + '\n')
 
-            with open(self.block_list_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    # コメント行、空行、セクションマーカー、例外ルール(@@)を無視
-                    if not line or line.startswith(('!', '[', '#', '@@')):
-                        continue
-
-                    # EasyListのドメイン指定ルール (例: ||example.com^) を簡易的にパース
-                    if line.startswith('||'): # ドメイン指定ルール
-                        # '||' を取り除き、オプション部分('^'以降)を分離
-                        domain_part = line[2:].split('^', 1)[0]
-
-                        # この簡易ブロッカーはパス指定ルール('/'を含む)をサポートしないため、無視する。
-                        # これにより、"||google.com/ads/" のようなルールが "google.com" として誤って解釈されるのを防ぐ。
-                        if '/' in domain_part:
-                            continue
-                        
-                        # ドメイン名として妥当か簡単なチェック（先頭のワイルドカードとドットは除去）
-                        domain = domain_part.lstrip('*.')
-                        if '.' in domain and ' ' not in domain:
-                            self.ad_domains.add(domain)
-                    # その他の単純なドメイン指定も考慮 (後方互換性のため)
-                    # '/'を含まない、' 'を含まない、'.'を含むものをドメインとみなす
-                    elif '/' not in line and ' ' not in line and '.' in line:
-                        self.ad_domains.add(line)
+            # ファイルが前回から変わっていなければ現在のエンジンをそのまま使い、
+            # 変わっていればコンパイル済みキャッシュ (ad_block_list.cache) から読み込む。
+            # キャッシュも使えない場合にだけリストを再パースする。
+            # 新しいエンジンを構築してから参照を差し替えることで、読み込み途中の状態で照合されるのを防ぐ
+            self.shared_engine.reload(self.block_list_path)
         except Exception as e:
             print(f"広告ブロックリストの読み込みに失敗しました: {e}")
 
     def interceptRequest(self, info):
         """ウェブページからのリクエストをインターセプト(傍受)する"""
-        url_host = info.requestUrl().host()
-        # ドメインリストと後方一致でマッチングを行う
-        for domain in self.ad_domains:
-            # url_hostがブロック対象ドメインそのものであるか、
-            # またはブロック対象ドメインのサブドメインであるかをチェック
-            # 例: domain="example.com" の場合、"example.com" と "sub.example.com" にマッチ
-            if url_host == domain or url_host.endswith('.' + domain):
-                info.block(True)
-                return # 一致したらブロックして終了
+        start = time.perf_counter_ns()
+        blocked, rule = self.check_request(info)
+        if blocked:
+            info.block(True)
+        self.stats.record(time.perf_counter_ns() - start, blocked, rule)
+
+    def check_request(self, info):
+        """リクエストをブロックすべきかを判定し、(ブロックするか, 一致したルール) を返す"""
+        request_url = info.requestUrl()
+        # about:blank やローカルスキームなど、ホスト名を持たないURLは無視
+        url_host = request_url.host()
+        if not url_host:
+            return False, None
+
+        # リクエストの分類 (リソースタイプ・リクエスト元ページ) は一度だけ行う
+        resource_type = RESOURCE_TYPE_MAP.get(info.resourceType(), "other")
+        first_party_host = info.firstPartyUrl().host()
+        # URL・リクエスト元ページ・リソースタイプをもとに、$third-party や $script などのオプションも考慮して判定する
+        # エンジン側ではタイプごとのバケットに振り分けられたフィルターとだけ照合される
+        # (ページ本体はドメインルールと document に適用されるフィルターとだけ照合され、サブリソース用のフィルターは調べない)
+        request = Request(request_url.toString(), url_host, first_party_host, resource_type)
+        return self.shared_engine.match(request) # 判定キャッシュを経由して照合する
+
+def ad_blocker_for(profile):
+    """
+    プロファイルのインターセプターを返す (プロファイルごとに1つだけ作る) 。
+    インターセプターはプロファイルに1つしか設定できず、同じプロファイルのウィンドウのリクエストは
+    すべて最後に設定したものを通るため、ウィンドウごとに作ると計測値が正しく分かれない。
+    """
+    ad_blocker = getattr(profile, "ad_blocker", None)
+    if ad_blocker is None:
+        # プロファイルを親にして、プロファイルと同じだけ生存させる
+        ad_blocker = AdBlockInterceptor(profile)
+        profile.ad_blocker = ad_blocker
+    return ad_blocker
 
 # 広告ブロックリストを非同期で更新するためのワーカースレッド
+# ダウンロードしたリストは更新元URLごとにストア (data/ad_block_sources) に保存され、
+# 次回はETag / Last-Modifiedによる条件付きリクエストで、変更がなければ本体をダウンロードしない
 class UpdateBlocklistThread(QThread):
-    # シグナル: 処理完了時に (成功/失敗, コンテンツ, エラーメッセージ) を送信
-    finished = pyqtSignal(bool, str, str)  # success, content, error_message
+    # シグナル: 処理完了時に (成功/失敗, リストが更新されたか, エラーメッセージ) を送信
+    finished = pyqtSignal(bool, bool, str)  # success, modified, error_message
 
-    def __init__(self, url, parent=None):
+    def __init__(self, url, store, parent=None):
         super().__init__(parent)
         self.url = url
+        self.store = store
 
     # スレッドのメイン処理
     def run(self):
         try:
-            req = urllib.request.Request(
-                self.url,
-                headers={'User-Agent': 'Mozilla/5.0'}  # 403 Forbiddenを避けるため
-            )
-            with urllib.request.urlopen(req, timeout=30) as response:
-                if response.status == 200:
-                    content = response.read().decode('utf-8', errors='ignore')
-                    self.finished.emit(True, content, "") # 成功シグナルを送信
-                else:
-                    self.finished.emit(False, "", f"サーバーエラー: {response.status}") # 失敗シグナルを送信
+            modified = fetch_list(self.url, self.store, timeout=30)
+            self.finished.emit(True, modified, "") # 成功シグナルを送信
         except Exception as e:
-            self.finished.emit(False, "", str(e)) # 例外発生時に失敗シグナルを送信
+            self.finished.emit(False, False, str(e)) # 例外発生時に失敗シグナルを送信
+
+# ブロックリストファイルの書き出しとフィルターエンジンの構築を行うワーカースレッド
+# 大きなリストのパースでGUIスレッドが固まらないよう、構築済みのエンジンをシグナルで返す
+class BlocklistCompileThread(QThread):
+    # シグナル: 処理完了時に (成功/失敗, 構築したエンジン, ルール数, エラーメッセージ) を送信
+    finished = pyqtSignal(bool, object, int, str)  # success, engine, rule_count, error_message
+
+    def __init__(self, list_path, sources=None, user_rules=None, parent=None):
+        super().__init__(parent)
+        self.list_path = list_path
+        self.sources = sources # (見出し, リストファイルのパス) のリスト。Noneの場合はファイルを書き換えずに構築する
+        self.user_rules = user_rules # 指定した場合は、構築の前にファイルのユーザー定義ルールを置き換える
+
+    # スレッドのメイン処理
+    def run(self):
+        try:
+            engine, rule_count = shared_engine.build(self.list_path, self.sources, self.user_rules)
+            self.finished.emit(True, engine, rule_count, "")
+        except Exception as e:
+            self.finished.emit(False, None, 0, str(e))
 
 # GitHubリリースを非同期でチェックするためのワーカースレッド
 class UpdateCheckThread(QThread):
@@ -438,23 +527,23 @@ QPushButton:pressed {
 }
 
 /* リストウィジェット */
-QListWidget {
+QListWidget, QListView#history_list {
     background-color: #2E3440;
     border: 1px solid #4C566A;
     border-radius: 4px;
     padding: 2px;
 }
 
-QListWidget::item {
+QListWidget::item, QListView#history_list::item {
     padding: 10px;
     border-radius: 3px;
 }
 
-QListWidget::item:hover {
+QListWidget::item:hover, QListView#history_list::item:hover {
     background-color: #434C5E;
 }
 
-QListWidget::item:selected {
+QListWidget::item:selected, QListView#history_list::item:selected {
     background-color: #5E81AC;
     color: #ECEFF4;
 }
@@ -742,23 +831,23 @@ QPushButton:pressed {
 }
 
 /* リストウィジェット */
-QListWidget {
+QListWidget, QListView#history_list {
     background-color: #ECEFF4;
     border: 1px solid #D8DEE9;
     border-radius: 4px;
     padding: 2px;
 }
 
-QListWidget::item {
+QListWidget::item, QListView#history_list::item {
     padding: 10px;
     border-radius: 3px;
 }
 
-QListWidget::item:hover {
+QListWidget::item:hover, QListView#history_list::item:hover {
     background-color: #E5E9F0;
 }
 
-QListWidget::item:selected {
+QListWidget::item:selected, QListView#history_list::item:selected {
     background-color: #5E81AC;
     color: #ECEFF4;
 }
@@ -933,6 +1022,17 @@ class BookmarkHTMLParser(HTMLParser):
 
 # JavaScriptのコンソールエラーを抑制するためのカスタムWebEnginePage
 class SilentWebEnginePage(QWebEnginePage):
+    # シグナル: メインフレームの遷移が始まる直前に遷移先のURLを送信 (要素非表示スクリプトの差し替えに使う)
+    mainFrameNavigationRequested = pyqtSignal(QUrl)
+    # 直近のメインフレームの遷移の種類 (履歴に記録する訪問の種類)
+    main_frame_transition = TRANSITION_LINK
+
+    def acceptNavigationRequest(self, url, navigation_type, is_main_frame):
+        if is_main_frame:
+            self.main_frame_transition = HISTORY_TRANSITIONS.get(navigation_type, self.main_frame_transition)
+            self.mainFrameNavigationRequested.emit(url)
+        return super().acceptNavigationRequest(url, navigation_type, is_main_frame)
+
     def javaScriptConsoleMessage(self, level, message, lineNumber, sourceID):
         # ウェブサイト側から出力されるJavaScriptのコンソールメッセージを
         # ターミナルに表示しないようにします。
@@ -1001,7 +1101,6 @@ class BookmarkWindow(QDialog):
         # 検索バー
         self.search_bar = QLineEdit()
         self.search_bar.setPlaceholderText("ブックマークを検索...")
-        self.search_bar.textChanged.connect(self.filter_items)
         layout.addWidget(self.search_bar)
 
         # ブックマークリストウィジェット
@@ -1027,7 +1126,11 @@ class BookmarkWindow(QDialog):
 
         layout.addLayout(button_layout)
         self.setLayout(layout)
-        self.filter_items() # 初回ロード
+
+        # 入力のたびに検索せず、入力が止まってから検索用のスレッドで検索する
+        self.search = SearchController(self.search_bookmarks, self.show_items, self)
+        self.search_bar.textChanged.connect(self.filter_items)
+        self.search.search_now("") # 初回ロード
 
         # ダブルクリックでブックマークを開く
         self.list_widget.itemDoubleClicked.connect(self.open_bookmark)
@@ -1037,21 +1140,30 @@ class BookmarkWindow(QDialog):
 
     def filter_items(self):
         """検索バーのテキストに基づいてブックマークをフィルタリング"""
-        search_text = self.search_bar.text().lower()
+        self.search.set_text(self.search_bar.text())
+
+    def search_bookmarks(self, text):
+        """ブックマークの検索を検索用のスレッドで始め、結果を受け取る Future を返す"""
+        # 検索中にGUIスレッドで追加・削除されても影響しないよう、ストアの複製から作った索引で検索する
+        return search_executor.submit(self.parent.bookmarks.index().search, text)
+
+    def show_items(self, text, bookmarks):
+        """検索結果のブックマークをリストに表示する"""
+        # 項目を追加するたびに再描画しないよう、まとめて追加してから描画する
+        self.list_widget.setUpdatesEnabled(False)
         self.list_widget.clear()
-        for bookmark in self.parent.bookmarks:
-            if search_text in bookmark['title'].lower() or search_text in bookmark['url'].lower():
-                item = QListWidgetItem(f"{bookmark['title']} ({bookmark['url']})")
-                item.setData(Qt.ItemDataRole.UserRole, bookmark)
-                self.list_widget.addItem(item)
+        for bookmark in bookmarks:
+            item = QListWidgetItem(f"{bookmark['title']} ({bookmark['url']})")
+            item.setData(Qt.ItemDataRole.UserRole, bookmark)
+            self.list_widget.addItem(item)
+        self.list_widget.setUpdatesEnabled(True)
 
     def load_bookmarks(self):
         """ブックマークリストを再読み込みし、表示を更新する"""
-        # 検索バーをクリアする。テキストが入っていればtextChangedシグナルが発火し、リストが更新される。
+        # 検索バーをクリアする (textChangedによる検索は、直後の search_now() で置き換えられる)
         self.search_bar.clear()
-        # 検索バーがもともと空だった場合、textChangedが発火しないため、
-        # 明示的にfilter_itemsを呼び出してリストの更新を保証する。
-        self.filter_items()
+        # 検索バーがもともと空だった場合もリストが更新されるよう、待たずに検索し直す
+        self.search.search_now("")
 
     def add_bookmark(self):
         """現在のタブのURLとタイトルをブックマークに追加"""
@@ -1059,9 +1171,8 @@ class BookmarkWindow(QDialog):
         if current_browser:
             url = current_browser.url().toString()
             title = current_browser.title()
-            # ブックマークが存在しないかチェック
-            if not any(b['url'] == url for b in self.parent.bookmarks):
-                self.parent.bookmarks.insert(0, {"title": title, "url": url})
+            # 同じURLのブックマークがなければ先頭に追加する
+            if self.parent.bookmarks.prepend({"title": title, "url": url}):
                 self.parent.save_bookmarks()
                 self.load_bookmarks()
                 QMessageBox.information(self, "完了", "ブックマークに追加しました。")
@@ -1087,7 +1198,7 @@ class BookmarkWindow(QDialog):
     def delete_bookmark(self, item):
         """ブックマークを削除"""
         bookmark_to_delete = item.data(Qt.ItemDataRole.UserRole)
-        self.parent.bookmarks = [b for b in self.parent.bookmarks if b['url'] != bookmark_to_delete['url']]
+        self.parent.bookmarks.remove(bookmark_to_delete['url'])
         self.parent.save_bookmarks()
         self.load_bookmarks()
 
@@ -1100,6 +1211,316 @@ class BookmarkWindow(QDialog):
         """エクスポート処理を親ウィンドウに依頼する"""
         self.parent.export_bookmarks()
 
+# ワーカースレッドで完了したFutureの結果をGUIスレッドに届けるためのオブジェクト
+class FutureRelay(QObject):
+    # シグナル: (コールバック, 失敗したときのコールバック, 完了したFuture) 。
+    # 別スレッドから発行されるとGUIスレッドのキューに積まれる
+    done = pyqtSignal(object, object, object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.done.connect(self._deliver)
+
+    def watch(self, future, callback, on_error=None):
+        """
+        futureが完了したら、その結果を引数にしてGUIスレッドでcallbackを呼び出す。
+        失敗した場合は、on_errorがあれば例外を引数にして呼び出す (なければ失敗を表示するだけ) 。
+        """
+        future.add_done_callback(lambda f: self.done.emit(callback, on_error, f))
+
+    def _deliver(self, callback, on_error, future):
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            if on_error is None:
+                print(f"バックグラウンド処理に失敗しました: {e}")
+            else:
+                on_error(e)
+            return
+        callback(result)
+
+# 検索欄のための検索コントローラー (履歴とブックマークで共用)
+class SearchController(QObject):
+    """
+    検索欄の入力を SEARCH_DEBOUNCE_MS だけ待って間引き、最後に入力された検索語の結果だけを適用する。
+    search(text) は結果を受け取る Future を返す関数 (時間のかかる検索は別スレッドで行う) 、
+    apply(text, result) は結果を表示する関数で、GUIスレッドで呼ばれる。
+    入力のたびに世代番号を増やし、結果が届いたときに世代が変わっていれば捨てる。
+    まだ始まっていない古い検索は取り消す。
+    """
+
+    def __init__(self, search, apply, parent=None):
+        super().__init__(parent)
+        self._search = search
+        self._apply = apply
+        self._text = ""
+        self._generation = 0
+        self._future = None
+        self.relay = FutureRelay(self)
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(SEARCH_DEBOUNCE_MS)
+        self._timer.timeout.connect(self._run)
+
+    def set_text(self, text):
+        """検索語を更新する。入力が止まってから検索する"""
+        self._text = text
+        # 実行中の検索の結果は、届いても使わない
+        self._generation += 1
+        self._timer.start()
+
+    def search_now(self, text):
+        """待たずにすぐ検索する (初回の表示や、データが変わったときの再表示に使う)"""
+        self._text = text
+        self._generation += 1
+        self._timer.stop()
+        self._run()
+
+    def _run(self):
+        if self._future is not None:
+            # まだ始まっていなければ取り消す (実行中のものは世代番号で結果を捨てる)
+            self._future.cancel()
+        text, generation = self._text, self._generation
+        self._future = self._search(text)
+        self.relay.watch(self._future, lambda result: self._deliver(generation, text, result))
+
+    def _deliver(self, generation, text, result):
+        if generation != self._generation:
+            return
+        self._future = None
+        self._apply(text, result)
+
+# アドレスバーの入力候補
+class OmniboxController(QObject):
+    """
+    アドレスバーに入力するたびに、履歴・ブックマーク・開いているタブから候補を集めてポップアップに表示する。
+    候補はメモリ上の索引を引くだけで集まるので、入力ごとにGUIスレッドで OMNIBOX_BUDGET 以内に求める。
+    索引は古くなったら (履歴は OMNIBOX_REFRESH_INTERVAL ごと、ブックマークは変更されたとき)
+    search_executor で作り直して差し替え、そのとき候補を表示していれば新しい索引で引き直す。
+    """
+    URL_ROLE = Qt.ItemDataRole.UserRole
+    SOURCES_ROLE = Qt.ItemDataRole.UserRole + 1
+
+    def __init__(self, window):
+        super().__init__(window)
+        self.window = window
+        self.url_bar = window.url_bar
+        self.omnibox = Omnibox()
+        self.relay = FutureRelay(self)
+        self._history_built_at = None # 最後に履歴の索引を作り始めた時刻 (time.monotonic())
+        self._history_generation = 0 # 履歴が削除されたら増やし、それより前に作り始めた索引を捨てる
+        self._bookmarks_dirty = True
+        self._bookmarks_generation = 0
+
+        self.model = QStandardItemModel(self)
+        # setCompleter() ではなく setWidget() で結びつけ、入力の補完と絞り込みはQCompleterに任せない
+        self.completer = QCompleter(self.model, self)
+        self.completer.setWidget(self.url_bar)
+        self.completer.setCompletionMode(QCompleter.CompletionMode.UnfilteredPopupCompletion)
+        self.completer.setMaxVisibleItems(OMNIBOX_MAX_SUGGESTIONS)
+        self.completer.activated[QModelIndex].connect(self.open_suggestion)
+        self.completer.highlighted[QModelIndex].connect(self.preview_suggestion)
+        self.url_bar.textEdited.connect(self.update_suggestions)
+
+    def update_suggestions(self, text):
+        """入力された text に一致する候補を表示する"""
+        self.refresh_indexes()
+        suggestions = self.omnibox.suggest(text, self.window.open_tabs())
+        icon_color = self.window.theme_colors['icon_color']
+        self.model.clear()
+        for suggestion in suggestions:
+            if suggestion.sources & SOURCE_TAB:
+                icon = qta.icon('fa5s.window-restore', color=icon_color)
+            elif suggestion.sources & SOURCE_BOOKMARK:
+                icon = qta.icon('fa5s.star', color=icon_color)
+            else:
+                icon = qta.icon('fa5s.history', color=icon_color)
+            item = QStandardItem(icon, f"{suggestion.title} - {suggestion.url}")
+            item.setData(suggestion.url, self.URL_ROLE)
+            item.setData(suggestion.sources, self.SOURCES_ROLE)
+            item.setToolTip(suggestion.url)
+            self.model.appendRow(item)
+        if suggestions:
+            self.completer.complete()
+        else:
+            self.hide_popup()
+
+    def hide_popup(self):
+        self.completer.popup().hide()
+
+    def preview_suggestion(self, index):
+        """矢印キーで選んでいる候補のURLをアドレスバーに表示する"""
+        self.url_bar.setText(index.data(self.URL_ROLE))
+
+    def open_suggestion(self, index):
+        """選ばれた候補を開く。開いているタブの候補ならそのタブに切り替える"""
+        url = index.data(self.URL_ROLE)
+        self.hide_popup()
+        if index.data(self.SOURCES_ROLE) & SOURCE_TAB and self.window.switch_to_tab(url):
+            return
+        self.url_bar.setText(url)
+        self.window.navigate_to_url()
+
+    def refresh_indexes(self):
+        """古くなった索引の作り直しを始める (完了は待たない)"""
+        service = self.window.history_service
+        now = time.monotonic()
+        if service is not None and (self._history_built_at is None or now - self._history_built_at >= OMNIBOX_REFRESH_INTERVAL):
+            self._history_built_at = now
+            generation = self._history_generation
+            # 履歴サービスのスレッドで読み出し、索引は search_executor で作る
+            self.relay.watch(service.frecent(OMNIBOX_HISTORY_SIZE),
+                             lambda rows: self._build_history_index(generation, rows))
+        if self._bookmarks_dirty:
+            self._bookmarks_dirty = False
+            generation = self._bookmarks_generation
+            items = [(b['url'], b['title'], None) for b in self.window.bookmarks]
+            self.relay.watch(search_executor.submit(SuggestionIndex, items),
+                             lambda index: self._set_bookmark_index(generation, index))
+
+    def history_changed(self):
+        """履歴が削除されたときに呼ぶ。作成中の索引を捨て、次の入力で作り直す"""
+        self._history_generation += 1
+        self._history_built_at = None
+        self.omnibox.set_history(SuggestionIndex())
+
+    def bookmarks_changed(self):
+        """ブックマークが変更されたときに呼ぶ。次の入力で索引を作り直す"""
+        self._bookmarks_generation += 1
+        self._bookmarks_dirty = True
+
+    def _build_history_index(self, generation, rows):
+        if generation != self._history_generation:
+            return
+        self.relay.watch(search_executor.submit(SuggestionIndex.from_history, rows),
+                         lambda index: self._set_history_index(generation, index))
+
+    def _set_history_index(self, generation, index):
+        if generation != self._history_generation:
+            return
+        self.omnibox.set_history(index)
+        self._resuggest()
+
+    def _set_bookmark_index(self, generation, index):
+        if generation != self._bookmarks_generation:
+            return
+        self.omnibox.set_bookmarks(index)
+        self._resuggest()
+
+    def _resuggest(self):
+        """候補を表示している間に索引が差し替わったら、新しい索引で引き直す"""
+        if self.completer.popup().isVisible() or (self.url_bar.hasFocus() and self.url_bar.isModified()):
+            self.update_suggestions(self.url_bar.text())
+
+# 履歴の一覧のモデル
+class HistoryListModel(QAbstractListModel):
+    """
+    履歴を最近訪問した順に、スクロールに合わせて HISTORY_PAGE_SIZE 件ずつ読み込むモデル。
+    ビューが末尾に近づくと canFetchMore() / fetchMore() が呼ばれ、前のページの最後の行を起点に
+    次のページを履歴サービスに問い合わせる (キーセットページング) 。
+    保持するのは読み込んだ行の値だけで、表示用の文字列はビューが描画する行についてだけ data() で作る。
+    検索語がある場合、最初のページは一致の度合いの高い順 (HistoryService.search() のbm25の順位) で表示し、
+    続きは一致する履歴を最近訪問した順に読み込む (最初のページに表示したものは除く) 。
+    """
+
+    def __init__(self, service, parent=None):
+        super().__init__(parent)
+        self.service = service
+        self.relay = FutureRelay(self)
+        self._rows = [] # (タイトル, URL, 最終訪問日時, id)
+        self._text = ""
+        self._after = None # 次のページの起点 (最後に読み込んだ訪問順のページの最後の行の (最終訪問日時, id))
+        self._ranked_ids = set() # 順位順の最初のページに表示した行のid (続きのページでは表示しない)
+        self._exhausted = False # 最後のページまで読み込んだか
+        self._loading = False # 読み込み中のページがあるか
+        self._generation = 0 # 検索語が変わるたびに増やし、古い検索の結果を捨てる
+
+    def first_page(self, text):
+        """検索語 text の最初のページを受け取る Future を返す (SearchController から使う)"""
+        if text:
+            return self.service.search(text, HISTORY_PAGE_SIZE)
+        return self.service.page(text, None, HISTORY_PAGE_SIZE)
+
+    def set_first_page(self, text, rows):
+        """
+        検索語を変えて、最初のページの行で置き換える。続きはスクロールに合わせて読み込む。
+        結果が届くまでは前の一覧を表示したままにするので、入力中に一覧が空になってちらつかない。
+        """
+        self.beginResetModel()
+        self._rows = list(rows)
+        self._text = text
+        if text:
+            # 順位順に並んでいるので、続きは訪問順の先頭から読み込み、すでに表示したものを除く
+            self._after = None
+            self._ranked_ids = {row[3] for row in rows}
+        else:
+            self._after = (rows[-1][2], rows[-1][3]) if rows else None
+            self._ranked_ids = set()
+        self._exhausted = len(rows) < HISTORY_PAGE_SIZE
+        self._loading = False
+        self._generation += 1
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and not self._exhausted and not self._loading
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        self._loading = True
+        generation = self._generation
+        future = self.service.page(self._text, self._after, HISTORY_PAGE_SIZE)
+        self.relay.watch(future, lambda rows: self._append_page(generation, rows),
+                         lambda error: self._page_failed(generation, error))
+
+    def _page_failed(self, generation, error):
+        if generation != self._generation:
+            return
+        # 読み込み中のままにすると、以降は続きを読み込めなくなる (次にスクロールしたときに読み込み直す)
+        self._loading = False
+        print(f"履歴の読み込みに失敗しました: {error}")
+
+    def _append_page(self, generation, rows):
+        if generation != self._generation:
+            return # 検索語が変わる前に問い合わせた結果
+        self._loading = False
+        if len(rows) < HISTORY_PAGE_SIZE:
+            self._exhausted = True
+        if rows:
+            self._after = (rows[-1][2], rows[-1][3])
+        rows = [row for row in rows if row[3] not in self._ranked_ids]
+        if rows:
+            first = len(self._rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+            self._rows.extend(rows)
+            self.endInsertRows()
+        elif not self._exhausted:
+            # すべて表示済みの行だった場合は、行が増えずビューから次の読み込みが要求されないので続けて読み込む
+            self.fetchMore(QModelIndex())
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._rows):
+            return None
+        title, url, last_visit_time, _ = self._rows[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            try:
+                # 最終訪問日時はUNIX時間 (ミリ秒)
+                dt = datetime.fromtimestamp(last_visit_time / 1000)
+                time_str = dt.strftime('%Y/%m/%d %H:%M')
+            except (ValueError, TypeError, OSError):
+                time_str = "不明な日時"
+            return f"{title}\n{url}\n{time_str}"
+        if role == Qt.ItemDataRole.UserRole:
+            return url
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return url
+        return None
+
 # 履歴ウィンドウクラス
 class HistoryWindow(QDialog):
     def __init__(self, parent=None):
@@ -1113,67 +1534,34 @@ class HistoryWindow(QDialog):
         # 検索バー
         self.search_bar = QLineEdit()
         self.search_bar.setPlaceholderText("履歴を検索...")
-        self.search_bar.textChanged.connect(self.filter_items)
         layout.addWidget(self.search_bar)
 
-        self.list_widget = QListWidget()
-        layout.addWidget(self.list_widget)
+        # 履歴はモデルからスクロールに合わせて読み込む (件数の上限はない)
+        # プライベートウィンドウからも通常の履歴を閲覧できるよう、パスからサービスを取得する
+        self.model = HistoryListModel(history_service_for(self.parent.history_db_path), self)
+        self.list_view = QListView()
+        self.list_view.setObjectName("history_list")
+        # すべての行が同じ高さ (3行のテキスト) なので、行ごとの大きさの計算を省く
+        self.list_view.setUniformItemSizes(True)
+        self.list_view.setModel(self.model)
+        layout.addWidget(self.list_view)
         self.setLayout(layout)
 
-        self.filter_items() # 初回ロード（検索バーは空なので全件表示）
+        # 入力のたびに検索せず、入力が止まってから履歴サービスのスレッドで検索する
+        self.search = SearchController(self.model.first_page, self.model.set_first_page, self)
+        self.search_bar.textChanged.connect(self.filter_items)
+        self.search.search_now("") # 初回ロード（検索バーは空なので全件表示）
 
         # ダブルクリックで履歴のページを開く
-        self.list_widget.itemDoubleClicked.connect(self.open_history_url)
+        self.list_view.doubleClicked.connect(self.open_history_url)
 
     def filter_items(self):
         """検索バーのテキストに基づいて履歴をフィルタリング"""
-        search_text = self.search_bar.text().strip()
-        self.list_widget.clear()
+        self.search.set_text(self.search_bar.text().strip())
 
-        try:
-            conn = sqlite3.connect(self.parent.history_db_path)
-            cursor = conn.cursor()
-            
-            if search_text:
-                # 検索語でタイトルとURLを検索
-                query = """
-                    SELECT title, url, last_visit_time FROM history
-                    WHERE title LIKE ? OR url LIKE ?
-                    ORDER BY last_visit_time DESC
-                    LIMIT 200
-                """
-                search_pattern = f"%{search_text}%"
-                cursor.execute(query, (search_pattern, search_pattern))
-            else:
-                # 検索語がなければ全件を降順で取得
-                query = """
-                    SELECT title, url, last_visit_time FROM history
-                    ORDER BY last_visit_time DESC
-                    LIMIT 200
-                """
-                cursor.execute(query)
-
-            for title, url, last_visit_time in cursor.fetchall():
-                try:
-                    dt = datetime.fromisoformat(last_visit_time)
-                    time_str = dt.strftime('%Y/%m/%d %H:%M')
-                except (ValueError, TypeError):
-                    time_str = "不明な日時"
-                
-                display_text = f"{title}\n{url}\n{time_str}"
-                item = QListWidgetItem(display_text)
-                item.setData(Qt.ItemDataRole.UserRole, url)
-                self.list_widget.addItem(item)
-
-        except sqlite3.Error as e:
-            print(f"履歴データベースの読み込みに失敗しました: {e}")
-        finally:
-            if conn:
-                conn.close()
-
-    def open_history_url(self, item):
+    def open_history_url(self, index):
         """リストの項目をダブルクリックしたときにURLを新しいタブで開く"""
-        url = item.data(Qt.ItemDataRole.UserRole)
+        url = index.data(Qt.ItemDataRole.UserRole)
         if url:
             self.parent.add_new_tab(QUrl(url))
             self.accept()
@@ -1505,12 +1893,48 @@ class SettingsDialog(QDialog):
         )
         data_layout.addWidget(self.clear_on_exit_checkbox)
 
+        # 履歴の保存期間などの制限 (0は無制限) 。超えた分はブラウザが使われていないときに少しずつ削除される
+        retention_layout = QFormLayout()
+        self.history_retention_spins = {}
+        for key, label, suffix, maximum, default in (
+            ("history/max_age_days", "履歴の保存期間:", " 日", 3650, DEFAULT_HISTORY_MAX_AGE_DAYS),
+            ("history/max_urls", "履歴の最大件数:", " 件", 10_000_000, DEFAULT_HISTORY_MAX_URLS),
+            ("history/max_size_mb", "履歴データベースの最大サイズ:", " MB", 100_000, DEFAULT_HISTORY_MAX_SIZE_MB),
+        ):
+            spin = QSpinBox()
+            spin.setRange(0, maximum)
+            spin.setSuffix(suffix)
+            spin.setSpecialValueText("無制限")
+            spin.setValue(self.parent.settings.value(key, default, type=int))
+            spin.valueChanged.connect(lambda value, key=key: self.change_history_retention(key, value))
+            retention_layout.addRow(label, spin)
+            self.history_retention_spins[key] = spin
+        data_layout.addLayout(retention_layout)
+        # 値は変わるたびに保存し、履歴サービスへの反映は操作が止まってから行う
+        self.history_retention_timer = QTimer(self)
+        self.history_retention_timer.setSingleShot(True)
+        self.history_retention_timer.setInterval(HISTORY_RETENTION_DEBOUNCE_MS)
+        self.history_retention_timer.timeout.connect(self.parent.apply_history_retention)
+        # 反映する前にダイアログが閉じられた場合は、閉じたときに反映する
+        self.finished.connect(self.flush_history_retention)
+
         clear_data_button = QPushButton("閲覧データを今すぐ削除...")
         clear_data_button.clicked.connect(self.handle_clear_browsing_data)
         data_layout.addWidget(clear_data_button, alignment=Qt.AlignmentFlag.AlignLeft)
         layout.addWidget(data_group)
         return page
 
+    def change_history_retention(self, key, value):
+        """履歴の保存期間などの制限を保存し、操作が止まったら履歴サービスに反映する"""
+        self.parent.settings.setValue(key, value)
+        self.history_retention_timer.start()
+
+    def flush_history_retention(self):
+        """まだ反映していない履歴の保存期間などの制限を、すぐに履歴サービスに反映する"""
+        if self.history_retention_timer.isActive():
+            self.history_retention_timer.stop()
+            self.parent.apply_history_retention()
+
     def create_group_management_page(self):
         """「タブグループ」設定ページを作成する"""
         page = QWidget()
@@ -1642,6 +2066,33 @@ class SettingsDialog(QDialog):
         list_layout.addLayout(button_layout)
         
         layout.addWidget(list_group)
+
+        # 動作状況 (インターセプターの計測値)
+        stats_group = QGroupBox("動作状況")
+        stats_layout = QVBoxLayout(stats_group)
+        stats_layout.setSpacing(10)
+        self.ad_block_stats_label = QLabel()
+        self.ad_block_stats_label.setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse)
+        stats_layout.addWidget(self.ad_block_stats_label)
+        self.rule_hits_widget = QListWidget()
+        self.rule_hits_widget.setToolTip("一致した回数の多いルール (全ウィンドウの合計)")
+        self.rule_hits_widget.setMaximumHeight(150)
+        stats_layout.addWidget(self.rule_hits_widget)
+
+        stats_button_layout = QHBoxLayout()
+        refresh_stats_button = QPushButton("表示を更新")
+        refresh_stats_button.clicked.connect(self.refresh_ad_block_stats)
+        export_stats_button = QPushButton("JSONに書き出す...")
+        export_stats_button.clicked.connect(self.export_ad_block_stats)
+        reset_stats_button = QPushButton("リセット")
+        reset_stats_button.clicked.connect(self.reset_ad_block_stats)
+        stats_button_layout.addStretch()
+        stats_button_layout.addWidget(refresh_stats_button)
+        stats_button_layout.addWidget(export_stats_button)
+        stats_button_layout.addWidget(reset_stats_button)
+        stats_layout.addLayout(stats_button_layout)
+        layout.addWidget(stats_group)
+        self.refresh_ad_block_stats()
         
         self.load_block_list()
         return page
@@ -1768,6 +2219,83 @@ class SettingsDialog(QDialog):
         for window in windows:
             window.set_ad_blocking(enabled)
 
+    def ad_block_profiles(self):
+        """
+        プロファイルごとの (表示名, インターセプター, そのプロファイルのウィンドウのリスト) のリストを返す。
+        計測値はインターセプター、つまりプロファイルごとに記録される。
+        """
+        groups = {}
+        for window in windows:
+            group = groups.get(id(window.ad_blocker))
+            if group is None:
+                groups[id(window.ad_blocker)] = group = (window.ad_blocker, [])
+            group[1].append(window)
+        profiles = []
+        for ad_blocker, profile_windows in groups.values():
+            if profile_windows[0].is_private:
+                # プライベートウィンドウはウィンドウごとに別のプロファイルを使う
+                name = f"プライベートウィンドウ ({profile_windows[0].windowTitle()})"
+            else:
+                name = "通常のウィンドウ"
+            profiles.append((name, ad_blocker, profile_windows))
+        return profiles
+
+    def collect_ad_block_stats(self):
+        """全プロファイルの計測値を合計したものを返す"""
+        total = AdBlockStats()
+        for _, ad_blocker, _ in self.ad_block_profiles():
+            total.merge(ad_blocker.stats)
+        return total
+
+    def refresh_ad_block_stats(self):
+        """広告ブロックの動作状況の表示を更新する"""
+        total = self.collect_ad_block_stats()
+        p50 = total.latency_percentile(50)
+        p99 = total.latency_percentile(99)
+        cache = shared_engine.cache.stats()
+        lines = [
+            f"{name}: {ad_blocker.stats.seen:,}件のリクエストのうち {ad_blocker.stats.blocked:,}件をブロック"
+            for name, ad_blocker, _ in self.ad_block_profiles()
+        ]
+        lines += [
+            f"合計: {total.seen:,}件のリクエストのうち {total.blocked:,}件をブロック",
+            "判定時間: 中央値 {} / 99% {}".format(
+                f"{p50}µs以下" if p50 is not None else "-", f"{p99}µs以下" if p99 is not None else "-"
+            ),
+            f"ルール数: {shared_engine.engine.rule_count:,} / 判定キャッシュのヒット率: {cache['hit_rate']:.1%}",
+        ]
+        self.ad_block_stats_label.setText("\n".join(lines))
+        self.rule_hits_widget.clear()
+        for rule, hits in total.top_rules(20):
+            self.rule_hits_widget.addItem(f"{hits:,}回\t{rule}")
+
+    def export_ad_block_stats(self):
+        """広告ブロックの計測値をJSONファイルに書き出す"""
+        path, _ = QFileDialog.getSaveFileName(self, "動作状況を書き出す", "adblock_stats.json", "JSONファイル (*.json)")
+        if not path:
+            return
+        data = {
+            "exported_at": datetime.now().isoformat(),
+            "rule_count": shared_engine.engine.rule_count,
+            "decision_cache": shared_engine.cache.stats(),
+            "total": self.collect_ad_block_stats().to_dict(),
+            "profiles": [
+                dict(ad_blocker.stats.to_dict(), profile=name, windows=[window.windowTitle() for window in profile_windows])
+                for name, ad_blocker, profile_windows in self.ad_block_profiles()
+            ],
+        }
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+        except OSError as e:
+            QMessageBox.warning(self, "エラー", f"ファイルの書き出しに失敗しました。\n\nエラー: {e}")
+
+    def reset_ad_block_stats(self):
+        """全プロファイルの計測値をリセットする"""
+        for _, ad_blocker, _ in self.ad_block_profiles():
+            ad_blocker.stats.reset()
+        self.refresh_ad_block_stats()
+
     def load_block_list(self):
         """ブロックリストのユーザー定義部分を表示に読み込む"""
         self.block_list_widget.clear()
@@ -1789,34 +2317,15 @@ class SettingsDialog(QDialog):
 
     def save_block_list_and_reload(self):
         """リストウィジェットの内容をユーザー定義ルールとしてファイルに保存し、全ウィンドウのブロッカーを更新する"""
-        try:
-            auto_updated_rules = []
-            user_rules_marker = "[User Defined Rules]"
-            # 既存のファイルから自動更新部分を読み込む
-            if os.path.exists(self.ad_block_list_path):
-                 with open(self.ad_block_list_path, 'r', encoding='utf-8') as f:
-                     for line in f:
-                         if line.strip() == user_rules_marker:
-                             break # ユーザー定義セクションに到達したら読み込みを停止
-                         auto_updated_rules.append(line)
-            
-            with open(self.ad_block_list_path, 'w', encoding='utf-8') as f:
-                # 自動更新部分を書き戻す
-                f.writelines(auto_updated_rules)
-                # 末尾に改行がない場合に備える
-                if auto_updated_rules and not auto_updated_rules[-1].endswith('\n'):
-                    f.write('\n')
-                
-                # ユーザー定義セクションを書き込む
-                f.write(f'\n{user_rules_marker}\n')
-                for i in range(self.block_list_widget.count()):
-                    f.write(self.block_list_widget.item(i).text() + '\n')
-            
-            for window in windows: # 開いているすべてのウィンドウの広告ブロッカーを更新
-                if window.ad_block_enabled:
-                    window.ad_blocker.load_domains()
-        except Exception as e:
-            QMessageBox.critical(self, "エラー", f"ブロックリストの保存に失敗しました:\n{e}")
+        user_rules = [self.block_list_widget.item(i).text() for i in range(self.block_list_widget.count())]
+        # 数MBのファイルの書き換えと共有エンジンの構築を、ワーカースレッドで1回だけ行う (全ウィンドウのブロッカーに反映される)
+        # 書き換えはリストの更新による書き換えと同じロックの中で、一時ファイルを経由して行われる
+        self.parent.start_blocklist_compile(user_rules=user_rules, on_finished=self.on_block_list_saved)
+
+    def on_block_list_saved(self, success, engine, rule_count, error_message):
+        if not success:
+            # ダイアログが閉じられている場合もあるので、ブラウザウィンドウを親にして表示する
+            QMessageBox.critical(self.parent, "エラー", f"ブロックリストの保存に失敗しました:\n{error_message}")
 
     def add_block_domain(self):
         """ブロックリストに新しいドメインを追加する"""
@@ -2107,6 +2616,7 @@ class BrowserWindow(QMainWindow):
         self._spa_progress_timer.setInterval(50)  # 50msごとに更新
         self._spa_progress_timer.timeout.connect(self._update_spa_progress)
         self.update_thread = None
+        self.compile_threads = [] # 実行中のブロックリスト構築スレッド
         self.fullscreen_request = None # 全画面リクエストを保持
 
         self.setWindowTitle("EQUA - ウェブ閲覧と使いやすさのHybrid")
@@ -2121,8 +2631,8 @@ class BrowserWindow(QMainWindow):
         settings_path = os.path.join(PORTABLE_BASE_PATH, SETTINGS_FILE_NAME)
         self.settings = QSettings(settings_path, QSettings.Format.IniFormat)
         
-        # 広告ブロッカーのインスタンスを作成
-        self.ad_blocker = AdBlockInterceptor(self)
+        # 広告ブロッカーを取得 (同じプロファイルのウィンドウで共有する)
+        self.ad_blocker = ad_blocker_for(self.profile)
         # 広告ブロック設定を適用
         self.set_ad_blocking(self.settings.value("ad_block_enabled", True, type=bool))
 
@@ -2133,7 +2643,8 @@ class BrowserWindow(QMainWindow):
 
         # 履歴DBとブックマークのファイルパスを初期化
         self.history_db_path = os.path.join(self.data_path, "history.sqlite")
-        self.bookmarks = []
+        self.history_service = None
+        self.bookmarks = BookmarkStore()
         self.bookmarks_file = os.path.join(self.data_path, "bookmarks.json")
 
         # タブグループの情報 (名前と色) を保持する辞書
@@ -2219,6 +2730,8 @@ class BrowserWindow(QMainWindow):
         self.url_bar.returnPressed.connect(self.navigate_to_url)
         self.url_bar.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Preferred)
         navigation_layout.addWidget(self.url_bar)
+        # 入力中に履歴・ブックマーク・開いているタブから候補を表示する
+        self.omnibox = OmniboxController(self)
 
         # ハンバーガーメニューボタン
         self.menu_button = QPushButton()
@@ -2343,53 +2856,76 @@ class BrowserWindow(QMainWindow):
         self.ad_block_enabled = enabled
         if enabled:
             self.profile.setUrlRequestInterceptor(self.ad_blocker)
-            self.ad_blocker.load_domains() # ドメインリストを再読み込み
+            self.ad_blocker.load_domains() # リストが変更されていれば再読み込み (未変更なら何もしない)
         else:
             self.profile.setUrlRequestInterceptor(None) # インターセプターを解除
         
         if not self.is_private: # プライベートモードでは設定を保存しない
             self.settings.setValue("ad_block_enabled", enabled)
 
+    def update_cosmetic_filters(self, page, url):
+        """
+        ページの要素非表示スクリプトを遷移先のホスト用に差し替える。
+        DocumentCreationで実行されるため、遷移先のページが表示される前にスタイルシートが適用される。
+        """
+        scripts = page.scripts()
+        host = url.host()
+        if not self.ad_block_enabled or not host:
+            for name in (COSMETIC_GENERIC_SCRIPT_NAME, COSMETIC_PAGE_SCRIPT_NAME):
+                for script in scripts.find(name):
+                    scripts.remove(script)
+            page.setProperty("cosmetic_build_id", None)
+            return
+
+        engine = shared_engine.engine
+        # 共通のスタイルシートはエンジンが差し替わったときだけ入れ替える
+        if page.property("cosmetic_build_id") != engine.build_id:
+            for script in scripts.find(COSMETIC_GENERIC_SCRIPT_NAME):
+                scripts.remove(script)
+            scripts.insert(generic_cosmetic_script(engine))
+            page.setProperty("cosmetic_build_id", engine.build_id)
+
+        # ホスト固有の部分 (ホストごとにキャッシュされたスクリプト)
+        for script in scripts.find(COSMETIC_PAGE_SCRIPT_NAME):
+            scripts.remove(script)
+        source = engine.cosmetic.page_script(host)
+        if source:
+            scripts.insert(make_cosmetic_script(COSMETIC_PAGE_SCRIPT_NAME, source, False))
+
     def init_history_db(self):
-        """履歴データベースを初期化し、テーブルが存在しない場合は作成する"""
-        try:
-            conn = sqlite3.connect(self.history_db_path)
-            cursor = conn.cursor()
-            # 履歴テーブルを作成
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    url TEXT NOT NULL UNIQUE,
-                    title TEXT,
-                    last_visit_time TEXT NOT NULL,
-                    visit_count INTEGER NOT NULL DEFAULT 1
-                )
-            """)
-            conn.commit()
-        except sqlite3.Error as e:
-            print(f"履歴データベースの初期化に失敗しました: {e}")
-        finally:
-            if conn:
-                conn.close()
+        """履歴サービスを開始する (同じデータベースを使うウィンドウ間でスレッドと接続を共有する)"""
+        self.history_service = history_service_for(self.history_db_path)
+        self.apply_history_retention()
+
+    def apply_history_retention(self):
+        """設定された履歴の保存期間などの制限を履歴サービスに渡す (整理はアイドル時に行われる)"""
+        if self.history_service is None:
+            return
+        self.history_service.set_retention(RetentionPolicy(
+            max_age_days=self.settings.value("history/max_age_days", DEFAULT_HISTORY_MAX_AGE_DAYS, type=int),
+            max_urls=self.settings.value("history/max_urls", DEFAULT_HISTORY_MAX_URLS, type=int),
+            max_size_mb=self.settings.value("history/max_size_mb", DEFAULT_HISTORY_MAX_SIZE_MB, type=int),
+        ))
 
     def load_bookmarks(self):
         """bookmarks.jsonファイルからブックマークを読み込むメソッド"""
         if os.path.exists(self.bookmarks_file):
             try:
                 with open(self.bookmarks_file, "r", encoding="utf-8") as f:
-                    self.bookmarks = json.load(f)
+                    self.bookmarks = BookmarkStore(json.load(f))
             except json.JSONDecodeError:
-                self.bookmarks = []
+                self.bookmarks = BookmarkStore()
         else:
-            self.bookmarks = []
+            self.bookmarks = BookmarkStore()
 
     def save_bookmarks(self):
         """現在のブックマークをbookmarks.jsonファイルに保存するメソッド"""
         with open(self.bookmarks_file, "w", encoding="utf-8") as f:
-            json.dump(self.bookmarks, f, ensure_ascii=False, indent=4)
+            json.dump(self.bookmarks.to_list(), f, ensure_ascii=False, indent=4)
+        self.omnibox.bookmarks_changed()
 
-    def update_history_entry(self, url, title):
-        """URLとタイトルを履歴データベースに追加または更新する"""
+    def update_history_entry(self, url, title, transition=TRANSITION_LINK):
+        """URLとタイトルを履歴データベースに追加または更新する (transitionは訪問の種類)"""
         # プライベートモードやデータ削除設定が有効な場合は何もしない
         if self.is_private or self.settings.value("privacy/clear_on_exit", False, type=bool):
             return
@@ -2401,28 +2937,14 @@ class BrowserWindow(QMainWindow):
 
         # タイトルが空の場合はURLをタイトルとして使用
         title_str = title if title else url_str
-        
-        try:
-            conn = sqlite3.connect(self.history_db_path)
-            cursor = conn.cursor()
-            
-            # UPSERT (INSERT or UPDATE) クエリ
-            # URLが競合した場合、訪問回数をインクリメントし、タイトルと最終訪問日時を更新
-            query = """
-                INSERT INTO history (url, title, last_visit_time, visit_count)
-                VALUES (?, ?, ?, 1)
-                ON CONFLICT(url) DO UPDATE SET
-                    title = excluded.title,
-                    last_visit_time = excluded.last_visit_time,
-                    visit_count = visit_count + 1;
-            """
-            cursor.execute(query, (url_str, title_str, datetime.now().isoformat()))
-            conn.commit()
-        except sqlite3.Error as e:
-            print(f"履歴の更新に失敗しました: {e}")
-        finally:
-            if conn:
-                conn.close()
+
+        # 書き込みは履歴サービスのスレッドで、他の訪問とまとめて行われる
+        self.history_service.record_visit(url_str, title_str, transition=transition)
+
+    def flush_history(self):
+        """バッファした訪問の書き込みを履歴サービスに依頼する (完了は待たない)"""
+        if self.history_service is not None:
+            self.history_service.flush()
 
     def clear_browsing_data(self):
         """このウィンドウに関連する閲覧データを削除する"""
@@ -2434,17 +2956,9 @@ class BrowserWindow(QMainWindow):
         self.profile.cookieStore().deleteAllCookies()
         self.profile.clearHttpCache()
 
-        # 履歴データベースをクリア
-        try:
-            conn = sqlite3.connect(self.history_db_path)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM history")
-            conn.commit()
-        except sqlite3.Error as e:
-            print(f"履歴データベースのクリアに失敗しました: {e}")
-        finally:
-            if conn:
-                conn.close()
+        # 履歴データベースをクリア (書き込み待ちの訪問も破棄する)
+        self.history_service.clear()
+        self.omnibox.history_changed()
 
         # ダウンロードマネージャーのリストをクリア
         while self.download_manager.downloads_layout.count() > 0:
@@ -2484,6 +2998,8 @@ class BrowserWindow(QMainWindow):
         page.loadStarted.connect(lambda browser=browser: self.handle_load_started(browser))
         page.loadProgress.connect(lambda progress, browser=browser: self.handle_load_progress(progress, browser))
         page.loadFinished.connect(lambda ok, browser=browser: self.handle_load_finished(ok, browser))
+        # 要素非表示ルールのスタイルシートを、遷移のたびに遷移先のホスト用に差し替えて挿入する
+        page.mainFrameNavigationRequested.connect(lambda url, page=page: self.update_cosmetic_filters(page, url))
 
         i = self.tabs.addTab(browser, label) # タブウィジェットに追加
         if set_as_current:
@@ -2616,8 +3132,24 @@ class BrowserWindow(QMainWindow):
             self.forward_button.setEnabled(False)
             self.update_progress_bar(100) # プログレスバーをリセット
 
+    def open_tabs(self):
+        """アドレスバーの入力候補にする、現在のタブ以外の開いているタブの (URL, タイトル) のリスト"""
+        current_browser = self.tabs.currentWidget()
+        return [(browser.url().toString(), browser.title())
+                for browser in (self.tabs.widget(i) for i in range(self.tabs.count()))
+                if browser is not current_browser]
+
+    def switch_to_tab(self, url):
+        """URLが url のタブに切り替える。見つからなければFalseを返す"""
+        for i in range(self.tabs.count()):
+            if self.tabs.widget(i).url().toString() == url:
+                self.tabs.setCurrentIndex(i)
+                return True
+        return False
+
     def navigate_to_url(self):
         """アドレスバーのURLに移動するメソッド"""
+        self.omnibox.hide_popup()
         current_browser = self.tabs.currentWidget()
         if not current_browser:
             return
@@ -2949,12 +3481,8 @@ class BrowserWindow(QMainWindow):
                     QMessageBox.warning(self, "警告", "ファイルからブックマークが見つかりませんでした。")
                     return
 
-                existing_urls = {b['url'] for b in self.bookmarks}
-                new_bookmarks_count = 0
-                for bookmark in imported_bookmarks:
-                    if bookmark['url'] not in existing_urls: # 重複を避ける
-                        self.bookmarks.insert(0, bookmark)
-                        new_bookmarks_count += 1
+                # 先頭に追加する (同じURLのブックマークは追加しない)
+                new_bookmarks_count = self.bookmarks.prepend_all(imported_bookmarks)
                 
                 self.save_bookmarks()
                 QMessageBox.information(self, "完了", f"{new_bookmarks_count}件の新しいブックマークをインポートしました。")
@@ -3015,6 +3543,9 @@ class BrowserWindow(QMainWindow):
 
     def closeEvent(self, a0: QCloseEvent):
         """ウィンドウを閉じる際に履歴とブックマークを保存するイベントハンドラ"""
+        # 構築中のブロックリストがあれば、スレッドが破棄される前に完了を待つ
+        for thread in list(self.compile_threads):
+            thread.wait()
         # グローバルリストからこのウィンドウの参照を削除
         if self in windows:
             windows.remove(self)
@@ -3046,6 +3577,8 @@ class BrowserWindow(QMainWindow):
                     urls = [self.tabs.widget(i).url().toString() for i in range(self.tabs.count())]
                     self.settings.setValue("session/urls", urls)
                     self.settings.setValue("session/current_index", self.tabs.currentIndex())
+                # 書き込み待ちの訪問を保存
+                self.flush_history()
 
             self.save_bookmarks()
         super().closeEvent(a0)
@@ -3155,63 +3688,80 @@ class BrowserWindow(QMainWindow):
 
         url = self.settings.value("ad_block_update_url", DEFAULT_ADBLOCK_LIST_URL) # 設定から更新URLを取得
 
-        self.update_thread = UpdateBlocklistThread(url)
+        self.update_thread = UpdateBlocklistThread(url, source_store_for(self.ad_blocker.block_list_path))
         self.update_thread.finished.connect(
-            lambda success, content, error_msg: self.finish_blocklist_update(success, content, error_msg, silent)
+            lambda success, modified, error_msg: self.finish_blocklist_update(url, success, modified, error_msg, silent)
         )
         self.update_thread.start()
 
-    def finish_blocklist_update(self, success, content, error_message, silent=False):
-        """ブロックリストの更新処理が完了した後に呼び出される"""
+    def finish_blocklist_update(self, url, success, modified, error_message, silent=False):
+        """ブロックリストのダウンロードが完了した後に呼び出される"""
+        if not success:
+            message = "" if silent else f"広告ブロックリストの更新に失敗しました。\n\nエラー: {error_message}"
+            self.blocklist_update_finished.emit(False, message)
+            return
+
+        list_path = self.ad_blocker.block_list_path
+        store = source_store_for(list_path)
+        if not store.needs_rebuild([url], list_path, modified):
+            # 304 Not Modified: ファイルの書き換えとエンジンの再構築は不要
+            self.settings.setValue("ad_block_last_updated", datetime.now().isoformat())
+            message = "" if silent else "リストは最新です。"
+            self.blocklist_update_finished.emit(True, message)
+            return
+
+        # ファイルの書き換え・ユーザー定義ルールの結合・エンジンの構築はワーカースレッドで行う
+        self.start_blocklist_compile(
+            [(None, store.path_for(url))],
+            lambda ok, engine, rule_count, error: self.on_blocklist_update_compiled([url], ok, engine, rule_count, error, silent)
+        )
+
+    def on_blocklist_update_compiled(self, urls, success, engine, rule_count, error_message, silent=False):
+        """更新したブロックリストのエンジン構築が完了した後に呼び出される"""
         message = ""
         if success:
-            try:
-                user_defined_rules = []
-                user_rules_marker = "[User Defined Rules]"
-                # 既存のファイルからユーザー定義ルールを読み込む
-                if os.path.exists(self.ad_blocker.block_list_path):
-                    with open(self.ad_blocker.block_list_path, 'r', encoding='utf-8') as f:
-                        in_user_section = False
-                        for line in f:
-                            if line.strip() == user_rules_marker:
-                                in_user_section = True
-                                continue # マーカー自体は含めない
-                            if in_user_section:
-                                user_defined_rules.append(line.strip())
-
-                # 新しいリストとユーザー定義ルールを結合して書き込む
-                with open(self.ad_blocker.block_list_path, 'w', encoding='utf-8') as f:
-                    f.write(content) # ダウンロードしたコンテンツを書き込む
-                    # 末尾に改行がない場合に備える
-                    if content and not content.endswith('\n'):
-                        f.write('\n')
-                    # ユーザー定義ルールセクションを追加
-                    f.write(f'\n{user_rules_marker}\n')
-                    for rule in user_defined_rules:
-                        if rule: # 空行は無視
-                            f.write(rule + '\n')
-                for window in windows:
-                    if window.ad_block_enabled:
-                        window.ad_blocker.load_domains() # 全ウィンドウのブロッカーをリロード
-                self.settings.setValue("ad_block_last_updated", datetime.now().isoformat())
-                
-                if not silent: # 手動更新の場合のみメッセージを作成
-                    new_domains_count = 0
-                    for line in content.splitlines():
-                        if line.strip() and not line.startswith(('!', '[', '#', '@')) and line.startswith('||'):
-                            new_domains_count += 1
-                    message = f"{new_domains_count}個のドメインでリストを更新しました。"
-            except Exception as e:
-                success = False
-                if not silent:
-                    message = f"リストの保存中にエラーが発生しました。\n\nエラー: {e}"
-        else:
-            if not silent:
-                message = f"広告ブロックリストの更新に失敗しました。\n\nエラー: {error_message}"
-        
+            # 次回の更新で変更がなければ再構築を省けるよう、結合したリストの構成を記録する
+            source_store_for(self.ad_blocker.block_list_path).set_merged_urls(urls)
+            self.settings.setValue("ad_block_last_updated", datetime.now().isoformat())
+            if not silent: # 手動更新の場合のみメッセージを作成
+                message = f"{rule_count}個のルールでリストを更新しました。"
+                removed = sum(engine.merge_stats.values()) if engine.merge_stats else 0
+                if removed:
+                    message += f"\n(重複・上位ドメインに含まれる{removed}個のルールを省きました)"
+        elif not silent:
+            message = f"リストの保存中にエラーが発生しました。\n\nエラー: {error_message}"
+
         # 設定ダイアログに結果を通知 (silentがTrueの場合は空メッセージ)
         self.blocklist_update_finished.emit(success, message)
 
+    def start_blocklist_compile(self, sources=None, on_finished=None, user_rules=None):
+        """
+        ブロックリストファイルの書き出しとエンジンの構築をワーカースレッドで開始する。
+        user_rules を指定した場合は、ファイルのユーザー定義ルールをそれに置き換えてから構築する。
+        構築が終わるまでは現在のエンジンでブロックを続け、完了したら共有エンジンを差し替える。
+        on_finished には (成功/失敗, 構築したエンジン, ルール数, エラーメッセージ) が渡される。
+        """
+        thread = BlocklistCompileThread(self.ad_blocker.block_list_path, sources, user_rules)
+        thread.finished.connect(
+            lambda success, engine, rule_count, error_message, thread=thread:
+                self.on_blocklist_compiled(thread, success, engine, rule_count, error_message, on_finished)
+        )
+        self.compile_threads.append(thread) # 実行中のスレッドがGCされないように参照を保持
+        thread.start()
+
+    def on_blocklist_compiled(self, thread, success, engine, rule_count, error_message, on_finished=None):
+        """エンジンの構築が完了したときに呼び出される"""
+        thread.wait() # シグナル送信後、スレッドが完全に終了するのを待ってから参照を手放す
+        if thread in self.compile_threads:
+            self.compile_threads.remove(thread)
+        if success:
+            # 後から要求された構築が先に完了していた場合、古いエンジンでは上書きしない
+            shared_engine.publish(engine)
+        elif on_finished is None:
+            print(f"広告ブロックリストの構築に失敗しました: {error_message}")
+        if on_finished:
+            on_finished(success, engine, rule_count, error_message)
+
     def check_for_updates(self):
         """アプリケーションのアップデートを非同期でチェックする"""
         self.update_check_thread = UpdateCheckThread(GITHUB_REPO_OWNER, GITHUB_REPO_NAME)
@@ -3333,7 +3883,8 @@ class BrowserWindow(QMainWindow):
         
         # 読み込みが成功した場合、履歴を更新
         if ok:
-            self.update_history_entry(browser.url(), browser.title())
+            transition = getattr(browser.page(), "main_frame_transition", TRANSITION_LINK)
+            self.update_history_entry(browser.url(), browser.title(), transition)
 
     def update_progress_bar(self, progress):
         """アドレスバーの背景を更新してプログレスバーとして表示する"""
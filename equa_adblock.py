@@ -0,0 +1,1846 @@
+# -*- coding: utf-8 -*-
+"""
+EQUA 広告ブロックエンジン
+
+Qtに依存しない純粋なPythonの部分をまとめたモジュール。
+equa.py / equa-copy.py のどちらからも利用され、ベンチマークなどから
+ディスプレイなしで単体でインポートすることもできる。
+"""
+import bisect
+import codecs
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import re
+import struct
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class DomainMatcher:
+    """
+    ドメインルールの集合に対して、ホスト名を後方一致で判定するマッチャー。
+
+    ホスト名をラベル単位で右から辿り、各親ドメインをハッシュセットで引くため、
+    判定コストはルール数ではなくホスト名のラベル数に比例する。
+    例: "a.b.example.com" は "a.b.example.com", "b.example.com", "example.com", "com" の順に調べる。
+
+    同じドメインを複数のルールから追加した場合に備えて参照数を持ち、
+    remove() ですべての参照がなくなったときにだけ判定対象から外す。
+    """
+
+    def __init__(self, domains=()):
+        self._domains = {} # ドメイン → 追加された回数
+        for domain in domains:
+            self.add(domain)
+
+    def __len__(self):
+        return len(self._domains)
+
+    def __contains__(self, domain):
+        return domain in self._domains
+
+    def __iter__(self):
+        return iter(self._domains)
+
+    def add(self, domain):
+        """ドメインを追加する"""
+        domain = domain.strip().strip('.').lower()
+        if domain:
+            self._domains[domain] = self._domains.get(domain, 0) + 1
+
+    def remove(self, domain):
+        """
+        add() 1回分の参照を取り除き、参照がなくなればドメインを削除する。
+        ドメインが存在しなければFalseを返す。
+        """
+        domain = domain.strip().strip('.').lower()
+        count = self._domains.get(domain)
+        if count is None:
+            return False
+        if count > 1:
+            self._domains[domain] = count - 1
+        else:
+            del self._domains[domain]
+        return True
+
+    def discard(self, domain):
+        """参照数にかかわらずドメインを削除する (存在しなくてもエラーにしない)"""
+        self._domains.pop(domain.strip().strip('.').lower(), None)
+
+    def clear(self):
+        self._domains.clear()
+
+    def copy(self):
+        matcher = DomainMatcher()
+        matcher._domains = self._domains.copy()
+        return matcher
+
+    def match(self, host):
+        """
+        hostがルールのドメインそのもの、またはそのサブドメインであれば、
+        一致したドメインを返す。一致しなければNoneを返す。
+        hostは小文字化済みであることを前提とする。
+        """
+        if not host:
+            return None
+        domains = self._domains
+        if host in domains:
+            return host
+        # 左端のラベルから順に取り除きながら親ドメインを調べる
+        pos = host.find('.')
+        while pos != -1:
+            suffix = host[pos + 1:]
+            if suffix in domains:
+                return suffix
+            pos = host.find('.', pos + 1)
+        return None
+
+
+# --- ABP (Adblock Plus / EasyList) 形式のネットワークフィルター ---
+
+# リソースタイプのビットマスク。ABPのオプション名をキーにする。
+RESOURCE_TYPES = (
+    "other", "script", "image", "stylesheet", "object", "xmlhttprequest", "subdocument",
+    "document", "font", "media", "websocket", "ping", "popup",
+)
+TYPE_BITS = {name: 1 << i for i, name in enumerate(RESOURCE_TYPES)}
+ALL_TYPES_MASK = (1 << len(RESOURCE_TYPES)) - 1
+# タイプ指定のないフィルターはページ本体(document)とポップアップには適用しない (ABPと同じ挙動)
+DEFAULT_TYPES_MASK = ALL_TYPES_MASK & ~(TYPE_BITS["document"] | TYPE_BITS["popup"])
+
+# オプション名の別名
+TYPE_ALIASES = {
+    "xhr": "xmlhttprequest",
+    "css": "stylesheet",
+    "frame": "subdocument",
+    "doc": "document",
+    "object-subrequest": "object",
+    "background": "image",
+}
+
+# ネットワーク層では意味を持たず、フィルター自体を無視すべきオプション
+# (コンテンツの書き換えや要素非表示の例外など)
+UNSUPPORTED_OPTIONS = frozenset((
+    "csp", "redirect", "redirect-rule", "removeparam", "rewrite", "replace", "header",
+    "elemhide", "ehide", "generichide", "ghide", "specifichide", "shide", "genericblock",
+    "badfilter", "denyallow", "permissions", "urltransform", "strict1p", "strict3p",
+    "to", "from", "method", "inline-script", "inline-font", "webrtc", "empty", "mp4",
+))
+
+# QWebEngineUrlRequestInfo.ResourceType のメンバー名とABPのタイプ名の対応
+QT_RESOURCE_TYPES = {
+    "ResourceTypeMainFrame": "document",
+    "ResourceTypeSubFrame": "subdocument",
+    "ResourceTypeStylesheet": "stylesheet",
+    "ResourceTypeScript": "script",
+    "ResourceTypeImage": "image",
+    "ResourceTypeFontResource": "font",
+    "ResourceTypeSubResource": "other",
+    "ResourceTypeObject": "object",
+    "ResourceTypeMedia": "media",
+    "ResourceTypeWorker": "script",
+    "ResourceTypeSharedWorker": "script",
+    "ResourceTypeServiceWorker": "script",
+    "ResourceTypePrefetch": "other",
+    "ResourceTypeFavicon": "image",
+    "ResourceTypeXhr": "xmlhttprequest",
+    "ResourceTypePing": "ping",
+    "ResourceTypeCspReport": "other",
+    "ResourceTypePluginResource": "object",
+    "ResourceTypeNavigationPreloadMainFrame": "document",
+    "ResourceTypeNavigationPreloadSubFrame": "subdocument",
+    "ResourceTypeWebSocket": "websocket",
+    "ResourceTypeJson": "xmlhttprequest",
+}
+
+# 一致判定に使うトークン (英数字と%の連続)
+_TOKEN_RE = re.compile(r"[a-z0-9%]+")
+# トークンの選択で避ける、URLにありふれたトークン
+_COMMON_TOKENS = frozenset((
+    "http", "https", "www", "com", "net", "org", "js", "html", "php", "jpg", "png", "gif", "css",
+))
+# ABPの区切り文字 '^' に相当する正規表現
+_SEPARATOR_RE = r"(?:[^\w.%-]|$)"
+
+# 登録可能ドメイン (eTLD+1) の判定に使う、よく使われる2階層のパブリックサフィックス
+_SECOND_LEVEL_SUFFIXES = frozenset((
+    "co.jp", "ne.jp", "or.jp", "ac.jp", "go.jp", "ad.jp", "ed.jp", "gr.jp", "lg.jp",
+    "co.uk", "org.uk", "ac.uk", "gov.uk", "me.uk", "ltd.uk", "plc.uk",
+    "com.au", "net.au", "org.au", "edu.au", "gov.au",
+    "com.br", "com.cn", "net.cn", "org.cn", "com.tw", "com.hk", "co.kr", "or.kr",
+    "co.nz", "co.in", "co.za", "com.mx", "com.ar", "com.tr", "com.sg",
+))
+
+
+def base_domain(host):
+    """ホスト名から登録可能ドメイン (例: www.example.co.jp → example.co.jp) を簡易的に求める"""
+    parts = host.rsplit('.', 3)
+    if len(parts) >= 3 and f"{parts[-2]}.{parts[-1]}" in _SECOND_LEVEL_SUFFIXES:
+        return '.'.join(parts[-3:])
+    return '.'.join(parts[-2:])
+
+
+class Request:
+    """
+    フィルターとの照合に必要なリクエスト情報をまとめたもの。
+    URLの小文字化やトークン分割は一度だけ行い、各フィルターで使い回す。
+    """
+    __slots__ = ("url", "url_lower", "hostname", "source_hostname", "type_bit", "third_party", "_tokens")
+
+    def __init__(self, url, hostname, source_hostname="", resource_type="other"):
+        self.url = url
+        self.url_lower = url.lower()
+        self.hostname = hostname.lower()
+        self.source_hostname = source_hostname.lower()
+        self.type_bit = TYPE_BITS.get(resource_type, TYPE_BITS["other"])
+        # 呼び出し元のページがない場合 (アドレスバーからの遷移など) はファーストパーティとみなす
+        self.third_party = bool(self.source_hostname) and base_domain(self.hostname) != base_domain(self.source_hostname)
+        self._tokens = None
+
+    @property
+    def tokens(self):
+        """URLに含まれるトークンの集合 (初回アクセス時に計算)"""
+        if self._tokens is None:
+            self._tokens = set(_TOKEN_RE.findall(self.url_lower))
+        return self._tokens
+
+
+class NetworkFilter:
+    """ABP形式のネットワークフィルター1件を表す"""
+    __slots__ = (
+        "rule", "is_exception", "is_important", "pattern", "is_regex", "anchor_host", "anchor_left",
+        "anchor_right", "match_case", "type_mask", "third_party", "include_domains", "exclude_domains",
+        "_regex",
+    )
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.is_exception = False
+        self.is_important = False
+        self.pattern = ""
+        self.is_regex = False
+        self.anchor_host = False
+        self.anchor_left = False
+        self.anchor_right = False
+        self.match_case = False
+        self.type_mask = DEFAULT_TYPES_MASK
+        self.third_party = None # None: 指定なし, True: サードパーティのみ, False: ファーストパーティのみ
+        self.include_domains = None # domain= オプションで指定された適用先 (DomainMatcher)
+        self.exclude_domains = None # domain= オプションで除外された適用先 (DomainMatcher)
+        self._regex = None
+
+    @classmethod
+    def parse(cls, line):
+        """
+        1行をパースしてNetworkFilterを返す。
+        コメントや要素非表示ルール、未対応のオプションを含む行の場合はNoneを返す。
+        """
+        line = line.strip()
+        if not line or line.startswith(('!', '[')):
+            return None
+        # 要素非表示ルール (##, #@#, #?# など) はネットワークフィルターではない
+        if '##' in line or '#@#' in line or '#?#' in line or '#$#' in line:
+            return None
+        if line.startswith('#'):
+            return None
+
+        f = cls(line)
+        text = line
+        if text.startswith('@@'):
+            f.is_exception = True
+            text = text[2:]
+
+        # 正規表現ルール (/.../) 以外ではオプション部分 ($...) を分離する
+        options = None
+        if not (text.startswith('/') and text.endswith('/') and len(text) > 2):
+            dollar = text.rfind('$')
+            if dollar != -1:
+                options = text[dollar + 1:]
+                text = text[:dollar]
+        if options is not None and not f._parse_options(options):
+            return None
+
+        if text.startswith('/') and text.endswith('/') and len(text) > 2:
+            f.is_regex = True
+            f.pattern = text[1:-1]
+            return f
+
+        if text.startswith('||'):
+            f.anchor_host = True
+            text = text[2:]
+        elif text.startswith('|'):
+            f.anchor_left = True
+            text = text[1:]
+        if text.endswith('|'):
+            f.anchor_right = True
+            text = text[:-1]
+        # 先頭・末尾のワイルドカードは意味を持たない
+        text = text.strip('*') if not f.anchor_host else text.rstrip('*')
+        f.pattern = text if f.match_case else text.lower()
+        return f
+
+    def _parse_options(self, options):
+        """$以降のオプションを解釈する。未対応のオプションがあればFalseを返す"""
+        include_types = 0
+        exclude_types = 0
+        for option in options.split(','):
+            option = option.strip().lower()
+            if not option:
+                continue
+            negated = option.startswith('~')
+            name = option[1:] if negated else option
+            value = None
+            if '=' in name:
+                name, value = name.split('=', 1)
+
+            if name in ("third-party", "3p"):
+                self.third_party = not negated
+            elif name in ("first-party", "1p"):
+                self.third_party = negated
+            elif name == "domain":
+                for domain in (value or "").split('|'):
+                    if domain.startswith('~'):
+                        if self.exclude_domains is None:
+                            self.exclude_domains = DomainMatcher()
+                        self.exclude_domains.add(domain[1:])
+                    elif domain:
+                        if self.include_domains is None:
+                            self.include_domains = DomainMatcher()
+                        self.include_domains.add(domain)
+            elif name == "match-case":
+                self.match_case = True
+            elif name == "important":
+                self.is_important = True
+            elif name == "all":
+                include_types |= ALL_TYPES_MASK
+            elif name in TYPE_BITS or name in TYPE_ALIASES:
+                bit = TYPE_BITS[TYPE_ALIASES.get(name, name)]
+                if negated:
+                    exclude_types |= bit
+                else:
+                    include_types |= bit
+            elif name in UNSUPPORTED_OPTIONS:
+                return False
+            else:
+                # 未知のオプションは誤ブロックを避けるためフィルターごと無視する
+                return False
+
+        if include_types:
+            self.type_mask = include_types & ~exclude_types
+        elif exclude_types:
+            self.type_mask = DEFAULT_TYPES_MASK & ~exclude_types
+        # ポップアップはインターセプターから判別できないため、ポップアップ専用のフィルターは無視する
+        return bool(self.type_mask & ~TYPE_BITS["popup"])
+
+    def __getstate__(self):
+        # コンパイル済みの正規表現はキャッシュファイルに含めず、読み込み後に遅延して再コンパイルする
+        return tuple(getattr(self, name) for name in self.__slots__[:-1])
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__[:-1], state):
+            setattr(self, name, value)
+        self._regex = None
+
+    def anchored_domain(self):
+        """パターンが '||example.com^' の形であればドメイン部分を、そうでなければNoneを返す"""
+        if self.anchor_host and not self.is_regex and not self.anchor_right and self.pattern.endswith('^'):
+            domain = self.pattern[:-1]
+            if _is_hostname(domain):
+                return domain.lower()
+        return None
+
+    @property
+    def has_options(self):
+        """タイプやドメインなど、照合結果を左右するオプションが指定されているかどうか"""
+        return (
+            self.type_mask != DEFAULT_TYPES_MASK or self.third_party is not None
+            or self.include_domains is not None or self.exclude_domains is not None
+        )
+
+    def tokens(self):
+        """
+        インデックスのキーとして使える候補トークンを返す。
+        トークンの前後がURL上でも必ず区切られていることが保証されるものだけを選ぶ。
+        """
+        if self.is_regex:
+            return []
+        pattern = self.pattern.lower()
+        result = []
+        for m in _TOKEN_RE.finditer(pattern):
+            start, end = m.span()
+            if start == 0:
+                if not (self.anchor_host or self.anchor_left):
+                    continue
+            elif pattern[start - 1] == '*':
+                continue
+            if end == len(pattern):
+                if not self.anchor_right:
+                    continue
+            elif pattern[end] == '*':
+                continue
+            result.append(m.group())
+        return result
+
+    def _get_regex(self):
+        """パターンを正規表現にコンパイルする (初回の照合時に遅延して行う)"""
+        if self._regex is None:
+            flags = 0 if self.match_case else re.IGNORECASE
+            if self.is_regex:
+                source = self.pattern
+            else:
+                parts = []
+                for ch in self.pattern:
+                    if ch == '*':
+                        parts.append(".*")
+                    elif ch == '^':
+                        parts.append(_SEPARATOR_RE)
+                    else:
+                        parts.append(re.escape(ch))
+                source = "".join(parts)
+                if self.anchor_host:
+                    # スキームの後、ホスト名の先頭またはドット区切りの位置から一致させる
+                    source = r"^[a-z][a-z0-9+.-]*:(?://)?(?:[^/?#]*\.)?" + source
+                elif self.anchor_left:
+                    source = "^" + source
+                if self.anchor_right:
+                    source += "$"
+            try:
+                self._regex = re.compile(source, flags)
+            except re.error:
+                self._regex = re.compile(r"(?!)") # 不正な正規表現は何にも一致させない
+        return self._regex
+
+    def matches(self, request):
+        """リクエストがこのフィルターに一致するかを判定する"""
+        if not self.type_mask & request.type_bit:
+            return False
+        if self.third_party is not None and self.third_party != request.third_party:
+            return False
+        if self.include_domains is not None or self.exclude_domains is not None:
+            source = request.source_hostname
+            if self.exclude_domains is not None and self.exclude_domains.match(source):
+                return False
+            if self.include_domains is not None and not self.include_domains.match(source):
+                return False
+
+        url = request.url if self.match_case else request.url_lower
+        pattern = self.pattern
+        # ワイルドカード・区切り文字・アンカーのない単純なパターンは部分文字列検索で済ませる
+        if not (self.is_regex or self.anchor_host or self.anchor_left or self.anchor_right
+                or '*' in pattern or '^' in pattern):
+            return pattern in url
+        return self._get_regex().search(url) is not None
+
+
+_HOSTNAME_RE = re.compile(r"^(?:[a-z0-9_](?:[a-z0-9_-]*[a-z0-9_])?\.)+[a-z0-9-]*[a-z0-9]$", re.IGNORECASE)
+
+
+def _is_hostname(text):
+    """文字列がホスト名として妥当かを簡易的に判定する"""
+    return _HOSTNAME_RE.match(text) is not None
+
+
+# --- 要素非表示ルール (##) ---
+
+# 要素非表示ルールの区切り。拡張構文 (#?#, #$#, #@$# など) やスクリプトレットには対応しない
+_COSMETIC_RE = re.compile(r"^([^#]*)#(@?)#(.+)$")
+# 要素非表示を無効にする例外ルール ('@@||example.com^$elemhide' / '$generichide')
+_ELEMHIDE_EXCEPTION_RE = re.compile(r"^@@\|\|([^/^$*|]+)\^?\$(elemhide|ehide|generichide|ghide)$", re.IGNORECASE)
+# ページごとのスタイルシートのキャッシュの上限
+COSMETIC_CACHE_SIZE = 256
+
+
+def parse_cosmetic_rule(line):
+    """
+    要素非表示ルールをパースして (例外かどうか, 適用先ドメイン, 除外ドメイン, セレクター) を返す。
+    要素非表示ルールでない場合や、対応しない構文の場合はNoneを返す。
+    """
+    m = _COSMETIC_RE.match(line)
+    if m is None:
+        return None
+    domains_text, at, selector = m.groups()
+    selector = selector.strip()
+    # uBlock Origin のスクリプトレット (##+js(...)) やHTMLフィルター (##^) は対象外
+    if not selector or selector.startswith(('+js(', '^')) or ':style(' in selector or '{' in selector:
+        return None
+    include, exclude = [], []
+    for domain in domains_text.split(','):
+        domain = domain.strip().lower()
+        if not domain:
+            continue
+        if domain.startswith('~'):
+            exclude.append(domain[1:])
+        else:
+            include.append(domain)
+    return bool(at), include, exclude, selector
+
+
+def _css_for(selectors):
+    """セレクターごとに1つずつ非表示ルールを作る (1つの不正なセレクターで他のルールまで無効にならないように)"""
+    return "\n".join(f"{selector} {{ display: none !important; }}" for selector in selectors)
+
+
+def _add_ref(table, key, selector):
+    entries = table.setdefault(key, {})
+    entries[selector] = entries.get(selector, 0) + 1
+
+
+def _remove_ref(table, key, selector):
+    entries = table.get(key)
+    if not entries or selector not in entries:
+        return False
+    if entries[selector] > 1:
+        entries[selector] -= 1
+    else:
+        del entries[selector]
+        if not entries:
+            del table[key]
+    return True
+
+
+def _excluded(host, domains):
+    """hostが domains のいずれかのドメイン (またはそのサブドメイン) か"""
+    return any(host == domain or host.endswith("." + domain) for domain in domains)
+
+
+class CosmeticFilters:
+    """
+    要素非表示ルール (##) をドメインごとに索引付けし、ページに挿入するスタイルシートを作る。
+
+    全サイト共通のスタイルシートを挿入するスクリプトは構築後に一度だけ作り、
+    ドメイン固有のセレクターや例外があるホスト用のスクリプトはホスト名をキーにキャッシュするため、
+    ページを読み込むたびにセレクターの文字列を組み立て直すことはない。
+    '~example.com' のような除外ドメインはルールごとに (セレクター, 除外ドメイン) の組で持ち、
+    そのルール自身を除外ドメインで適用しないだけにする (同じセレクターの他のルールは打ち消さない) 。
+    """
+
+    def __init__(self):
+        self.generic = {} # 全サイト共通のセレクター → 参照数 (挿入順を保つ)
+        self.specific = {} # ドメイン → {セレクター: 参照数}
+        self.exceptions = {} # ドメイン → {非表示にしないセレクター: 参照数} ('' は全サイトに適用)
+        # 除外ドメインのあるドメイン固有のルール: ドメイン → {(セレクター, 除外ドメイン): 参照数}
+        self.specific_excluding = {}
+        # 除外ドメインのある共通のルール: 除外ドメイン → {(セレクター, 除外ドメイン): 参照数}
+        # (セレクターは generic にも数えておき、除外ドメインではそのルールの分だけ差し引く)
+        self.generic_excluding = {}
+        self.elemhide_domains = DomainMatcher() # 要素非表示をすべて無効にするドメイン ($elemhide)
+        self.generichide_domains = DomainMatcher() # 共通のセレクターを無効にするドメイン ($generichide)
+        self._generic_script = None
+        self._host_cache = OrderedDict() # ホスト名 → page_script() の結果
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_generic_script"] = None
+        state["_host_cache"] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return (len(self.generic) + sum(len(entries) for entries in self.specific.values())
+                + sum(len(entries) for entries in self.specific_excluding.values()))
+
+    def copy(self):
+        cosmetic = CosmeticFilters()
+        cosmetic.generic = self.generic.copy()
+        cosmetic.specific = {domain: entries.copy() for domain, entries in self.specific.items()}
+        cosmetic.exceptions = {domain: entries.copy() for domain, entries in self.exceptions.items()}
+        cosmetic.specific_excluding = {domain: entries.copy() for domain, entries in self.specific_excluding.items()}
+        cosmetic.generic_excluding = {domain: entries.copy() for domain, entries in self.generic_excluding.items()}
+        cosmetic.elemhide_domains = self.elemhide_domains.copy()
+        cosmetic.generichide_domains = self.generichide_domains.copy()
+        return cosmetic
+
+    def _invalidate(self):
+        self._generic_script = None
+        self._host_cache.clear()
+
+    def add_rule(self, line):
+        """要素非表示に関するルールであれば追加してTrueを返す"""
+        return self._apply(line, add=True)
+
+    def remove_rule(self, line):
+        """add_rule() で追加したルール1件分を取り除く。取り除けた場合はTrueを返す"""
+        return self._apply(line, add=False)
+
+    def _apply(self, line, add):
+        m = _ELEMHIDE_EXCEPTION_RE.match(line)
+        if m is not None:
+            domain, option = m.group(1), m.group(2).lower()
+            matcher = self.elemhide_domains if option in ("elemhide", "ehide") else self.generichide_domains
+            if add:
+                matcher.add(domain)
+                changed = True
+            else:
+                changed = matcher.remove(domain)
+            if changed:
+                self._invalidate()
+            return changed
+
+        parsed = parse_cosmetic_rule(line)
+        if parsed is None:
+            return False
+        is_exception, include, exclude, selector = parsed
+        ref = _add_ref if add else _remove_ref
+        changed = False
+        if is_exception:
+            # '#@#.ad' は全サイト、'example.com#@#.ad' はそのドメインで非表示にしない
+            for domain in include or [""]:
+                changed = (ref(self.exceptions, domain, selector) is not False) or changed
+        elif include:
+            if exclude:
+                # 'example.com,~sub.example.com##.ad' は除外ドメインと組にして、このルールだけを除外する
+                key = (selector, tuple(sorted(set(exclude))))
+                for domain in include:
+                    changed = (ref(self.specific_excluding, domain, key) is not False) or changed
+            else:
+                for domain in include:
+                    changed = (ref(self.specific, domain, selector) is not False) or changed
+        else:
+            # '~example.com##.ad' は除外ドメイン以外の全サイトに適用する
+            if add:
+                self.generic[selector] = self.generic.get(selector, 0) + 1
+                changed = True
+            elif selector in self.generic:
+                if self.generic[selector] > 1:
+                    self.generic[selector] -= 1
+                else:
+                    del self.generic[selector]
+                changed = True
+            if exclude and changed:
+                key = (selector, tuple(sorted(set(exclude))))
+                for domain in key[1]:
+                    ref(self.generic_excluding, domain, key)
+        if changed:
+            self._invalidate()
+        return changed
+
+    def _collect(self, table, host):
+        """hostとその親ドメインに登録されたセレクターを集める"""
+        selectors = {}
+        pos = -1
+        while True:
+            entries = table.get(host[pos + 1:])
+            if entries:
+                selectors.update(entries)
+            pos = host.find('.', pos + 1)
+            if pos == -1:
+                return selectors
+
+    def generic_stylesheet(self):
+        """全サイト共通のセレクターのスタイルシート"""
+        hidden = self.exceptions.get("", {})
+        return _css_for(s for s in self.generic if s not in hidden)
+
+    def stylesheet_for(self, host):
+        """
+        ホストのページに挿入するスタイルシートを (スタイルシート, 共通のスタイルシートを置き換えるか) で返す。
+
+        通常は、共通のスタイルシートに加えて挿入するドメイン固有の部分だけを返す。
+        共通のセレクターに対する例外や $generichide があるホストの場合は、
+        共通のスタイルシートの代わりに使う完全なスタイルシートを返す (置き換える=True) 。
+        """
+        if self.elemhide_domains.match(host):
+            return "", True
+        host_exceptions = self._collect(self.exceptions, host)
+        hidden = dict(self.exceptions.get("", {}))
+        hidden.update(host_exceptions)
+        specific = dict(self._collect(self.specific, host))
+        for selector, exclude in self._collect(self.specific_excluding, host):
+            if not _excluded(host, exclude):
+                specific[selector] = 1
+        specific = [s for s in specific if s not in hidden]
+        if self.generichide_domains.match(host):
+            return _css_for(specific), True
+        # 共通のセレクターのうち、それを含むルールがすべてこのホストを除外しているもの
+        excluded_refs = {}
+        for (selector, _), refs in self._collect(self.generic_excluding, host).items():
+            excluded_refs[selector] = excluded_refs.get(selector, 0) + refs
+        generic_excluded = {s for s, refs in excluded_refs.items() if refs >= self.generic.get(s, 0)}
+        if generic_excluded or any(s in self.generic for s in host_exceptions):
+            selectors = [s for s in self.generic if s not in hidden and s not in generic_excluded]
+            shown = set(selectors)
+            selectors.extend(s for s in specific if s not in shown)
+            return _css_for(selectors), True
+        return _css_for(s for s in specific if s not in self.generic), False
+
+    def generic_script(self):
+        """共通のスタイルシートを挿入するスクリプト (初回に作成してキャッシュする)"""
+        if self._generic_script is None:
+            self._generic_script = cosmetic_script(self.generic_stylesheet(), "generic")
+        return self._generic_script
+
+    def page_script(self, host):
+        """
+        ホスト固有のスタイルシートを挿入するスクリプト。挿入するものがなければ空文字列を返す。
+        結果はホスト名ごとにキャッシュする。
+        """
+        host = host.lower()
+        script = self._host_cache.get(host)
+        if script is not None:
+            self._host_cache.move_to_end(host)
+            return script
+        css, replaces_generic = self.stylesheet_for(host)
+        if replaces_generic:
+            script = cosmetic_script(css, "override")
+        else:
+            script = cosmetic_script(css, "page") if css else ""
+        self._host_cache[host] = script
+        if len(self._host_cache) > COSMETIC_CACHE_SIZE:
+            self._host_cache.popitem(last=False)
+        return script
+
+
+# 要素非表示のスタイルシートを挿入するスクリプト (DocumentCreationの時点で実行する)
+# role: "generic" … 共通のスタイルシート, "page" … ホスト固有の追加分, "override" … 共通のスタイルシートを置き換える
+# 同じページで実行される generic と override のどちらが先に実行されても、override の内容だけが残るようにしている
+_COSMETIC_SCRIPT_TEMPLATE = """(function () {
+    var state = window.__equaCosmetic || (window.__equaCosmetic = {});
+    var role = %(role)s, css = %(css)s;
+    function add(text) {
+        try {
+            var sheet = new CSSStyleSheet();
+            sheet.replaceSync(text);
+            document.adoptedStyleSheets = document.adoptedStyleSheets.concat([sheet]);
+            return sheet;
+        } catch (e) {
+            var style = document.createElement("style");
+            style.textContent = text;
+            (document.head || document.documentElement).appendChild(style);
+            return style;
+        }
+    }
+    function remove(sheet) {
+        if (sheet.parentNode) {
+            sheet.parentNode.removeChild(sheet);
+        } else {
+            document.adoptedStyleSheets = document.adoptedStyleSheets.filter(function (s) { return s !== sheet; });
+        }
+    }
+    if (role === "generic" && state.override) {
+        return;
+    }
+    if (role === "override") {
+        state.override = true;
+        if (state.generic) {
+            remove(state.generic);
+            state.generic = null;
+        }
+    }
+    if (css) {
+        var sheet = add(css);
+        if (role === "generic") {
+            state.generic = sheet;
+        }
+    }
+})();
+"""
+
+
+def cosmetic_script(css, role):
+    """スタイルシートを挿入するJavaScriptのソースを返す"""
+    return _COSMETIC_SCRIPT_TEMPLATE % {"role": json.dumps(role), "css": json.dumps(css)}
+
+
+# タイプの指定がこの数以下のフィルターは、タイプごとのバケットに入れる
+TYPED_BUCKET_MAX_TYPES = 3
+_DOCUMENT_BIT = TYPE_BITS["document"]
+
+
+class FilterIndex:
+    """
+    トークン → フィルターのリスト のバケットの集まり。
+
+    $image や $script のようにタイプを絞ったフィルターは、そのタイプ専用のバケットに入れる。
+    リクエストは全タイプ共通のバケットと、自分のタイプのバケットとだけ照合されるため、
+    画像のリクエストがスクリプト専用のフィルターと照合されることはない。
+    ページ本体 (document) に適用されるフィルターは、全タイプ共通のものも document のバケットに入れておき、
+    ページ本体のリクエストは document のバケットとだけ照合する
+    (タイプ指定のないフィルターはページ本体に適用されないため、共通のバケットを調べずに済む) 。
+    """
+
+    def __init__(self):
+        self.general = {} # トークン → タイプを絞っていないフィルターのリスト
+        self.by_type = {} # タイプのビット → (トークン → フィルターのリスト)
+
+    def __bool__(self):
+        return bool(self.general) or bool(self.by_type)
+
+    def copy(self):
+        """バケットのリストまで複製する (フィルター自体は共有する)"""
+        index = FilterIndex()
+        index.general = {token: list(bucket) for token, bucket in self.general.items()}
+        index.by_type = {
+            bit: {token: list(bucket) for token, bucket in buckets.items()}
+            for bit, buckets in self.by_type.items()
+        }
+        return index
+
+    def _type_bits(self, f):
+        """フィルターを入れるタイプのビットのリストを返す。全タイプ共通のバケットに入れる場合はNone"""
+        bits = [bit for bit in TYPE_BITS.values() if f.type_mask & bit]
+        if not bits or len(bits) > TYPED_BUCKET_MAX_TYPES:
+            return None
+        return bits
+
+    def insert(self, f):
+        bits = self._type_bits(f)
+        if bits is None:
+            self._insert(self.general, f)
+            if f.type_mask & _DOCUMENT_BIT:
+                self._insert(self.by_type.setdefault(_DOCUMENT_BIT, {}), f)
+        else:
+            for bit in bits:
+                self._insert(self.by_type.setdefault(bit, {}), f)
+
+    def remove(self, f):
+        """fと同じルールのフィルターを1件分取り除く。取り除けた場合はTrueを返す"""
+        bits = self._type_bits(f)
+        if bits is None:
+            if f.type_mask & _DOCUMENT_BIT:
+                buckets = self.by_type.get(_DOCUMENT_BIT)
+                if buckets is not None and self._remove(buckets, f) and not buckets:
+                    del self.by_type[_DOCUMENT_BIT]
+            return self._remove(self.general, f)
+        removed = False
+        for bit in bits:
+            buckets = self.by_type.get(bit)
+            if buckets is not None and self._remove(buckets, f):
+                removed = True
+                if not buckets:
+                    del self.by_type[bit]
+        return removed
+
+    def find(self, request):
+        """リクエストに一致する最初のフィルターを探す"""
+        buckets = self.by_type.get(request.type_bit)
+        if buckets:
+            f = self._find(buckets, request)
+            if f is not None:
+                return f
+        if request.type_bit == _DOCUMENT_BIT:
+            # ページ本体に適用される共通のフィルターは document のバケットにも入っている
+            return None
+        return self._find(self.general, request)
+
+    @staticmethod
+    def _remove(index, f):
+        """
+        バケットからfと同じルールのフィルターを1件取り除く。
+        追加時のバケットはその時点のバケットの大きさで決まるため、候補トークンのバケットをすべて探す。
+        """
+        for token in list(f.tokens()) + [""]:
+            bucket = index.get(token)
+            if not bucket:
+                continue
+            for i, candidate in enumerate(bucket):
+                if candidate.rule == f.rule:
+                    del bucket[i]
+                    if not bucket:
+                        del index[token]
+                    return True
+        return False
+
+    @staticmethod
+    def _insert(index, f):
+        """フィルターを、候補トークンのうち最もバケットが小さいものに入れる"""
+        best = ""
+        best_key = None
+        for token in f.tokens():
+            # ありふれたトークンは避け、同じ大きさなら長いトークンを優先する
+            key = (token in _COMMON_TOKENS, len(index.get(token, ())), -len(token))
+            if best_key is None or key < best_key:
+                best, best_key = token, key
+        index.setdefault(best, []).append(f)
+
+    @staticmethod
+    def _find(index, request):
+        """バケットから、リクエストに一致する最初のフィルターを探す"""
+        if not index:
+            return None
+        for token in request.tokens:
+            bucket = index.get(token)
+            if bucket:
+                for f in bucket:
+                    if f.matches(request):
+                        return f
+        # トークンを持たないフィルター (空文字キー) は常に照合する
+        bucket = index.get("")
+        if bucket:
+            for f in bucket:
+                if f.matches(request):
+                    return f
+        return None
+
+
+class FilterEngine:
+    """
+    ABP形式のネットワークフィルターをトークンでバケット化して保持するエンジン。
+
+    各フィルターはパターン中の「まれな」トークン1つをキーにしてバケットに入れられ、
+    リクエストはURLに含まれるトークンのバケットに属するフィルターとだけ照合される。
+    タイプを絞ったフィルターはタイプごとのバケットに分けて保持する (FilterIndex) 。
+    オプションのない純粋なドメインルールは DomainMatcher でまとめて判定する。
+    """
+
+    def __init__(self):
+        self.block_domains = DomainMatcher() # '||example.com^' 形式のブロックルール
+        self.exception_domains = DomainMatcher() # '@@||example.com^' 形式の例外ルール
+        self.document_exceptions = DomainMatcher() # '@@||example.com^$document' 形式 (ページ単位の許可)
+        self.cosmetic = CosmeticFilters() # 要素非表示ルール (##)
+        self._block_index = FilterIndex() # ブロックフィルター
+        self._exception_index = FilterIndex() # 例外フィルター
+        self._important_index = FilterIndex() # $important 付きブロックフィルター
+        self.rule_count = 0
+        self.source_key = None # 構築元ファイルの (サイズ, 更新日時) 。キャッシュの鮮度判定に使う
+        self.build_id = 0 # SharedEngineが構築順に振る番号。古い構築結果で新しいエンジンを上書きしないために使う
+        self.merge_stats = None # rebuild_block_listでリストを結合した際に削除したルール数 ({'duplicates': n, 'subsumed': n})
+        self.patch_stats = None # 差分適用で構築した場合の追加・削除ルール数 ({'added': n, 'removed': n}) 。全体を構築した場合はNone
+
+    @classmethod
+    def from_lines(cls, lines):
+        """行のイテラブルからエンジンを構築する"""
+        engine = cls()
+        for line in lines:
+            engine.add_rule(line)
+        return engine
+
+    def __len__(self):
+        return self.rule_count
+
+    def copy(self):
+        """
+        差分を適用するための複製を返す。
+        フィルター自体は共有し、それを入れる集合とバケットだけを複製するため、
+        複製への変更は公開中の元のエンジン (他スレッドから照合中) に影響しない。
+        """
+        engine = FilterEngine()
+        engine.block_domains = self.block_domains.copy()
+        engine.exception_domains = self.exception_domains.copy()
+        engine.document_exceptions = self.document_exceptions.copy()
+        engine.cosmetic = self.cosmetic.copy()
+        engine._block_index = self._block_index.copy()
+        engine._exception_index = self._exception_index.copy()
+        engine._important_index = self._important_index.copy()
+        engine.rule_count = self.rule_count
+        return engine
+
+    def add_rule(self, line):
+        """
+        1行のルールを追加する。ネットワークフィルターとして追加できた場合はTrueを返す。
+        後方互換性のため、'example.com' のような単純なドメイン指定の行はドメインルールとして扱う。
+        """
+        line = line.strip()
+        if not line or line.startswith(('!', '[')):
+            return False
+        if _is_hostname(line):
+            self.block_domains.add(line)
+            self.rule_count += 1
+            return True
+        if self.cosmetic.add_rule(line):
+            self.rule_count += 1
+            return True
+
+        f = NetworkFilter.parse(line)
+        if f is None:
+            return False
+        domain = f.anchored_domain()
+        if domain and not f.has_options and not f.is_important:
+            (self.exception_domains if f.is_exception else self.block_domains).add(domain)
+        elif (domain and f.is_exception and f.type_mask & TYPE_BITS["document"]
+              and f.third_party is None and f.include_domains is None and f.exclude_domains is None):
+            # このページ上のリクエストをすべて許可する例外ルール
+            self.document_exceptions.add(domain)
+        elif f.is_exception:
+            self._exception_index.insert(f)
+        elif f.is_important:
+            self._important_index.insert(f)
+        else:
+            self._block_index.insert(f)
+        self.rule_count += 1
+        return True
+
+    def remove_rule(self, line):
+        """
+        add_rule() で追加したルール1件分を取り除く。取り除けた場合はTrueを返す。
+        同じルールが複数回追加されている場合は1件分だけ取り除く。
+        """
+        line = line.strip()
+        if not line or line.startswith(('!', '[')):
+            return False
+        if _is_hostname(line):
+            removed = self.block_domains.remove(line)
+        elif _COSMETIC_RE.match(line) or _ELEMHIDE_EXCEPTION_RE.match(line):
+            removed = self.cosmetic.remove_rule(line)
+        else:
+            f = NetworkFilter.parse(line)
+            if f is None:
+                return False
+            domain = f.anchored_domain()
+            if domain and not f.has_options and not f.is_important:
+                removed = (self.exception_domains if f.is_exception else self.block_domains).remove(domain)
+            elif (domain and f.is_exception and f.type_mask & TYPE_BITS["document"]
+                  and f.third_party is None and f.include_domains is None and f.exclude_domains is None):
+                removed = self.document_exceptions.remove(domain)
+            elif f.is_exception:
+                removed = self._exception_index.remove(f)
+            elif f.is_important:
+                removed = self._important_index.remove(f)
+            else:
+                removed = self._block_index.remove(f)
+        if removed:
+            self.rule_count -= 1
+        return removed
+
+    def match(self, request):
+        """
+        リクエストをブロックすべきかを判定し、(ブロックするか, 一致したルール) を返す。
+        例外ルールに一致した場合は (False, 例外ルール) を返す。
+        """
+        if request.source_hostname:
+            domain = self.document_exceptions.match(request.source_hostname)
+            if domain is not None:
+                return False, f"@@||{domain}^$document"
+
+        important = self._important_index.find(request)
+        if important is not None:
+            return True, important.rule
+
+        rule = None
+        # ドメインルールは従来どおり、ページ本体を含むすべてのリクエストに適用する
+        domain = self.block_domains.match(request.hostname)
+        if domain is not None:
+            rule = f"||{domain}^"
+        else:
+            f = self._block_index.find(request)
+            if f is not None:
+                rule = f.rule
+        if rule is None:
+            return False, None
+
+        # ブロック対象でも、例外ルール (@@) に一致すれば許可する
+        domain = self.exception_domains.match(request.hostname)
+        if domain is not None:
+            return False, f"@@||{domain}^"
+        exception = self._exception_index.find(request)
+        if exception is not None:
+            return False, exception.rule
+        return True, rule
+
+    def should_block(self, request):
+        """リクエストをブロックすべきかどうかだけを返す"""
+        return self.match(request)[0]
+
+
+# --- コンパイル済みエンジンのキャッシュ ---
+#
+# ファイル形式: ヘッダー (マジック, 形式バージョン, 元ファイルのサイズ, 更新日時(ns), 内容のハッシュ)
+#              + pickle化したFilterEngine
+# エンジンの内部構造を変更した場合は ENGINE_CACHE_VERSION を上げること。
+ENGINE_CACHE_MAGIC = b"EQUAABPC"
+ENGINE_CACHE_VERSION = 7
+_CACHE_HEADER = struct.Struct("<8sIQQ32s")
+
+
+def cache_path_for(list_path):
+    """ブロックリストに対応するキャッシュファイルのパスを返す (例: ad_block_list.txt → ad_block_list.cache)"""
+    return os.path.splitext(list_path)[0] + ".cache"
+
+
+def _file_key(path):
+    """ファイルの (サイズ, 更新日時) を返す"""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _file_digest(path):
+    """ファイル内容のハッシュを返す (更新日時だけが変わった場合の判定用)"""
+    h = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def save_engine_cache(engine, list_path, cache_path=None, digest=None):
+    """エンジンをキャッシュファイルに書き出す。一時ファイルに書いてから置き換えるため、書き込み途中で壊れない"""
+    cache_path = cache_path or cache_path_for(list_path)
+    size, mtime_ns = _file_key(list_path)
+    if digest is None:
+        digest = _file_digest(list_path)
+    engine.source_key = (size, mtime_ns)
+    header = _CACHE_HEADER.pack(ENGINE_CACHE_MAGIC, ENGINE_CACHE_VERSION, size, mtime_ns, digest)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        pickle.dump(engine, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+
+def load_engine_cache(list_path, cache_path=None):
+    """
+    キャッシュファイルからエンジンを読み込む。
+    キャッシュが存在しない、形式が古い、元ファイルの内容と一致しない場合はNoneを返す。
+    """
+    cache_path = cache_path or cache_path_for(list_path)
+    try:
+        size, mtime_ns = _file_key(list_path)
+        with open(cache_path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if len(mm) < _CACHE_HEADER.size:
+                    return None
+                magic, version, cached_size, cached_mtime, digest = _CACHE_HEADER.unpack_from(mm, 0)
+                if magic != ENGINE_CACHE_MAGIC or version != ENGINE_CACHE_VERSION or cached_size != size:
+                    return None
+                if cached_mtime != mtime_ns:
+                    # 更新日時だけが変わった場合 (フォルダのコピーなど) は内容のハッシュで判定する
+                    if _file_digest(list_path) != digest:
+                        return None
+                    stale_mtime = True
+                else:
+                    stale_mtime = False
+                with memoryview(mm) as view:
+                    engine = pickle.loads(view[_CACHE_HEADER.size:])
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError, AttributeError, struct.error):
+        return None
+    if not isinstance(engine, FilterEngine):
+        return None
+    if stale_mtime:
+        # 次回からハッシュ計算を省けるよう、ヘッダーの更新日時を書き直しておく
+        try:
+            save_engine_cache(engine, list_path, cache_path, digest)
+        except OSError:
+            pass
+    engine.source_key = (size, mtime_ns)
+    return engine
+
+
+def compile_engine(list_path):
+    """ブロックリストファイルをパースしてエンジンを構築する"""
+    size_mtime = _file_key(list_path)
+    with open(list_path, 'r', encoding='utf-8') as f:
+        engine = FilterEngine.from_lines(f)
+    engine.source_key = size_mtime
+    return engine
+
+
+def load_engine(list_path, current=None, use_cache=True):
+    """
+    ブロックリストに対応するエンジンを返す。
+
+    currentが同じファイルから構築済みであればそれをそのまま返し、
+    キャッシュが有効であればキャッシュから読み込み、
+    どちらも使えない場合にだけファイルをパースして、結果をキャッシュに書き出す。
+    """
+    if current is not None and current.source_key is not None:
+        try:
+            if current.source_key == _file_key(list_path):
+                return current
+        except OSError:
+            pass
+    if use_cache:
+        engine = load_engine_cache(list_path)
+        if engine is not None:
+            return engine
+    engine = compile_engine(list_path)
+    if use_cache:
+        try:
+            save_engine_cache(engine, list_path)
+        except OSError as e:
+            print(f"広告ブロックリストのキャッシュの保存に失敗しました: {e}")
+    return engine
+
+
+# --- ブロックリストファイルの再構築 ---
+
+# ad_block_list.txt 内で、ユーザーが設定画面から追加したルールの開始を示すマーカー
+USER_RULES_MARKER = "[User Defined Rules]"
+
+
+def read_user_rules(list_path):
+    """ブロックリストファイルからユーザー定義ルールを抽出して返す"""
+    user_rules = []
+    if not os.path.exists(list_path):
+        return user_rules
+    with open(list_path, 'r', encoding='utf-8') as f:
+        in_user_section = False
+        for line in f:
+            if line.strip() == USER_RULES_MARKER:
+                in_user_section = True
+                continue # マーカー自体は含めない
+            if in_user_section:
+                rule = line.strip()
+                if rule: # 空行は無視
+                    user_rules.append(rule)
+    return user_rules
+
+
+def write_user_rules(list_path, user_rules):
+    """
+    ブロックリストファイルのユーザー定義ルールを user_rules に置き換える (自動更新部分はそのまま残す) 。
+    一時ファイルに書いてから置き換えるため、書き込み途中のファイルを読み込むことはない。
+    ファイルは数MBになるので、ワーカースレッドから呼び出すことを想定している。
+    """
+    tmp_path = list_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as out:
+        last = '' # 最後に書き戻した行
+        if os.path.exists(list_path):
+            with open(list_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip() == USER_RULES_MARKER:
+                        break # ユーザー定義セクションに到達したら読み込みを停止
+                    out.write(line)
+                    last = line
+        # 末尾に改行がない場合に備える
+        if last and not last.endswith('\n'):
+            out.write('\n')
+        # 保存のたびにマーカーの前の空行が増えないよう、空行がなければ1行だけ入れる
+        if last.strip():
+            out.write('\n')
+        out.write(f'{USER_RULES_MARKER}\n')
+        for rule in user_rules:
+            out.write(rule + '\n')
+    os.replace(tmp_path, list_path)
+
+
+def _domain_rule_host(rule):
+    """
+    ルールがオプションなしのドメインブロックルール ('||example.com^' または 'example.com') であれば
+    小文字のホスト名を、そうでなければNoneを返す。
+    """
+    if _is_hostname(rule):
+        return rule.lower()
+    if rule.startswith('||') and rule.endswith('^') and _is_hostname(rule[2:-1]):
+        return rule[2:-1].lower()
+    return None
+
+
+def _is_subsumed(host, block_hosts):
+    """上位ドメインのブロックルールがあり、hostのルールが不要かどうか"""
+    i = host.find('.')
+    while i != -1:
+        if host[i + 1:] in block_hosts:
+            return True
+        i = host.find('.', i + 1)
+    return False
+
+
+def _iter_source_rules(source_path):
+    """リストファイルからコメント・見出し・空行を除いたルールを返す"""
+    with open(source_path, 'r', encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            rule = line.strip()
+            if rule and not rule.startswith(('!', '[')):
+                yield rule
+
+
+# 変更されたルールがこの割合を超える場合は、差分を適用せずにエンジン全体を構築し直す
+PATCH_MAX_CHANGE_RATIO = 0.5
+
+
+def _is_valid_rule(rule):
+    """add_rule() でエンジンに追加されるルールかどうか"""
+    return (
+        _is_hostname(rule) or parse_cosmetic_rule(rule) is not None
+        or _ELEMHIDE_EXCEPTION_RE.match(rule) is not None or NetworkFilter.parse(rule) is not None
+    )
+
+
+def rebuild_block_list(list_path, sources, base=None):
+    """
+    ダウンロードしたリストと既存のユーザー定義ルールを結合してブロックリストファイルを書き直し、
+    書き出しと同時にエンジンを構築してキャッシュも保存する。
+    sources は (見出し, リストファイルのパス) のリスト。見出しがNoneでなければ "! List from: 見出し" 行を付ける。
+
+    結合の際、ドメインルールは '||example.com^' の形に正規化し、リスト間で重複するルールと、
+    より上位のドメインのブロックルールに含まれるルール ('||example.com^' がある場合の '||a.b.example.com^') は書き出さない。
+    削除した数はエンジンの merge_stats に記録する。ユーザー定義ルールはそのまま残す。
+
+    baseに現在のファイルから構築したエンジンを渡すと、新旧のルールの差分だけをその複製に適用する。
+    毎日の更新のように変更が少ない場合、構築の時間はリスト全体ではなく変更されたルール数に比例する。
+
+    GUIスレッドを止めないよう、ワーカースレッドから呼び出すことを想定している。
+    戻り値は (エンジン, ダウンロードしたリスト部分から読み込めたルール数) 。
+    """
+    user_rules = read_user_rules(list_path)
+    old_counts = None
+    if base is not None and base.source_key is not None:
+        try:
+            if base.source_key == _file_key(list_path):
+                old_counts = Counter(_iter_source_rules(list_path))
+        except OSError:
+            pass
+
+    # 1回目: 上位ドメインによる包含を判定するため、ブロックするドメインを集める
+    block_hosts = set()
+    for _, source_path in sources:
+        for rule in _iter_source_rules(source_path):
+            host = _domain_rule_host(rule)
+            if host:
+                block_hosts.add(host)
+
+    # 2回目: 重複と包含を除きながら書き出す。差分を適用しない場合は同時にエンジンを構築する
+    engine = FilterEngine() if old_counts is None else None
+    new_counts = Counter()
+    duplicates = subsumed = 0
+    # 一時ファイルに書いてから置き換えるため、書き込み途中のファイルを読み込むことはない
+    tmp_path = list_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for header, source_path in sources:
+            if header is not None:
+                f.write(f"! List from: {header}\n")
+            for rule in _iter_source_rules(source_path):
+                host = _domain_rule_host(rule)
+                if host:
+                    if _is_subsumed(host, block_hosts):
+                        subsumed += 1
+                        continue
+                    rule = f"||{host}^"
+                if rule in new_counts:
+                    duplicates += 1
+                    continue
+                new_counts[rule] = 1
+                f.write(rule + '\n')
+                if engine is not None:
+                    engine.add_rule(rule)
+        # ユーザー定義ルールセクションを追加
+        f.write(f'\n{USER_RULES_MARKER}\n')
+        for rule in user_rules:
+            f.write(rule + '\n')
+            new_counts[rule] += 1
+            if engine is not None:
+                engine.add_rule(rule)
+    os.replace(tmp_path, list_path)
+
+    if engine is None:
+        removed = old_counts - new_counts
+        added = new_counts - old_counts
+        change_count = sum(removed.values()) + sum(added.values())
+        if change_count <= len(new_counts) * PATCH_MAX_CHANGE_RATIO:
+            engine = base.copy()
+            for rule, count in removed.items():
+                for _ in range(count):
+                    engine.remove_rule(rule)
+            for rule, count in added.items():
+                for _ in range(count):
+                    engine.add_rule(rule)
+            engine.patch_stats = {"added": sum(added.values()), "removed": sum(removed.values())}
+        else:
+            engine = FilterEngine.from_lines(new_counts.elements())
+    downloaded_count = engine.rule_count - sum(1 for rule in user_rules if _is_valid_rule(rule))
+    engine.merge_stats = {"duplicates": duplicates, "subsumed": subsumed}
+    try:
+        save_engine_cache(engine, list_path)
+    except OSError as e:
+        print(f"広告ブロックリストのキャッシュの保存に失敗しました: {e}")
+    return engine, downloaded_count
+
+
+# --- 更新元リストのダウンロード ---
+
+# ListSourceStoreのインデックスファイルへの書き込みを直列化するためのロック
+_store_lock = threading.Lock()
+
+
+class ListSourceStore:
+    """
+    ダウンロードしたリストを更新元URLごとにファイルとして保存し、
+    条件付きリクエストのための ETag / Last-Modified を記録する。
+
+    変更のなかったリスト (304 Not Modified) も、保存済みのファイルから再結合できる。
+    ディレクトリ構成:
+        index.json   … URLごとの検証子と、前回ad_block_list.txtに結合したURLの一覧
+        <hash>.txt   … URLごとのリスト本体
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+
+    def path_for(self, url):
+        """URLに対応するリストファイルのパスを返す"""
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, f"{name}.txt")
+
+    def has(self, url):
+        return os.path.exists(self.path_for(url))
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if isinstance(index, dict):
+                return index
+        except (OSError, ValueError):
+            pass
+        return {}
+
+    def _save_index(self, index):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, self.index_path)
+
+    def validators(self, url):
+        """URLに対して保存されている {'etag': ..., 'last_modified': ...} を返す"""
+        if not self.has(url):
+            return {} # 本体が失われている場合は条件付きリクエストをしない
+        return self._load_index().get("sources", {}).get(url, {})
+
+    def save(self, url, lines, etag=None, last_modified=None):
+        """
+        リスト本体を1行ずつ一時ファイルに書き出してから置き換え、検証子を保存する。
+        lines はイテラブルで、ダウンロードしながら渡せば本体全体をメモリに載せずに済む。
+        途中で失敗した場合は一時ファイルを削除し、以前のファイルはそのまま残す。
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path_for(url)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for line in lines:
+                    f.write(line + '\n')
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        self.set_validators(url, etag, last_modified)
+
+    def set_validators(self, url, etag=None, last_modified=None):
+        with _store_lock:
+            index = self._load_index()
+            entry = {}
+            if etag:
+                entry["etag"] = etag
+            if last_modified:
+                entry["last_modified"] = last_modified
+            index.setdefault("sources", {})[url] = entry
+            self._save_index(index)
+
+    def merged_urls(self):
+        """前回ad_block_list.txtに結合したURLの一覧"""
+        return self._load_index().get("merged_urls", [])
+
+    def set_merged_urls(self, urls):
+        with _store_lock:
+            index = self._load_index()
+            index["merged_urls"] = list(urls)
+            self._save_index(index)
+
+    def needs_rebuild(self, urls, list_path, modified):
+        """
+        ad_block_list.txtを作り直す必要があるかを判定する。
+        いずれかのリストが更新されたか、結合するリストの構成が変わったか、ファイルがない場合にTrue。
+        """
+        return bool(modified) or self.merged_urls() != list(urls) or not os.path.exists(list_path)
+
+
+def source_store_for(list_path):
+    """ブロックリストファイルと同じフォルダにある ad_block_sources のストアを返す"""
+    return ListSourceStore(os.path.join(os.path.dirname(list_path), "ad_block_sources"))
+
+
+# ダウンロード時に一度に読み込むバイト数。メモリ使用量のピークはリスト全体ではなくこの大きさで決まる
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class _StreamDecompressor:
+    """
+    Content-Encodingに応じてレスポンス本体をチャンクごとに展開する。
+    圧縮率の高いリストでも展開後の1回分がmax_lengthを超えないよう、分割して返す。
+    """
+
+    def __init__(self, content_encoding, max_length=DOWNLOAD_CHUNK_SIZE):
+        encoding = (content_encoding or "").strip().lower()
+        if encoding in ("gzip", "x-gzip"):
+            self._wbits = 16 + zlib.MAX_WBITS
+        elif encoding == "deflate":
+            self._wbits = zlib.MAX_WBITS # zlibヘッダー付き (RFC準拠)
+        else:
+            self._wbits = None
+        self._obj = zlib.decompressobj(self._wbits) if self._wbits is not None else None
+        self._started = False
+        self.max_length = max_length
+
+    def _decompress_first(self, data):
+        try:
+            return self._obj.decompress(data, self.max_length)
+        except zlib.error:
+            if self._started or self._wbits != zlib.MAX_WBITS:
+                raise
+            # ヘッダーなしのdeflateを返すサーバー向け
+            self._wbits = -zlib.MAX_WBITS
+            self._obj = zlib.decompressobj(self._wbits)
+            return self._obj.decompress(data, self.max_length)
+
+    def decompress(self, data):
+        """展開したデータを max_length 以下の断片ごとに返すジェネレーター"""
+        if self._obj is None:
+            yield data
+            return
+        out = self._decompress_first(data)
+        self._started = True
+        while True:
+            if out:
+                yield out
+            if self._obj.unconsumed_tail:
+                out = self._obj.decompress(self._obj.unconsumed_tail, self.max_length)
+            elif self._obj.eof and self._obj.unused_data:
+                # 複数メンバーからなるgzipは続きのメンバーも展開する
+                rest = self._obj.unused_data
+                self._obj = zlib.decompressobj(self._wbits)
+                out = self._obj.decompress(rest, self.max_length)
+            else:
+                break
+
+    def flush(self):
+        return self._obj.flush() if self._obj is not None else b""
+
+
+def iter_response_lines(response, chunk_size=DOWNLOAD_CHUNK_SIZE, deadline=None):
+    """
+    レスポンスをチャンクごとに読み込み、展開・デコードしながら1行ずつ返す。
+    改行コードは取り除く。行をまたぐチャンクの境界は次のチャンクと結合する。
+    deadline (time.monotonic() の値) を過ぎるとTimeoutErrorを送出する。
+    """
+    decompressor = _StreamDecompressor(response.headers.get('Content-Encoding'), chunk_size)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    # read() は chunk_size バイトそろうまで戻らないため、少しずつ送ってくる遅いサーバーでは
+    # 期限を確かめられない。届いた分だけを返す read1() があればそちらを使う
+    read = getattr(response, 'read1', response.read)
+    pending = ""
+    while True:
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError("ダウンロードが制限時間内に完了しませんでした")
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        for data in decompressor.decompress(chunk):
+            pending += decoder.decode(data)
+            lines = pending.split('\n')
+            pending = lines.pop() # 最後の要素は行の途中の可能性がある
+            for line in lines:
+                yield line.rstrip('\r')
+    pending += decoder.decode(decompressor.flush(), final=True)
+    for line in pending.split('\n'):
+        line = line.rstrip('\r')
+        if line:
+            yield line
+
+
+def fetch_list(url, store, timeout=30, deadline=None):
+    """
+    更新元URLからリストをダウンロードしてストアに保存する。
+    前回のETag / Last-Modifiedがあれば条件付きリクエストを送り、gzip/deflate圧縮も受け付ける。
+    リストが更新されていればTrue、304 Not Modifiedで変更がなければFalseを返す。
+    timeout は1回の通信の待ち時間、deadline (time.monotonic() の値) はダウンロード全体の期限。
+    失敗した場合は例外を送出する。
+    """
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("ダウンロードが制限時間内に開始できませんでした")
+        timeout = min(timeout, remaining)
+    headers = {
+        'User-Agent': 'Mozilla/5.0', # 403 Forbiddenを避けるため
+        'Accept-Encoding': 'gzip, deflate',
+    }
+    validators = store.validators(url)
+    if validators.get("etag"):
+        headers['If-None-Match'] = validators["etag"]
+    if validators.get("last_modified"):
+        headers['If-Modified-Since'] = validators["last_modified"]
+
+    req = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(req, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return False # 前回から変更なし
+        raise
+    with response:
+        if response.status == 304:
+            return False
+        if response.status != 200:
+            raise RuntimeError(f"サーバーエラー: {response.status}")
+        # 本体は読み込みながらストアの一時ファイルに書き出し、完了してから置き換える
+        store.save(url, iter_response_lines(response, deadline=deadline), response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    return True
+
+
+# 同時にダウンロードするリストの数と、リストごと・更新全体の制限時間 (秒)
+MAX_CONCURRENT_DOWNLOADS = 4
+SOURCE_DEADLINE = 60
+UPDATE_DEADLINE = 180
+
+
+def fetch_lists(urls, store, max_workers=MAX_CONCURRENT_DOWNLOADS,
+                source_deadline=SOURCE_DEADLINE, update_deadline=UPDATE_DEADLINE):
+    """
+    複数のリストを並行してダウンロードし、完了した順に (URL, 成功/失敗, 更新されたか, エラーメッセージ) を返すジェネレーター。
+    1つの遅いミラーが他のリストを待たせないよう、リストごとの期限と全体の期限を設ける。
+    全体の期限を過ぎてから順番が回ってきたリストは、通信せずにタイムアウトとして扱う。
+    """
+    update_end = time.monotonic() + update_deadline
+
+    def fetch(url):
+        deadline = min(time.monotonic() + source_deadline, update_end)
+        return fetch_list(url, store, deadline=deadline)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(urls)))) as executor:
+        futures = {executor.submit(fetch, url): url for url in urls}
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                yield url, True, future.result(), ""
+            except Exception as e:
+                yield url, False, False, str(e) or type(e).__name__
+
+
+class DecisionCache:
+    """
+    判定結果の上限付きLRUキャッシュ。
+    同じページ内で同じリクエストが繰り返される場合に、エンジンでの照合を辞書の参照1回で済ませる。
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """キャッシュされた判定結果を返す。なければNoneを返す"""
+        result = self._entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        try:
+            self._entries.move_to_end(key)
+        except KeyError: # 他のスレッドが同時に追い出した場合
+            pass
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """判定結果を追加し、上限を超えたら最も古いものを追い出す"""
+        self._entries[key] = result
+        if len(self._entries) > self.maxsize:
+            try:
+                self._entries.popitem(last=False)
+            except KeyError:
+                pass
+
+    def stats(self):
+        """ヒット数・ミス数などの統計を辞書で返す"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+        }
+
+
+class SharedEngine:
+    """
+    プロセス全体で1つのFilterEngineを共有するための入れ物。
+
+    公開されたエンジンは変更しない (イミュータブルとして扱う) 。リストが更新されたときは
+    新しいエンジンを構築してから参照を差し替えるだけなので、照合中のスレッドは
+    手元の古いエンジンを最後まで使え、参照がなくなった時点で古いエンジンは解放される。
+    """
+
+    def __init__(self, cache_size=4096):
+        self.cache_size = cache_size
+        # エンジンとその判定キャッシュは必ず対で差し替える (1回の代入で読み書きできるようにタプルで持つ)
+        self._state = (FilterEngine(), DecisionCache(cache_size))
+        # ブロックリストファイルの書き換えとエンジンの構築を直列化するためのロック
+        # (複数のウィンドウやワーカースレッドから同時に構築が要求されても、ファイルが競合しない)
+        self._lock = threading.Lock()
+        self._build_seq = 0
+        self.generation = 0 # エンジンが差し替えられるたびに増える世代番号
+
+    @property
+    def engine(self):
+        """現在のエンジン"""
+        return self._state[0]
+
+    @property
+    def cache(self):
+        """現在のエンジンに対応する判定キャッシュ"""
+        return self._state[1]
+
+    def swap(self, engine):
+        """
+        エンジンを差し替え、判定キャッシュも新しいものにする。
+        参照の代入はアトミックなので、照合中のスレッドをブロックしない。
+        """
+        self._state = (engine, DecisionCache(self.cache_size))
+        self.generation += 1
+
+    def match(self, request):
+        """
+        判定キャッシュを引き、なければエンジンで照合して (ブロックするか, 一致したルール) を返す。
+        パスや$third-party、タイプ指定のルールがあるためホスト名だけでは結果が決まらないので、
+        キャッシュのキーには URL・リクエスト元ホスト・リソースタイプ を使う。
+        """
+        engine, cache = self._state
+        key = (request.url, request.source_hostname, request.type_bit)
+        result = cache.get(key)
+        if result is None:
+            result = engine.match(request)
+            cache.put(key, result)
+        return result
+
+    def should_block(self, request):
+        """リクエストをブロックすべきかどうかだけを返す"""
+        return self.match(request)[0]
+
+    def _assign_build_id(self, engine):
+        # self._lock を保持した状態で呼ぶこと
+        self._build_seq += 1
+        engine.build_id = self._build_seq
+
+    def build(self, list_path, sources=None, user_rules=None):
+        """
+        エンジンを構築して返す (公開はしない) 。ワーカースレッドから呼び出すことを想定している。
+        sourcesを指定した場合はブロックリストファイルを書き直してから構築し、
+        Noneの場合は現在のファイル (またはそのキャッシュ) から構築する。
+        user_rulesを指定した場合は、先にファイルのユーザー定義ルールをそれに置き換える。
+        ファイルの書き換えはすべてこのロックの中で行うので、同時に書き換えられることはない。
+        戻り値は (エンジン, 読み込んだルール数) 。
+        """
+        with self._lock:
+            if user_rules is not None:
+                write_user_rules(list_path, user_rules)
+            if sources is None:
+                engine = load_engine(list_path)
+                rule_count = engine.rule_count
+            else:
+                # 公開中のエンジンが現在のファイルから構築されていれば、差分だけを適用する
+                engine, rule_count = rebuild_block_list(list_path, sources, base=self.engine)
+            self._assign_build_id(engine)
+        return engine, rule_count
+
+    def publish(self, engine):
+        """
+        build() で構築したエンジンを公開する。GUIスレッドから呼び出す。
+        より後に構築されたエンジンが既に公開されている場合は何もせずFalseを返す。
+        """
+        if engine.build_id < self.engine.build_id:
+            return False
+        self.swap(engine)
+        return True
+
+    def reload(self, list_path):
+        """
+        ブロックリストファイルからエンジンを読み込み直す。
+        ファイルが変わっていなければ何もしない。差し替えた場合はTrueを返す。
+        GUIスレッドから呼ばれるので、ロックは待たない。ワーカースレッドで構築中であれば、
+        その構築が終わって publish() されたときに最新のファイルが反映されるので、何もせずFalseを返す。
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            current = self.engine
+            engine = load_engine(list_path, current=current)
+            if engine is current:
+                return False
+            self._assign_build_id(engine)
+            self.swap(engine)
+            return True
+        finally:
+            self._lock.release()
+
+
+# すべてのウィンドウ・プロファイルのインターセプターが参照する共有エンジン
+shared_engine = SharedEngine()
+
+
+# --- 計測 ---
+
+# インターセプターの処理時間のヒストグラムの区切り (マイクロ秒) 。最後の区切りを超えたものは最後のバケットに数える
+LATENCY_BUCKET_BOUNDS_US = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class AdBlockStats:
+    """
+    インターセプター1つ (= プロファイル1つ) 分の計測値。
+
+    リクエストごとのコストを抑えるため、処理時間は固定のバケットに数えるだけにし、
+    ルールの一致回数も辞書のカウンターで数える。複数スレッドから更新されるがロックは取らない
+    (まれにカウントが1つ失われても、統計としては問題にならない) 。
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seen = 0
+        self.blocked = 0
+        self.latency_counts = [0] * (len(LATENCY_BUCKET_BOUNDS_US) + 1)
+        self.rule_hits = Counter()
+
+    def record(self, elapsed_ns, blocked, rule):
+        """1件のリクエストの処理時間 (ナノ秒) と判定結果を記録する"""
+        self.seen += 1
+        if blocked:
+            self.blocked += 1
+        self.latency_counts[bisect.bisect_left(LATENCY_BUCKET_BOUNDS_US, elapsed_ns // 1000)] += 1
+        if rule is not None:
+            self.rule_hits[rule] += 1
+
+    def merge(self, other):
+        """他の計測値を足し合わせる (全ウィンドウの集計用)"""
+        self.seen += other.seen
+        self.blocked += other.blocked
+        for i, count in enumerate(other.latency_counts):
+            self.latency_counts[i] += count
+        self.rule_hits.update(other.rule_hits)
+
+    def latency_percentile(self, percentile):
+        """
+        処理時間のパーセンタイルを、それを含むバケットの上限 (マイクロ秒) で返す。
+        最後のバケットに入る場合や、まだ記録がない場合はNoneを返す。
+        """
+        total = sum(self.latency_counts)
+        if not total:
+            return None
+        threshold = total * percentile / 100
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKET_BOUNDS_US, self.latency_counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return bound
+        return None
+
+    def top_rules(self, n=20):
+        """一致回数の多いルールを (ルール, 回数) のリストで返す"""
+        return self.rule_hits.most_common(n)
+
+    def to_dict(self, top_n=100):
+        """JSONに書き出せる形で返す"""
+        buckets = [f"<={bound}us" for bound in LATENCY_BUCKET_BOUNDS_US] + [f">{LATENCY_BUCKET_BOUNDS_US[-1]}us"]
+        return {
+            "seen": self.seen,
+            "blocked": self.blocked,
+            "latency_histogram": dict(zip(buckets, self.latency_counts)),
+            "latency_p50_us": self.latency_percentile(50),
+            "latency_p99_us": self.latency_percentile(99),
+            "top_rules": [{"rule": rule, "hits": hits} for rule, hits in self.top_rules(top_n)],
+        }
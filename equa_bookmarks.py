@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+EQUA ブックマークストア
+
+Qtに依存しない純粋なPythonの部分をまとめたモジュール。
+equa.py / equa-copy.py のどちらからも利用される。
+"""
+import bisect
+import re
+
+# タイトル・URLを検索用の語に区切る
+_TERM_RE = re.compile(r"\w+")
+# 範囲検索の上限に使う、どの文字よりも後ろに並ぶ文字
+_MAX_CHAR = chr(0x10FFFF)
+
+
+class BookmarkIndex:
+    """
+    ブックマークのリストの複製から作る検索用の索引。作った後は変更しないので、GUIスレッドの外で検索できる。
+    検索結果はタイトルかURLに入力をそのまま含むブックマーク (部分一致) で、
+    語からその語を含むブックマークの番号への索引 (転置索引) は、一致しうるものを絞り込むのに使う。
+    索引は最初の検索のときに作るので、1つのスレッド (search_executor) からだけ検索すること。
+    """
+
+    def __init__(self, bookmarks):
+        self.bookmarks = tuple(bookmarks)
+        self._titles = None # 小文字にしたタイトル (番号順)
+        self._urls = None # 小文字にしたURL (番号順)
+        self._postings = None # 語 -> その語を含むブックマークの番号の集合
+        self._terms = None # _postings の語をソートしたリスト
+
+    def __len__(self):
+        return len(self.bookmarks)
+
+    def _build(self):
+        self._titles = [bookmark['title'].lower() for bookmark in self.bookmarks]
+        self._urls = [bookmark['url'].lower() for bookmark in self.bookmarks]
+        postings = {}
+        for i, (title, url) in enumerate(zip(self._titles, self._urls)):
+            for term in set(_TERM_RE.findall(f"{title} {url}")):
+                ids = postings.get(term)
+                if ids is None:
+                    postings[term] = {i}
+                else:
+                    ids.add(i)
+        self._postings = postings
+        self._terms = sorted(postings)
+
+    def search(self, text):
+        """
+        タイトルかURLに text を含むブックマークを並び順のリストで返す (大文字・小文字は区別しない) 。
+        入力の中で区切り文字の直後から始まる語は、ブックマークの語の先頭に一致するはずなので、
+        その語で始まる語を索引から引いて候補を絞り込む。そのような語がない入力 ('ample' のように語の途中から
+        一致しうるものや日本語など) は、すべてのブックマークを部分一致で調べる。
+        """
+        search_text = text.lower()
+        if not search_text:
+            return list(self.bookmarks)
+        if self._postings is None:
+            self._build()
+        candidates = None
+        for m in _TERM_RE.finditer(search_text):
+            if m.start() == 0:
+                continue
+            ids = self._match_prefix(m.group())
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return []
+        ids = range(len(self.bookmarks)) if candidates is None else sorted(candidates)
+        return [
+            self.bookmarks[i] for i in ids
+            if search_text in self._titles[i] or search_text in self._urls[i]
+        ]
+
+    def _match_prefix(self, prefix):
+        """prefix で始まる語を含むブックマークの番号の集合"""
+        lo = bisect.bisect_left(self._terms, prefix)
+        hi = bisect.bisect_left(self._terms, prefix + _MAX_CHAR, lo)
+        ids = set()
+        for term in self._terms[lo:hi]:
+            ids |= self._postings[term]
+        return ids
+
+
+class BookmarkStore:
+    """
+    ブックマーク ({'title': タイトル, 'url': URL} の辞書) を並び順を保って保持する。
+    URLをキーにした辞書で持つので、URLによる重複の確認・追加・削除は件数によらず定数時間で済む。
+    先頭への追加と末尾への追加は別の辞書に入れ、先頭側を逆順にたどってから末尾側をたどることで並び順を表す。
+    GUIスレッドからだけ使う (他のスレッドに渡すときは to_list() の複製や index() の索引を渡す) 。
+    """
+
+    def __init__(self, bookmarks=()):
+        self._head = {} # 先頭に追加したブックマーク (URL -> ブックマーク) 。後に追加したものほど前に並ぶ
+        self._tail = {} # 末尾に追加したブックマーク。先に追加したものほど前に並ぶ
+        self._index = None # index() で作った索引。変更されたらNoneにして次に作り直す
+        for bookmark in bookmarks:
+            self._add(bookmark, front=False)
+
+    def __len__(self):
+        return len(self._head) + len(self._tail)
+
+    def __iter__(self):
+        yield from reversed(self._head.values())
+        yield from self._tail.values()
+
+    def __contains__(self, url):
+        return url in self._head or url in self._tail
+
+    def get(self, url):
+        """URLが url のブックマーク (なければNone)"""
+        bookmark = self._head.get(url)
+        return bookmark if bookmark is not None else self._tail.get(url)
+
+    def prepend(self, bookmark):
+        """ブックマークを先頭に追加する。同じURLのブックマークがすでにあれば追加せずFalseを返す"""
+        return self._add(bookmark, front=True)
+
+    def append(self, bookmark):
+        """ブックマークを末尾に追加する。同じURLのブックマークがすでにあれば追加せずFalseを返す"""
+        return self._add(bookmark, front=False)
+
+    def prepend_all(self, bookmarks):
+        """bookmarks を順に先頭に追加し (最後のものが先頭に並ぶ) 、追加した件数を返す。重複するURLは追加しない"""
+        return sum(self._add(bookmark, front=True) for bookmark in bookmarks)
+
+    def remove(self, url):
+        """URLが url のブックマークを削除する。なければFalseを返す"""
+        bookmark = self._head.pop(url, None)
+        if bookmark is None:
+            bookmark = self._tail.pop(url, None)
+            if bookmark is None:
+                return False
+        self._index = None
+        return True
+
+    def to_list(self):
+        """並び順のブックマークのリスト (保存や同期に使う)"""
+        return list(self)
+
+    def index(self):
+        """
+        現在のブックマークの検索用の索引 (BookmarkIndex) 。変更されるまでは同じものを返す。
+        索引は複製から作るので、この後にブックマークが変更されても影響を受けない。
+        """
+        if self._index is None:
+            self._index = BookmarkIndex(self)
+        return self._index
+
+    def _add(self, bookmark, front):
+        url = bookmark['url']
+        if url in self:
+            return False
+        if front:
+            self._head[url] = bookmark
+        else:
+            self._tail[url] = bookmark
+        self._index = None
+        return True
@@ -0,0 +1,722 @@
+# -*- coding: utf-8 -*-
+"""
+EQUA 閲覧履歴ストア
+
+Qtに依存しない純粋なPythonの部分をまとめたモジュール。
+equa.py / equa-copy.py のどちらからも利用される。
+"""
+import atexit
+import math
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+# バッファした訪問がこの件数に達したら、タイマーを待たずに書き込む
+HISTORY_FLUSH_BATCH_SIZE = 32
+# バッファした訪問を書き込むまでの最大の待ち時間 (秒)
+HISTORY_FLUSH_INTERVAL = 3.0
+# 履歴の保存期間・最大件数・データベースの最大サイズの既定値 (設定で変更できる。0は無制限)
+# 以前は履歴を無期限に保存していたので、既存の履歴がユーザーの知らないうちに削除されないよう、
+# 既定ではどれも無制限にしておき、設定で制限したときにだけ整理する
+DEFAULT_HISTORY_MAX_AGE_DAYS = 0
+DEFAULT_HISTORY_MAX_URLS = 0
+DEFAULT_HISTORY_MAX_SIZE_MB = 0
+# 操作がこの秒数なかったら、ブラウザが使われていないとみなして履歴の整理を始める
+HISTORY_IDLE_SECONDS = 30
+# 履歴の整理が終わってから次に整理するまでの間隔 (秒)
+HISTORY_MAINTENANCE_INTERVAL = 60 * 60
+# 整理で1回のトランザクションで削除する行数 (この間は書き込みを待たせるので小さくする)
+HISTORY_PRUNE_BATCH_SIZE = 500
+# 1回の PRAGMA incremental_vacuum で解放するページ数
+HISTORY_VACUUM_PAGES = 256
+# 全文検索インデックスの削除済みの項目を片付けるとき、1回でマージするページ数
+HISTORY_FTS_MERGE_PAGES = 256
+# frecent() / search() などで返す最大件数
+HISTORY_QUERY_LIMIT = 200
+# 履歴ウィンドウでスクロールに合わせて一度に読み込む件数
+HISTORY_PAGE_SIZE = 100
+# 全文検索でbm25のスコアを計算する候補の数。一致した行のうち新しく追加されたものからこの件数だけを順位付けする
+# (「com」のようにほぼ全行に一致する語でも、スコアの計算が履歴の件数に比例しないようにするため)
+HISTORY_SEARCH_CANDIDATES = 2000
+# bm25の列ごとの重み (タイトル, URL)
+HISTORY_SEARCH_WEIGHTS = (2.0, 1.0)
+
+# 訪問の種類 (visits.transition に保存する値)
+TRANSITION_LINK = 0 # リンクのクリック
+TRANSITION_TYPED = 1 # アドレスバーへの入力
+TRANSITION_FORM_SUBMIT = 2 # フォームの送信
+TRANSITION_BACK_FORWARD = 3 # 戻る・進む
+TRANSITION_RELOAD = 4 # 再読み込み
+TRANSITION_OTHER = 5 # その他 (スクリプトによる遷移など)
+
+# frecency (訪問の新しさで重み付けした訪問回数) の計算に使う、訪問の種類ごとの重み
+# 自分で入力したURLは重く、再読み込みはほとんど数えない
+TRANSITION_WEIGHTS = {
+    TRANSITION_LINK: 1.0,
+    TRANSITION_TYPED: 2.0,
+    TRANSITION_FORM_SUBMIT: 0.5,
+    TRANSITION_BACK_FORWARD: 0.5,
+    TRANSITION_RELOAD: 0.1,
+    TRANSITION_OTHER: 0.5,
+}
+# 訪問の重みが半分になるまでの日数
+FRECENCY_HALF_LIFE_DAYS = 30
+_FRECENCY_DECAY_PER_MS = math.log(2) / (FRECENCY_HALF_LIFE_DAYS * 24 * 60 * 60 * 1000)
+
+
+def visit_score(visit_time, weight):
+    """
+    1回の訪問のfrecencyへの寄与を対数で返す。
+    現在時刻 now における訪問の重みは weight * 2^(-(now - visit_time) / 半減期) だが、
+    これを now によらない基準 (UNIX時間0) に換算して log(weight) + λ * visit_time として保存する。
+    すべてのURLに同じ係数 2^(-now / 半減期) がかかるだけなので、時間が経っても保存した値を
+    更新し直さずにそのまま大小を比較でき、訪問のたびに frecency_add() で足し込むだけでよい。
+    """
+    return math.log(weight) + visit_time * _FRECENCY_DECAY_PER_MS
+
+
+def frecency_add(a, b):
+    """対数で表したfrecencyの和 log(e^a + e^b) 。どちらかがNULLならもう一方を返す"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    high, low = (a, b) if a >= b else (b, a)
+    return high + math.log1p(math.exp(low - high))
+
+
+def frecency_at(frecency, now):
+    """保存したfrecencyを、時刻 now (UNIX時間 (ミリ秒)) における重み付き訪問回数に直す"""
+    return math.exp(frecency - now * _FRECENCY_DECAY_PER_MS)
+
+def _fts_triggers(table):
+    """
+    table と全文検索インデックス (table_fts) を同期するトリガー。
+    テーブルを作り直すマイグレーションではトリガーも消えるので、作り直せるよう関数にしておく。
+    """
+    fts = f"{table}_fts"
+    return (
+        f"""
+        CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts}(rowid, title, url) VALUES (new.id, new.title, new.url);
+        END
+        """,
+        f"""
+        CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, title, url) VALUES ('delete', old.id, old.title, old.url);
+        END
+        """,
+        f"""
+        CREATE TRIGGER {fts}_update AFTER UPDATE OF title, url ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, title, url) VALUES ('delete', old.id, old.title, old.url);
+            INSERT INTO {fts}(rowid, title, url) VALUES (new.id, new.title, new.url);
+        END
+        """,
+    )
+
+
+def _create_fts(conn, table):
+    """
+    table のタイトルとURLの全文検索インデックス (table_fts) を作り、既存の行から構築する。
+    外部コンテンツ型なので文字列を二重に保存しない。2文字・3文字の前方一致用のインデックスも作り、
+    入力途中の短い語でも速く引けるようにする。
+    SQLiteがFTS5なしでビルドされている場合は作らずに進め、検索はLIKEで行う。
+    """
+    fts = f"{table}_fts"
+    if _has_table(conn, fts):
+        return
+    try:
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE {fts} USING fts5(
+                title, url, content='{table}', content_rowid='id', prefix='2 3'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        print(f"履歴の全文検索インデックスを作成できませんでした: {e}")
+        return
+    for sql in _fts_triggers(table):
+        conn.execute(sql)
+    conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def _has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+
+def _migrate_create_history(conn):
+    """バージョン1: 履歴テーブル (マイグレーションを導入する前のデータベースには既にある)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NOT NULL UNIQUE,
+            title TEXT,
+            last_visit_time TEXT NOT NULL,
+            visit_count INTEGER NOT NULL DEFAULT 1
+        )
+    """)
+
+
+def _migrate_create_fts(conn):
+    """バージョン2: タイトルとURLの全文検索インデックス"""
+    _create_fts(conn, "history")
+
+
+def _migrate_epoch_ms(conn):
+    """
+    バージョン3: 最終訪問日時をISO形式の文字列からUNIX時間 (ミリ秒) の整数に変え、インデックスを張る。
+    列の型は変えられないのでテーブルを作り直す。idはそのまま引き継ぐので全文検索インデックスは作り直さなくてよい。
+    以前の値はローカル時刻で保存されているので、'utc' 修飾子でUTCに直してから変換する。
+    """
+    conn.execute("""
+        CREATE TABLE history_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NOT NULL UNIQUE,
+            title TEXT,
+            last_visit_time INTEGER NOT NULL,
+            visit_count INTEGER NOT NULL DEFAULT 1
+        )
+    """)
+    conn.execute("""
+        INSERT INTO history_new (id, url, title, last_visit_time, visit_count)
+        SELECT id, url, title,
+               COALESCE(CAST(ROUND((julianday(last_visit_time, 'utc') - 2440587.5) * 86400000) AS INTEGER), 0),
+               visit_count
+        FROM history
+    """)
+    conn.execute("DROP TABLE history")
+    conn.execute("ALTER TABLE history_new RENAME TO history")
+    conn.execute("CREATE INDEX history_last_visit_time ON history (last_visit_time)")
+    if _has_table(conn, "history_fts"):
+        for sql in _fts_triggers("history"):
+            conn.execute(sql)
+
+
+def _migrate_visits(conn):
+    """
+    バージョン4: URLごとの urls テーブルと、訪問ごとの visits テーブルに分ける。
+    history を urls に改名してfrecencyの列を加える。以前のデータには最後の訪問しか残っていないので、
+    各URLの visit_count 回の訪問が最終訪問日時にまとめてあったものとして初期値を計算する。
+    全文検索インデックスは参照先のテーブル名が変わるので作り直す。
+    """
+    for suffix in ("insert", "delete", "update"):
+        conn.execute(f"DROP TRIGGER IF EXISTS history_fts_{suffix}")
+    conn.execute("DROP TABLE IF EXISTS history_fts")
+    conn.execute("DROP INDEX IF EXISTS history_last_visit_time")
+    conn.execute("ALTER TABLE history RENAME TO urls")
+    conn.execute("ALTER TABLE urls ADD COLUMN frecency REAL NOT NULL DEFAULT 0")
+    conn.execute("UPDATE urls SET frecency = visit_score(last_visit_time, visit_count)")
+    conn.execute("CREATE INDEX urls_last_visit_time ON urls (last_visit_time)")
+    conn.execute("CREATE INDEX urls_frecency ON urls (frecency)")
+    conn.execute("""
+        CREATE TABLE visits (
+            id INTEGER PRIMARY KEY,
+            url_id INTEGER NOT NULL REFERENCES urls (id) ON DELETE CASCADE,
+            visit_time INTEGER NOT NULL,
+            transition INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute(
+        "INSERT INTO visits (url_id, visit_time, transition) SELECT id, last_visit_time, ? FROM urls",
+        (TRANSITION_LINK,),
+    )
+    conn.execute("CREATE INDEX visits_visit_time ON visits (visit_time)")
+    conn.execute("CREATE INDEX visits_url_id ON visits (url_id)")
+    _create_fts(conn, "urls")
+
+
+# スキーマのマイグレーション。i番目の関数がバージョンiからi+1への変更を行う。
+# 現在のバージョンは PRAGMA user_version に記録される。スキーマを変えるときは末尾に追加すること (既存のものは変えない) 。
+_MIGRATIONS = (
+    _migrate_create_history,
+    _migrate_create_fts,
+    _migrate_epoch_ms,
+    _migrate_visits,
+)
+HISTORY_SCHEMA_VERSION = len(_MIGRATIONS)
+
+
+def migrate(conn):
+    """
+    データベースを最新のスキーマに移行する。各マイグレーションは1つのトランザクションで行い、
+    途中で失敗した場合はそのマイグレーションの前の状態に戻る (次回の起動時に再試行される) 。
+    移行後のバージョンを返す。
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > HISTORY_SCHEMA_VERSION:
+        # 新しいバージョンのEQUAで作られたデータベース。そのまま使う
+        print(f"履歴データベースのバージョン ({version}) がこのバージョンのEQUAより新しいため、移行を行いません")
+        return version
+    for index in range(version, HISTORY_SCHEMA_VERSION):
+        # sqlite3モジュールはCREATEなどの前にトランザクションを自動で開始しないので、明示的に開始する
+        conn.execute("BEGIN")
+        try:
+            _MIGRATIONS[index](conn)
+            conn.execute(f"PRAGMA user_version = {index + 1}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+    return HISTORY_SCHEMA_VERSION
+
+
+def now_ms():
+    """現在時刻のUNIX時間 (ミリ秒)"""
+    return time.time_ns() // 1_000_000
+
+
+# URLの行を追加・更新し、訪問のfrecencyを足し込む (引数: url, title, 訪問日時, 訪問日時, 重み)
+_UPSERT_URL = """
+    INSERT INTO urls (url, title, last_visit_time, visit_count, frecency)
+    VALUES (?, ?, ?, 1, visit_score(?, ?))
+    ON CONFLICT(url) DO UPDATE SET
+        title = excluded.title,
+        last_visit_time = max(last_visit_time, excluded.last_visit_time),
+        visit_count = visit_count + 1,
+        frecency = frecency_add(frecency, excluded.frecency)
+"""
+# 訪問の行を追加する (引数: 訪問日時, 訪問の種類, url)
+_INSERT_VISIT = "INSERT INTO visits (url_id, visit_time, transition) SELECT id, ?, ? FROM urls WHERE url = ?"
+
+
+class HistoryStore:
+    """
+    履歴データベースへの接続を1つだけ保持し、訪問の記録をまとめて書き込むストア。
+    ページを読み込むたびに接続を開いてコミット (fsync) していたのをやめ、
+    record_visit() でバッファした訪問を flush() で1つのトランザクションにまとめて書き込む。
+    WALモードなので、書き込み中でも読み込みはブロックされない。
+    接続を作成したスレッドからのみ使用できる。GUIからは HistoryService を経由して使う。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._pending = [] # まだ書き込んでいない訪問 (url, title, 訪問日時のUNIX時間 (ミリ秒), 訪問の種類)
+        self.has_fts = False
+        self._maintaining = False # maintain() による整理の途中かどうか
+        self._size_row_limit = 0 # 今回の整理で、サイズの制限を守るために残すURLの数 (0は無制限)
+        self._conn = sqlite3.connect(db_path)
+        # frecencyの計算に使う関数 (訪問の書き込みとマイグレーションで使う)
+        self._conn.create_function("visit_score", 2, visit_score, deterministic=True)
+        self._conn.create_function("frecency_add", 2, frecency_add, deterministic=True)
+        try:
+            # 新しいデータベースでは、削除で空いたページを incremental_vacuum で少しずつ返せるようにする
+            # (テーブルを作る前にしか変えられない。既存のデータベースは maintain() で変換する)
+            self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # WALではNORMALでもデータベースは壊れない (電源断時に直近のコミットが失われうるだけ)
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            # URLを削除したときに訪問も削除されるようにする (ON DELETE CASCADE)
+            self._conn.execute("PRAGMA foreign_keys=ON")
+            migrate(self._conn)
+            self.has_fts = _has_table(self._conn, "urls_fts")
+        except sqlite3.Error as e:
+            print(f"履歴データベースの初期化に失敗しました: {e}")
+
+    @property
+    def pending_count(self):
+        """バッファ中の訪問の件数"""
+        return len(self._pending)
+
+    def record_visit(self, url, title, visit_time=None, transition=TRANSITION_LINK):
+        """
+        訪問をバッファに追加する。件数がしきい値に達した場合はその場で書き込む。
+        書き込んだ場合はTrueを返す。
+        """
+        if visit_time is None:
+            visit_time = now_ms()
+        self._pending.append((url, title, visit_time, transition))
+        if len(self._pending) >= HISTORY_FLUSH_BATCH_SIZE:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """
+        バッファした訪問を1つのトランザクションで書き込む。
+        URLごとのfrecencyはここで訪問の分だけ足し込むので、読み込み時に訪問を集計し直す必要はない。
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            with self._conn:
+                self._conn.executemany(_UPSERT_URL, [
+                    (url, title, visit_time, visit_time, TRANSITION_WEIGHTS.get(transition, 1.0))
+                    for url, title, visit_time, transition in pending
+                ])
+                self._conn.executemany(_INSERT_VISIT, [
+                    (visit_time, transition, url) for url, title, visit_time, transition in pending
+                ])
+        except sqlite3.Error as e:
+            print(f"履歴の更新に失敗しました: {e}")
+
+    def _query(self, sql, params=()):
+        # 読み込みの前にバッファを書き込み、直前の訪問も結果に含める
+        self.flush()
+        try:
+            return self._conn.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            print(f"履歴データベースの読み込みに失敗しました: {e}")
+            return []
+
+    def page(self, text="", after=None, limit=HISTORY_PAGE_SIZE):
+        """
+        最近訪問した順に並べた履歴の1ページ分を (タイトル, URL, 最終訪問日時, id) のリストで返す。
+        after には前のページの最後の行の (最終訪問日時, id) を渡す (キーセットページング) 。
+        OFFSETと違い読み飛ばす行がないので、どれだけ先のページでもインデックスの範囲を読むだけで済む。
+        text を指定した場合は一致する履歴だけを返す (全文検索は絞り込みだけに使い、順序は訪問順のまま) 。
+        一致する行を訪問順に並べる部分はSQLiteが上位 limit 件だけを保持して行うので、
+        一致する件数が多くても、メモリに載るのは1ページ分だけで済む。
+        """
+        query = _fts_query(text) if text else None
+        fts = self.has_fts and query is not None and text.isascii()
+        conditions, params = [], []
+        if fts:
+            conditions.append("urls_fts MATCH ?")
+            params.append(query)
+        elif text:
+            conditions.append("(h.title LIKE ? OR h.url LIKE ?)")
+            params.extend((f"%{text}%", f"%{text}%"))
+        if after is not None:
+            conditions.append("(h.last_visit_time, h.id) < (?, ?)")
+            params.extend(after)
+        source = "urls_fts AS f JOIN urls AS h ON h.id = f.rowid" if fts else "urls AS h"
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._query(f"""
+            SELECT h.title, h.url, h.last_visit_time, h.id FROM {source}
+            {where}
+            ORDER BY h.last_visit_time DESC, h.id DESC
+            LIMIT ?
+        """, (*params, limit))
+
+    def frecent(self, limit=HISTORY_QUERY_LIMIT):
+        """
+        frecencyの高い順に (タイトル, URL, 最終訪問日時, frecency) のリストを返す。
+        frecencyは書き込み時に計算済みなので、インデックスを逆順にたどるだけで済む。
+        """
+        return self._query("""
+            SELECT title, url, last_visit_time, frecency FROM urls
+            ORDER BY frecency DESC
+            LIMIT ?
+        """, (limit,))
+
+    def search(self, text, limit=HISTORY_QUERY_LIMIT):
+        """
+        タイトルかURLが text に一致する履歴を (タイトル, URL, 最終訪問日時, id) のリストで返す。
+        全文検索が使える場合は、空白で区切った各語の前方一致 (AND) で引き、bm25の順位の高い順に並べる。
+        履歴ウィンドウで検索したときの最初の結果に使う (続きは page() で訪問順に読み込む) 。
+        """
+        query = _fts_query(text)
+        if self.has_fts and query is not None and text.isascii():
+            weights = ", ".join(str(w) for w in HISTORY_SEARCH_WEIGHTS)
+            return self._query(f"""
+                SELECT h.title, h.url, h.last_visit_time, h.id
+                FROM (
+                    SELECT rowid, bm25(urls_fts, {weights}) AS score FROM urls_fts
+                    WHERE urls_fts MATCH ?
+                    ORDER BY rowid DESC
+                    LIMIT ?
+                ) AS m
+                JOIN urls AS h ON h.id = m.rowid
+                ORDER BY m.score
+                LIMIT ?
+            """, (query, HISTORY_SEARCH_CANDIDATES, limit))
+        # 日本語などは語が空白で区切られず、トークンの途中からの一致を全文検索で引けないため部分一致で検索する
+        # (記号だけの入力も同様)
+        pattern = f"%{text}%"
+        return self._query("""
+            SELECT title, url, last_visit_time, id FROM urls
+            WHERE title LIKE ? OR url LIKE ?
+            ORDER BY last_visit_time DESC, id DESC
+            LIMIT ?
+        """, (pattern, pattern, limit))
+
+    def clear(self):
+        """バッファも含めてすべての履歴を削除する"""
+        self._pending = []
+        try:
+            with self._conn:
+                self._conn.execute("DELETE FROM visits")
+                self._conn.execute("DELETE FROM urls")
+        except sqlite3.Error as e:
+            print(f"履歴データベースのクリアに失敗しました: {e}")
+
+    def maintain(self, policy, now=None):
+        """
+        保存期間などの制限を超えた履歴を少しずつ削除し、空いた領域をファイルから解放する。
+        1回の呼び出しでは HISTORY_PRUNE_BATCH_SIZE 行の削除や HISTORY_VACUUM_PAGES ページの解放など、
+        小さな作業を1つだけ行う。まだ作業が残っていればTrueを返すので、間に他の処理を挟みながら
+        Falseが返るまで繰り返し呼ぶ (ここまでを1回の整理とする) 。
+        """
+        try:
+            if self._conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2: # 2 = INCREMENTAL
+                # 既存のデータベースは一度だけ VACUUM して incremental_vacuum を使えるようにする
+                self.flush()
+                self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                self._conn.execute("VACUUM")
+                return True
+            if not self._maintaining:
+                self._maintaining = True
+                self._size_row_limit = self._rows_for_size(policy)
+            if self._prune(policy, now_ms() if now is None else now):
+                return True
+            if self.has_fts and self._merge_fts():
+                return True
+            free_pages = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if free_pages:
+                # execute() ではこのPRAGMAが1ステップ (1ページ) しか実行されないため executescript() を使う
+                self._conn.executescript(f"PRAGMA incremental_vacuum({HISTORY_VACUUM_PAGES});")
+            if free_pages > HISTORY_VACUUM_PAGES:
+                return True
+        except sqlite3.Error as e:
+            print(f"履歴の整理に失敗しました: {e}")
+        self._maintaining = False
+        return False
+
+    def _rows_for_size(self, policy):
+        """
+        データベースの大きさを制限に収めるために残すURLの数を見積もる (制限内なら0) 。
+        行を削除しても、ページの断片化や全文検索インデックスの削除済みの項目のため、
+        使用中のページはすぐには比例して減らない。削除しながら大きさを測り直すと消しすぎるので、
+        整理の始めに一度だけ、1行あたりの大きさから残す行数を決めておく。
+        """
+        if not policy.max_size_mb:
+            return 0
+        page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        used = (page_count - free_pages) * page_size
+        max_bytes = policy.max_size_mb * 1024 * 1024
+        if used <= max_bytes:
+            return 0
+        url_count = self._conn.execute("SELECT count(*) FROM urls").fetchone()[0]
+        # 見積もりの誤差を考えて1割余分に減らす。収まらなければ次回の整理でさらに減らす
+        return max(1, int(url_count * max_bytes / used * 0.9))
+
+    def _prune(self, policy, now):
+        """制限を超えた履歴を最大 HISTORY_PRUNE_BATCH_SIZE 行削除し、削除した行数を返す"""
+        batch = HISTORY_PRUNE_BATCH_SIZE
+        with self._conn:
+            if policy.max_age_days:
+                cutoff = now - policy.max_age_days * 24 * 60 * 60 * 1000
+                # 最後の訪問が保存期間より前のURL (訪問と全文検索インデックスも一緒に消える)
+                deleted = self._delete_oldest_urls(batch, "WHERE last_visit_time < ?", (cutoff,))
+                if deleted:
+                    return deleted
+                # 最近も訪問しているURLの、保存期間より前の訪問
+                deleted = self._conn.execute("""
+                    DELETE FROM visits WHERE id IN (
+                        SELECT id FROM visits WHERE visit_time < ? ORDER BY visit_time LIMIT ?
+                    )
+                """, (cutoff, batch)).rowcount
+                if deleted:
+                    return deleted
+            max_urls = min(limit for limit in (policy.max_urls, self._size_row_limit, float("inf")) if limit)
+            if max_urls != float("inf"):
+                excess = self._conn.execute("SELECT count(*) FROM urls").fetchone()[0] - max_urls
+                if excess > 0:
+                    # 最後の訪問が古いものから削除する
+                    return self._delete_oldest_urls(min(excess, batch))
+        return 0
+
+    def _merge_fts(self):
+        """
+        全文検索インデックスのセグメントを少しマージし、削除済みの項目が占める領域を片付ける。
+        まだマージするものが残っていればTrueを返す。
+        """
+        before = self._conn.total_changes
+        with self._conn:
+            # 負の値を指定すると、セグメントの数によらずマージを進める
+            self._conn.execute(
+                "INSERT INTO urls_fts(urls_fts, rank) VALUES ('merge', ?)", (-HISTORY_FTS_MERGE_PAGES,)
+            )
+        # 何もマージしなかった場合は変更が2未満になる
+        return self._conn.total_changes - before >= 2
+
+    def _delete_oldest_urls(self, limit, where="", params=()):
+        return self._conn.execute(f"""
+            DELETE FROM urls WHERE id IN (
+                SELECT id FROM urls {where} ORDER BY last_visit_time LIMIT ?
+            )
+        """, (*params, limit)).rowcount
+
+    def close(self):
+        """バッファを書き込んで接続を閉じる"""
+        self.flush()
+        self._conn.close()
+
+
+class RetentionPolicy:
+    """履歴の保存期間 (日) ・最大件数 (URL数) ・データベースの最大サイズ (MB) 。0は無制限"""
+
+    def __init__(self, max_age_days=0, max_urls=0, max_size_mb=0):
+        self.max_age_days = max_age_days
+        self.max_urls = max_urls
+        self.max_size_mb = max_size_mb
+
+    def __bool__(self):
+        return bool(self.max_age_days or self.max_urls or self.max_size_mb)
+
+    def __eq__(self, other):
+        if not isinstance(other, RetentionPolicy):
+            return NotImplemented
+        return (self.max_age_days, self.max_urls, self.max_size_mb) == (other.max_age_days, other.max_urls, other.max_size_mb)
+
+
+def _fts_query(text):
+    """
+    入力された文字列をFTS5のクエリに変換する。各語は引用符で囲んで前方一致にするので、
+    記号を含む語 (URLの一部など) も構文エラーにならない。検索できる語がなければNoneを返す。
+    """
+    terms = [term for term in text.split() if any(ch.isalnum() for ch in term)]
+    if not terms:
+        return None
+    return " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+
+
+class HistoryService:
+    """
+    履歴データベースの入出力をすべて専用のスレッドで行うサービス。
+    HistoryStore はワーカースレッドの中で作成され、他のスレッドからは触らない。
+    書き込み (record_visit) はキューに積むだけで戻り、
+    読み込み (page / search など) は結果を受け取る Future をすぐに返すので、
+    呼び出し元 (GUIスレッド) がSQLiteの処理やロックを待つことはない。
+    キューは先入れ先出しなので、記録した訪問はその後の読み込みの結果に必ず含まれる。
+    保存期間の制限 (set_retention) を設定すると、キューが HISTORY_IDLE_SECONDS の間空いていたとき
+    (ブラウザが使われていないとき) に、古い履歴の削除と領域の解放を少しずつ行う。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._queue = queue.Queue()
+        self._closed = False
+        self._retention = RetentionPolicy()
+        self._maintenance_at = 0.0 # 次に履歴を整理する時刻 (time.monotonic())
+        self._thread = threading.Thread(target=self._run, name="HistoryService", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            store = HistoryStore(self.db_path)
+        except sqlite3.Error as e:
+            # ファイルを開けない場合もスレッドを止めず、このセッションの間だけメモリ上に記録する
+            print(f"履歴データベースを開けませんでした: {e}")
+            store = HistoryStore(":memory:")
+        flush_at = None # バッファした訪問を書き込む時刻 (最初の訪問から HISTORY_FLUSH_INTERVAL 後)
+        last_task_at = time.monotonic()
+        while True:
+            now = time.monotonic()
+            deadlines = []
+            if flush_at is not None:
+                deadlines.append(flush_at)
+            if self._retention:
+                deadlines.append(max(self._maintenance_at, last_task_at + HISTORY_IDLE_SECONDS))
+            timeout = max(0.0, min(deadlines) - now) if deadlines else None
+            try:
+                task = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                now = time.monotonic()
+                if flush_at is not None and now >= flush_at:
+                    store.flush()
+                    flush_at = None
+                elif self._retention and not store.maintain(self._retention):
+                    # 整理し終えた。残っていれば、間に届いた処理を先に行ってから続きを行う
+                    self._maintenance_at = now + HISTORY_MAINTENANCE_INTERVAL
+                continue
+            last_task_at = time.monotonic()
+            if task is None:
+                store.close()
+                return
+            func, args, future = task
+            if future is not None and not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = func(store, *args)
+            except Exception as e:
+                if future is None:
+                    print(f"履歴データベースの処理に失敗しました: {e}")
+                else:
+                    future.set_exception(e)
+            else:
+                if future is not None:
+                    future.set_result(result)
+            if not store.pending_count:
+                flush_at = None
+            elif flush_at is None:
+                flush_at = time.monotonic() + HISTORY_FLUSH_INTERVAL
+
+    def _submit(self, func, *args, want_result=True):
+        future = Future() if want_result else None
+        if self._closed:
+            if future is not None:
+                future.set_exception(RuntimeError("履歴サービスは終了しています"))
+            return future
+        self._queue.put((func, args, future))
+        return future
+
+    def record_visit(self, url, title, visit_time=None, transition=TRANSITION_LINK):
+        """訪問を記録する。訪問日時は呼び出した時点のものを使う"""
+        self._submit(HistoryStore.record_visit, url, title, visit_time or now_ms(), transition, want_result=False)
+
+    def page(self, text="", after=None, limit=HISTORY_PAGE_SIZE):
+        """HistoryStore.page() の結果を受け取る Future を返す"""
+        return self._submit(HistoryStore.page, text, after, limit)
+
+    def frecent(self, limit=HISTORY_QUERY_LIMIT):
+        """HistoryStore.frecent() の結果を受け取る Future を返す"""
+        return self._submit(HistoryStore.frecent, limit)
+
+    def search(self, text, limit=HISTORY_QUERY_LIMIT):
+        """HistoryStore.search() の結果を受け取る Future を返す"""
+        return self._submit(HistoryStore.search, text, limit)
+
+    def flush(self):
+        """バッファした訪問を書き込む。書き込みが終わると完了する Future を返す"""
+        return self._submit(HistoryStore.flush)
+
+    def clear(self):
+        """すべての履歴を削除する。削除が終わると完了する Future を返す"""
+        # 空いた領域は次に整理するときに解放される
+        self._maintenance_at = 0.0
+        return self._submit(HistoryStore.clear)
+
+    def set_retention(self, policy):
+        """
+        履歴の保存期間などの制限を設定する。次にブラウザが使われていないときに整理を行う。
+        ウィンドウを開くたびに同じ設定で呼ばれるので、制限が変わっていなければ何もしない
+        (整理の予定を前倒しし続けたり、待機中のワーカーを起こしてアイドル時間を数え直させたりしない) 。
+        """
+        if policy == self._retention:
+            return
+        self._retention = policy
+        self._maintenance_at = 0.0
+        # 待機中のワーカーを起こして、待ち時間を計算し直させる
+        self._submit(lambda store: None, want_result=False)
+
+    def close(self, timeout=None):
+        """キューに積まれた処理とバッファを書き込んでからスレッドを終了する"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+
+# データベースのパスごとに共有するサービス (同じプロファイルのウィンドウは1つのスレッドと接続を使う)
+_services = {}
+
+
+def history_service_for(db_path):
+    """db_path のサービスを返す。まだなければ作成してスレッドを開始する"""
+    service = _services.get(db_path)
+    if service is None:
+        service = _services[db_path] = HistoryService(db_path)
+    return service
+
+
+@atexit.register
+def _close_services():
+    # デーモンスレッドが止められる前に、書き込み待ちの訪問を保存する
+    for service in _services.values():
+        service.close()
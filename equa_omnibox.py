@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+EQUA アドレスバーの入力候補 (オムニボックス)
+
+履歴・ブックマーク・開いているタブから、アドレスバーに入力中の文字列に一致する候補を集め、
+frecencyの順に並べて返す。Qtに依存しない純粋なPythonの部分をまとめたモジュール。
+equa.py / equa-copy.py のどちらからも利用される。
+"""
+import bisect
+import math
+import re
+import time
+
+from equa_history import TRANSITION_TYPED, TRANSITION_WEIGHTS, frecency_add, now_ms, visit_score
+
+# アドレスバーに表示する候補の最大件数
+OMNIBOX_MAX_SUGGESTIONS = 8
+# 1回の入力で候補を集めるのにかけてよい時間 (秒)。1フレームに収め、入力した文字の表示を遅らせないようにする
+OMNIBOX_BUDGET = 0.016
+# 索引に載せる履歴の件数 (frecencyの高いものから)
+OMNIBOX_HISTORY_SIZE = 20_000
+# 履歴の索引を作り直す間隔 (秒)。この間に初めて訪問したページは、次に作り直すまで候補に出ない
+OMNIBOX_REFRESH_INTERVAL = 60
+
+# 候補の出どころ (ビットの組み合わせ)
+SOURCE_HISTORY = 1
+SOURCE_BOOKMARK = 2
+SOURCE_TAB = 4
+
+# ブックマークと開いているタブを、アドレスバーに入力して今訪問したのと同じ訪問が何回あったものとして数えるか
+BOOKMARK_VISIT_WEIGHT = 4 * TRANSITION_WEIGHTS[TRANSITION_TYPED]
+TAB_VISIT_WEIGHT = 2 * TRANSITION_WEIGHTS[TRANSITION_TYPED]
+# 入力した文字列でURLが始まる候補 (そのまま補完できるもの) のfrecencyに掛ける倍率 (対数)
+URL_PREFIX_BOOST = math.log(4)
+
+# この文字数までの接頭辞については、一致する項目のうちfrecencyの高いものをあらかじめ求めておく
+_TOP_PREFIX_LENGTH = 3
+_TOP_PREFIX_RANGE = range(1, _TOP_PREFIX_LENGTH + 1)
+# あらかじめ求めておく項目の数 (接頭辞ごと)
+_TOP_PREFIX_SIZE = 32
+# それより長い接頭辞で、索引の範囲から調べる項目の最大数
+_SCAN_LIMIT = 256
+# 時間切れかどうかを確かめる間隔 (項目の数)
+_DEADLINE_CHECK_INTERVAL = 64
+
+# 照合の前にURLや入力から取り除く、スキームと先頭の「www.」
+_URL_PREFIX_RE = re.compile(r"^(?:[a-z][a-z0-9+.\-]*://)?(?:www\.)?")
+# タイトル・URLを語に区切る
+_TERM_RE = re.compile(r"\w+")
+# 範囲検索の上限に使う、どの文字よりも後ろに並ぶ文字
+_MAX_CHAR = chr(0x10FFFF)
+
+
+def url_key(url):
+    """照合用にURLを正規化する (小文字にし、スキームと先頭の www. を取り除く)"""
+    return _URL_PREFIX_RE.sub("", url.lower(), count=1)
+
+
+def query_terms(text):
+    """入力を空白で区切り、照合用に正規化した語のリストにする"""
+    terms = (url_key(term) for term in text.lower().split())
+    return [term for term in terms if term]
+
+
+class _Entry:
+    """索引の1項目"""
+    __slots__ = ("url", "title", "frecency", "key", "text")
+
+    def __init__(self, url, title, frecency):
+        self.url = url
+        self.title = title or url
+        self.frecency = frecency
+        self.key = url_key(url)
+        # 入力の各語が含まれているかを確かめる文字列
+        self.text = f"{self.key}\n{self.title.lower()}"
+
+
+class Suggestion:
+    """アドレスバーの入力候補"""
+    __slots__ = ("url", "title", "sources", "score")
+
+    def __init__(self, url, title, sources, score=None):
+        self.url = url
+        self.title = title
+        self.sources = sources # SOURCE_* の組み合わせ
+        self.score = score # 順位付けに使った値 (frecencyと同じ対数の値)
+
+    def __repr__(self):
+        return f"Suggestion({self.url!r}, {self.title!r}, {self.sources}, {self.score})"
+
+
+class SuggestionIndex:
+    """
+    URL全体と、タイトル・URLに含まれる語の前方一致で項目を引く索引。
+    キーをソートした配列を二分探索するので、トライ木と同じく接頭辞に一致するキーが連続した範囲として得られる。
+    項目はfrecencyの高い順に番号を振っておき、一致する項目が多い短い接頭辞については
+    frecencyの高い項目をあらかじめ求めておく (1文字目からすべての項目をたどらずに済むように) 。
+    作るのには時間がかかるので別スレッドで作り、できあがったものと丸ごと差し替えて使う (作った後は変更しない) 。
+    """
+
+    def __init__(self, items=()):
+        """items は (URL, タイトル, frecency) の列。frecencyは visit_score() と同じ対数の値で、Noneは訪問なし"""
+        entries = [_Entry(url, title, frecency) for url, title, frecency in items if url]
+        entries.sort(key=lambda e: -math.inf if e.frecency is None else -e.frecency)
+        self.entries = []
+        self._by_url = {}
+        keys = []
+        top = {}
+        full = set() # 項目が _TOP_PREFIX_SIZE 件そろった接頭辞 (以降の項目は調べない)
+        for entry in entries:
+            if entry.url in self._by_url:
+                continue
+            i = len(self.entries)
+            self.entries.append(entry)
+            self._by_url[entry.url] = i
+            terms = {entry.key, *_TERM_RE.findall(entry.text)}
+            keys.extend((term, i) for term in terms)
+            for prefix in {term[:n] for term in terms for n in _TOP_PREFIX_RANGE} - full:
+                ids = top.get(prefix)
+                if ids is None:
+                    top[prefix] = [i]
+                else:
+                    ids.append(i)
+                    if len(ids) == _TOP_PREFIX_SIZE:
+                        full.add(prefix)
+        keys.sort()
+        self._keys = [term for term, _ in keys]
+        self._ids = [i for _, i in keys]
+        self._top = top
+
+    @classmethod
+    def from_history(cls, rows):
+        """HistoryStore.frecent() の結果 (タイトル, URL, 最終訪問日時, frecency) から作る"""
+        return cls((url, title, frecency) for title, url, _, frecency in rows)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def frecency(self, url):
+        """url の項目のfrecency (なければNone)"""
+        i = self._by_url.get(url)
+        return None if i is None else self.entries[i].frecency
+
+    def candidates(self, prefix):
+        """
+        接頭辞 prefix で始まるキーを持つ項目の番号を、frecencyの高い順に返す。
+        長い接頭辞では、範囲の先頭から _SCAN_LIMIT 件と、先頭 _TOP_PREFIX_LENGTH 文字で求めておいた
+        項目を合わせて返す (後者は prefix に一致するとは限らないので、呼び出し側で確かめる) 。
+        """
+        if len(prefix) <= _TOP_PREFIX_LENGTH:
+            return self._top.get(prefix, ())
+        lo = bisect.bisect_left(self._keys, prefix)
+        hi = bisect.bisect_left(self._keys, prefix + _MAX_CHAR, lo, min(len(self._keys), lo + _SCAN_LIMIT))
+        ids = set(self._ids[lo:hi])
+        ids.update(self._top.get(prefix[:_TOP_PREFIX_LENGTH], ()))
+        return sorted(ids)
+
+
+class Omnibox:
+    """
+    履歴・ブックマーク・開いているタブから入力候補を集め、まとめて順位付けする。
+    履歴とブックマークの索引は別スレッドで作ったものを set_history() / set_bookmarks() で差し替え、
+    開いているタブは数が少ないので索引を作らず suggest() のたびに渡す。
+    順位は履歴のfrecencyで付け、ブックマークと開いているタブは、今その重みの訪問があったものとして足し込む。
+    """
+
+    def __init__(self):
+        self.history = SuggestionIndex()
+        self.bookmarks = SuggestionIndex()
+
+    def set_history(self, index):
+        self.history = index
+
+    def set_bookmarks(self, index):
+        self.bookmarks = index
+
+    def suggest(self, text, tabs=(), limit=OMNIBOX_MAX_SUGGESTIONS, budget=OMNIBOX_BUDGET, now=None):
+        """
+        text に一致する候補を、順位の高い順に最大 limit 件の Suggestion のリストで返す。
+        tabs は開いているタブの (URL, タイトル) の列。
+        候補を集め始めてから budget 秒を過ぎたら、それまでに集めた候補だけで順位付けする。
+        """
+        terms = query_terms(text)
+        if not terms:
+            return []
+        deadline = time.perf_counter() + budget
+        now = now_ms() if now is None else now
+        typed = " ".join(terms)
+        found = {} # URL -> Suggestion
+        completable = set() # 入力した文字列でURLが始まる候補
+
+        def add(entry, source):
+            suggestion = found.get(entry.url)
+            if suggestion is None:
+                found[entry.url] = Suggestion(entry.url, entry.title, source)
+                if entry.key.startswith(typed):
+                    completable.add(entry.url)
+            else:
+                suggestion.sources |= source
+
+        for url, title in tabs:
+            entry = _Entry(url, title, None)
+            if url and all(term in entry.text for term in terms):
+                add(entry, SOURCE_TAB)
+        # 最も長い語で索引を引き、残りの語は項目の文字列に含まれるかで確かめる
+        lead = max(terms, key=len)
+        for index, source in ((self.bookmarks, SOURCE_BOOKMARK), (self.history, SOURCE_HISTORY)):
+            for count, i in enumerate(index.candidates(lead)):
+                if count % _DEADLINE_CHECK_INTERVAL == 0 and time.perf_counter() > deadline:
+                    break
+                entry = index.entries[i]
+                if all(term in entry.text for term in terms):
+                    add(entry, source)
+
+        bookmark_score = visit_score(now, BOOKMARK_VISIT_WEIGHT)
+        tab_score = visit_score(now, TAB_VISIT_WEIGHT)
+        for suggestion in found.values():
+            score = self.history.frecency(suggestion.url)
+            if suggestion.sources & SOURCE_BOOKMARK:
+                score = frecency_add(score, bookmark_score)
+            if suggestion.sources & SOURCE_TAB:
+                score = frecency_add(score, tab_score)
+            if score is None:
+                score = -math.inf
+            if suggestion.url in completable:
+                score += URL_PREFIX_BOOST
+            suggestion.score = score
+        return sorted(found.values(), key=lambda s: s.score, reverse=True)[:limit]
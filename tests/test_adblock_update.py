@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+更新元リストのダウンロード (fetch_list / fetch_lists) のテスト
+
+ローカルの http.server をスレッドで起動して更新元の代わりにし、
+gzip圧縮された200、ETagによる304、期限を過ぎる遅い更新元を確かめる。ネットワークは使わない。
+
+使い方:
+    python -m pytest tests
+"""
+import gzip
+import http.server
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from equa_adblock import ListSourceStore, fetch_list, fetch_lists # noqa: E402
+
+LIST_LINES = ["[Adblock Plus 2.0]", "! Title: test", "||ads.example.com^", "/banner/*", "example.com##.ad"]
+LIST_BODY = "\r\n".join(LIST_LINES).encode("utf-8") + b"\r\n"
+ETAG = '"v1"'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path == "/list.txt":
+            if self.headers.get("If-None-Match") == ETAG:
+                self.send_response(304)
+                self.send_header("ETag", ETAG)
+                self.end_headers()
+                return
+            body = LIST_BODY
+            gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+            if gzipped:
+                body = gzip.compress(body)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", ETAG)
+            if gzipped:
+                self.send_header("Content-Encoding", "gzip")
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/slow.txt":
+            # 本体を少しずつ送り続け、テストが終わるまで完了しない更新元
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.end_headers()
+            try:
+                while not self.server.stopping.wait(0.05):
+                    self.wfile.write(b"||slow.example.com^\n")
+                    self.wfile.flush()
+            except OSError:
+                pass # クライアントが期限切れで切断した
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.daemon_threads = True
+    httpd.requests = []
+    httpd.stopping = threading.Event()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield httpd
+    finally:
+        httpd.stopping.set()
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join(5)
+
+
+def _url(server, path):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}{path}"
+
+
+def _read(store, url):
+    with open(store.path_for(url), "r", encoding="utf-8") as f:
+        return f.read().splitlines()
+
+
+def test_fetch_list_gzip(server, tmp_path):
+    store = ListSourceStore(str(tmp_path))
+    url = _url(server, "/list.txt")
+    assert fetch_list(url, store) is True
+    _, headers = server.requests[-1]
+    assert "gzip" in headers["Accept-Encoding"]
+    assert "If-None-Match" not in headers
+    # 展開され、改行コードの \r も取り除かれている
+    assert _read(store, url) == LIST_LINES
+    assert store.validators(url) == {"etag": ETAG}
+
+
+def test_fetch_list_not_modified(server, tmp_path):
+    store = ListSourceStore(str(tmp_path))
+    url = _url(server, "/list.txt")
+    assert fetch_list(url, store) is True
+    assert fetch_list(url, store) is False
+    _, headers = server.requests[-1]
+    assert headers["If-None-Match"] == ETAG
+    # 304のときは保存済みのリストをそのまま使う
+    assert _read(store, url) == LIST_LINES
+
+
+def test_fetch_list_deadline(server, tmp_path):
+    store = ListSourceStore(str(tmp_path))
+    url = _url(server, "/slow.txt")
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        fetch_list(url, store, timeout=5, deadline=time.monotonic() + 0.5)
+    assert time.monotonic() - start < 3
+    # 途中まで受け取った内容は保存しない
+    assert not store.has(url)
+    assert not os.path.exists(store.path_for(url) + ".tmp")
+
+
+def test_fetch_lists_slow_source_does_not_block_others(server, tmp_path):
+    store = ListSourceStore(str(tmp_path))
+    fast, slow = _url(server, "/list.txt"), _url(server, "/slow.txt")
+    start = time.monotonic()
+    results = {url: (ok, modified, error) for url, ok, modified, error in
+               fetch_lists([slow, fast], store, source_deadline=0.5, update_deadline=5)}
+    assert time.monotonic() - start < 3
+    assert results[fast] == (True, True, "")
+    ok, modified, error = results[slow]
+    assert not ok and not modified and error
+    assert _read(store, fast) == LIST_LINES
+    assert not store.has(slow)
+
+
+def test_fetch_lists_update_deadline(server, tmp_path):
+    # 全体の期限を過ぎてから順番が回ってきたリストは通信せずにタイムアウトになる
+    store = ListSourceStore(str(tmp_path))
+    slow, fast = _url(server, "/slow.txt"), _url(server, "/list.txt")
+    results = {url: ok for url, ok, _, _ in
+               fetch_lists([slow, fast], store, max_workers=1, source_deadline=0.5, update_deadline=0.3)}
+    assert results == {slow: False, fast: False}
+    assert [path for path, _ in server.requests] == ["/slow.txt"]